@@ -1,15 +1,17 @@
 import os, sys, joblib, random
 from joblib import Memory
 mem = Memory(cachedir='./tmp', mmap_mode='r', verbose=0)
-from multiprocessing import cpu_count
+from multiprocessing import Pool, cpu_count
 from collections import defaultdict
 import numpy as np
 from dtw import DTW
 from mfcc_and_gammatones import FBANKS_RATE
+from scheduler import JobStats, map_longest_first
 
 from random import shuffle
 
 OLD_SCHEME = False
+N_WORKERS = max(1, cpu_count() - 1) # DTW processes
 
 class Memoize:
     """Memoize(fn) - an instance which acts like fn but memoizes its arguments
@@ -50,6 +52,18 @@ def do_dtw(word, x, y):
     return word, x, y, dtw[0], dtw[-1][1], dtw[-1][2]
 
 
+def longest_dtw_first(func, tasks, costs, names):
+    """ func(*task) for the tasks, the longest DTW (costs: len(x)*len(y))
+    first, in a Pool of N_WORKERS, returns the results in order """
+    p = Pool(N_WORKERS)
+    job_stats = JobStats(N_WORKERS, names=names)
+    res = map_longest_first(p, func, tasks, costs, star=True, stats=job_stats)
+    p.close()
+    p.join()
+    job_stats.report("dtw")
+    return res
+
+
 def do_dtw_pair(p1, p2):
     dtw = DTW(p1[2], p2[2], return_alignment=1)
     # word, talkerX, talkerY, x, y, cost_dtw, dtw_x_to_y_mapping, dtw_y_to_x_mapping
@@ -146,12 +160,14 @@ def match_words(words_feats, serial=False):
                         continue
                     res.append(do_dtw(word, x, y))
     else:
-        res = joblib.Parallel(n_jobs=cpu_count()-1)(joblib.delayed(do_dtw)
-                (word, l[i], y)
+        tasks = [(word, l[i], y)
                     for word, l in words_feats.items()
                         for i, x in enumerate(l)
                             for j, y in enumerate(l)
-                                if i < j)
+                                if i < j]
+        res = longest_dtw_first(do_dtw, tasks,
+                [len(x) * len(y) for _, x, y in tasks],
+                [word for word, _, _ in tasks])
     return res
 
 
@@ -209,8 +225,9 @@ if __name__ == '__main__':
         print("number of word types in all (not pairs!):", len(words_timings))
         same = pair_and_extract_same_words(words_timings)
         print("number of pairs of same words:", len(same))
-        same_words = joblib.Parallel(n_jobs=cpu_count()-1)(joblib.delayed(do_dtw_pair)
-                (sp[0], sp[1]) for sp in same)
+        same_words = longest_dtw_first(do_dtw_pair, same,
+                [len(sp[0][2]) * len(sp[1][2]) for sp in same],
+                [sp[0][0] for sp in same])
         
         joblib.dump(same_words, output_name + ".joblib",
                 compress=5, cache_size=512)
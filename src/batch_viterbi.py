@@ -1,30 +1,140 @@
 import numpy as np
-from numpy import linalg
 import functools
-import sys, math
+import sys, math, threading
 import pickle
 from collections import defaultdict, deque
-import htkmfc
 import itertools
 from multiprocessing import Pool, cpu_count
-import os
-from functools import reduce
+import os, re, tempfile
+from viterbi_kernels import build_topology, viterbi_sparse, viterbi_dense
+from viterbi_kernels import LOG_ZERO, BACKENDS, average_active
+from viterbi_kernels import run_viterbi_batch, pad_likelihoods, traceback
+from viterbi_kernels import sparse_step, dense_step, run_viterbi_lean
+from viterbi_kernels import run_forward_backward, transpose_topology
+from viterbi_kernels import sparse_sum_step, dense_sum_step, OnlineViterbi
+from lattice import build_lattice, string_nbest, lattice_fname
+from shared_arrays import SharedArray
+from decode_cache import DecodeCache
+from scheduler import OrderedWriter, JobStats, longest_first
+from scheduler import map_longest_first, file_costs, htk_n_frames
+from ngram_lm import parse_arpa, LMGraph, viterbi_ngram
+from lexicon_tree import parse_dict, LexiconTree, viterbi_words, string_words
+from scorers import eval_gauss_mixt, precompute_det_inv, compute_likelihoods
+from scorers import padding, compute_likelihoods_dbn, N_BATCHES_DATASET
+from scorers import DbnScorer, GmmScorer, load_scorer, save_scores
+from scorers import allocate_scores
+from two_pass import two_pass_likelihoods, TWO_PASS_BEAM
+from gaussian_selection import ShortlistScorer
+from parallel_viterbi import parallel_viterbi
 sys.path.append(os.getcwd())
 
 usage = """
-python viterbi.py OUTPUT[.mlf] INPUT_SCP INPUT_HMM  
+python batch_viterbi.py OUTPUT[.mlf] INPUT_SCP INPUT_HMM  
         [--p INSERTION_PENALTY] [--s SCALE_FACTOR] 
-        [--b INPUT_LM] [--w WDNET] [--ub UNI&BIGRAM_LM]
+        [--b INPUT_LM] [--w WDNET] [--ub UNI&BIGRAM_LM] [--ngram ARPA_LM]
+        [--dict HTK_DICT [--wlm WORD_ARPA_LM]]
+        [--sparse] [--backend numpy|compiled|auto]
+        [--beam LOG_BEAM] [--max-active N_STATES] [--batch N_UTTERANCES]
+        [--online MAX_DELAY] [--scan N_BLOCKS]
+        [--lattices OUTPUT_DIR] [--n N_BEST] [--lean] [--spill DIR]
+        [--states]
+        [--shared-dir DIR] [--cache DIR] [--cache-float16] [--pipeline N]
         [--d DBN_PICKLED_FILE DBN_TO_INT_TO_STATE_DICTS_TUPLE]
+        [--scores LIKELIHOODS.npy] [--save-scores LIKELIHOODS.npy]
+        [--memory-budget MB]
+        [--two-pass FIRST_PASS_HMM [--two-pass-beam LOG_BEAM]]
+        [--gs N_CODEWORDS]
         [--verbose]
 
+viterbi.py takes the same options and does not force the paths to start
+on !ENTER and end on !EXIT when there is no LM, batch_mocha_viterbi.py
+takes the same options and its --d DBN is on MFCC + articulatory features.
+
 Exclusive uses of these options:
     --b followed by an HTK bigram file (ARPA-MIT LL or matrix bigram, see code)
         /!\ A bigram LM will only work if there are sentences start/end
             (the default symbols are !ENTER/!EXIT)
     --w followed by a wordnet (bigram only)
     --ub followed by a pickled bigram file (apply src/produce_LM.py to a MLF)
+    --ngram followed by an ARPA backoff LM of any order (e.g. trigrams from
+        src/produce_LM.py --order 3), decoded on a graph that only has the
+        histories listed in the LM (see src/ngram_lm.py), one utterance at
+        a time (no --batch, --lattices or --n)
+    --dict followed by an HTK dictionary: outputs words, decoded on a prefix
+        tree of the pronunciations (see src/lexicon_tree.py), with the word
+        bigram of --wlm (ARPA, e.g. HLStats -b) or uniform words, one
+        utterance at a time (no --batch, --lattices or --n)
+
+Other options:
+    --sparse runs Viterbi on the compact (intra-phone band + phone to phone)
+        topology, in O(T.(S + P^2)) instead of O(T.S^2)
+    --backend followed by the dense Viterbi kernel to use: numpy (vectorized),
+        compiled (numba) or auto (compiled if numba is installed, default)
+    --beam followed by the log score beam: states scoring lower than the best
+        state of the frame minus the beam are pruned (as HVite -t)
+    --max-active followed by the max number of states kept at each frame
+    --batch followed by the number of utterances (of similar lengths) that
+        are decoded at once in a (N, T_max, S) tensor by each worker,
+        use it with --sparse for large numbers of states
+    --lattices followed by a directory where the phone lattices of each
+        utterance are written (HTK SLF, rescore them with src/lattice.py)
+    --n followed by the number of best phones strings written to the MLF
+        for each utterance (separated by ///, from the lattices), both
+        --lattices and --n decode the utterances one by one (no --batch)
     --d followed by a pickled DBN file and a pickled tuple of dicts (states map)
+    --scores followed by a likelihoods matrix (.npy, with its pickled
+        {file: (start, end)} map next to it in a .pickle) used instead of
+        the GMMs / DBN (see src/scorers.py)
+    --save-scores followed by the .npy where the likelihoods are written
+        (with their .pickle map) for later --scores (no --pipeline)
+    --two-pass followed by HMMs with the same states (e.g. with fewer
+        mixtures): their GMMs score a first pass whose (frame, state) pairs
+        within --two-pass-beam (default TWO_PASS_BEAM) of its best path are
+        the only ones scored (GMMs, --d DBN) and searched by the second
+        pass (see src/two_pass.py), no --online, --scan, --pipeline, --cache
+    --memory-budget followed by the MB of temporaries of each worker
+        scoring the GMMs (default MEMORY_BUDGET of src/scorers.py): the
+        frames are scored by chunks that fit in it; with --save-scores, the
+        workers write their files straight into the memory mapped .npy
+    --gs followed by the size of the VQ codebook of the Gaussian selection:
+        each frame only evaluates the Gaussians shortlisted for its nearest
+        codeword (see src/gaussian_selection.py, which also reports its
+        speed / accuracy), GMMs only
+    --online followed by the max number of undecided frames kept (0 for no
+        limit): decodes the files one after the other frame by frame, the
+        phones are written to the MLF as soon as all active paths agree
+        (for long recordings, memory stays bounded by MAX_DELAY frames),
+        GMMs only (no --d, --scores), phones with --b / --w / --ub or none
+        (no --ngram, --dict, --lattices, --n, --batch, --cache)
+    --scan followed by the number of blocks of each utterance scanned in
+        parallel (0 for the number of CPUs): decodes the files one after the
+        other, each on all the workers (blocked max-plus scan with a fix-up
+        pass, same path as the sequential Viterbi, see
+        src/parallel_viterbi.py), for a few very long recordings, phones
+        with --b / --w / --ub or none (no --ngram, --dict, --lattices,
+        --n, --batch, --lean, --cache), with --beam or --max-active (the
+        blocks only converge once the unlikely states are pruned)
+    --states writes the states (and their phones, as HVite -f) in the MLF
+        instead of the phones, the MLF lines are "start end label score"
+        (not for --lattices / --n / --dict / --online)
+    --lean keeps only two rows of scores and the backpointers in the
+        smallest integer type, utterances longer than LEAN_MAX_FRAMES get a
+        checkpointed (square-root) traceback (no posteriors are returned)
+    --spill followed by a directory where the backpointers of these long
+        utterances are written (memmap) instead of being recomputed
+    --shared-dir followed by a directory where the likelihoods and the
+        transitions shared with the workers are written (memmap) instead of
+        shared memory (/dev/shm)
+    --cache followed by a directory where the likelihoods and the decoded
+        utterances are kept, keyed by digests of the features, models, LM
+        and decoding parameters: reruns only redo what changed (not used
+        for --lattices / --n)
+    --cache-float16 stores the cached likelihoods in float16 (lossy)
+    --pipeline followed by the max number of utterances scored and not yet
+        decoded: scoring (by chunks of PIPELINE_CHUNK utterances for the
+        DBN) and decoding overlap and the likelihoods of the whole scp are
+        never in memory (no --batch, --cache, --shared-dir, --save-scores,
+        --two-pass, --online, --scan)
 """
 
 VERBOSE = False
@@ -35,8 +145,34 @@ SCALE_FACTOR = 1.0 # importance of the LM w.r.t. the acoustics
 INSERTION_PENALTY = 2.5 # penalty of inserting a new phone (in the Viterbi)
 epsilon = 1E-5 # degree of precision for floating (0.0-1.0 probas) operations
 epsilon_log = 1E-80 # to add for logs
-N_BATCHES_DATASET = 32 # number of batches in which we divide the dataset 
-                      # (to fit in the GPU memory, only 2Gb at home)
+SPARSE_VITERBI = False # Viterbi on the compact topology (phones band + P*P)
+VITERBI_BACKEND = 'auto' # dense Viterbi kernel: 'numpy', 'compiled' or 'auto'
+BEAM = None # log score beam w.r.t. the best state of each frame (None: no beam)
+MAX_ACTIVE = None # max number of active states per frame (None: all)
+ONLINE = False # frame-synchronous decoding, writes the MLF as it goes
+ONLINE_MAX_DELAY = None # max number of undecided frames (None: unbounded)
+LIKELIHOODS_CHUNK = 100 # frames of likelihoods computed at once when ONLINE
+UTTERANCES_PER_BATCH = 1 # utterances decoded at once by each Pool task (--batch)
+LATTICES_DIR = None # where to write the SLF lattices (None: no lattices)
+N_BEST = 1 # number of alternatives per utterance in the MLF
+LEAN_VITERBI = False # two rows of scores + compact backpointers (--lean)
+LEAN_MAX_FRAMES = 30000 # beyond that, lean Viterbi checkpoints or spills
+SPILL_DIR = None # where lean Viterbi spills long utterances (None: checkpoint)
+SHARED_DIR = None # memmap dir of the arrays shared w/ workers (None: /dev/shm)
+CACHE_DIR = None # likelihoods and decodings cache (None: no cache, --cache)
+CACHE_FLOAT16 = False # likelihoods cached in float16 (--cache-float16)
+PIPELINE_IN_FLIGHT = None # max utterances scored, not decoded (None: no pipeline)
+PIPELINE_CHUNK = 16 # utterances scored at once by the DBN in the pipeline
+HTK_FRAME = 100000 # duration of a frame in HTK's 100ns units (TARGETRATE)
+MLF_STATES = False # states level MLF (phones level if False, --states)
+IMAP_CHUNKSIZE = 1 # scp lines per Pool task, results streamed to the MLF
+FORCE_ENTER_EXIT = True # paths from !ENTER to !EXIT even without LM (viterbi.py: not)
+DBN_SCORER = DbnScorer # Scorer class of the --d DBN (batch_mocha_viterbi.py: its own)
+SAVE_SCORES = None # .npy where the likelihoods are written (--save-scores)
+SCAN_BLOCKS = None # blocks of each utterance scanned in parallel (None: no --scan)
+FIRST_PASS_HMM = None # HMMs whose GMMs select the pairs to score (--two-pass)
+GS_CODEWORDS = None # codebook size of the Gaussian selection (None: no --gs)
+MEMORY_BUDGET = None # bytes of GMM scoring temporaries per worker (None: scorers')
 
 class Phone:
     def __init__(self, phn_id, phn):
@@ -55,113 +191,6 @@ def clean(s):
     return s.strip().rstrip('\n')
 
 
-def eval_gauss_mixt(v, gmixt):
-    assert(len(gmixt[0]) == gmixt[1].shape[0] == gmixt[2].shape[0])
-    def eval_gauss_comp(mix_comp): # closure
-        pi_k, mu_k, sigma_k_inv = mix_comp
-        return pi_k * math.exp(-0.5 * np.dot((v - mu_k).T, 
-                    np.dot(sigma_k_inv, v - mu_k)))
-    return reduce(lambda x, y: x + y, list(map(eval_gauss_comp, 
-        zip(gmixt[0], gmixt[1], gmixt[2]))))
-
-
-def precompute_det_inv(gmms):
-    # /!\ iteration order is important, this gives us:
-    ret = []
-    for _, gm in gmms.items():
-        for gm_st in gm:
-            pi_k = []
-            mu_k = []
-            inv_sqrt_det_sigma = []
-            inv_sigma = []
-            for component in gm_st:
-                pi_k.append(component[0])
-                mu_k.append(component[1])
-                sigma2_k = component[2]
-                inv_sqrt_det_sigma.append(1.0 / np.sqrt(linalg.det(2 * np.pi * np.diag(sigma2_k))))
-                inv_sigma.append(1.0 / np.array(sigma2_k))
-                assert((inv_sigma[-1] == np.diag(linalg.inv(np.diag(sigma2_k)))).all())
-            ret.append((np.array(pi_k) * np.array(inv_sqrt_det_sigma), 
-                    np.array(mu_k).T, 
-                    np.array(inv_sigma).T))
-    return ret
-
-
-def compute_likelihoods(gmms_, mat):
-    """ compute the log-likelihoods of each states i according to the Gaussian 
-    mixture in gmms_[i], for each line of mat (input data) """
-    ret = np.ndarray((mat.shape[0], len(gmms_)), dtype="float32")
-    ret[:] = 0.0
-    for state_id, mixture in enumerate(gmms_):
-        pis, mus, inv_sigmas = mixture
-        # N_mixtures = len(pis) = mus.shape[1] = inv_sigmas.shape[1]
-        # N_features = mus.shape[0] = inv_sigmas.shape[0]
-        assert(pis.shape[0] == mus.shape[1])
-        assert(pis.shape[0] == inv_sigmas.shape[1])
-        x_minus_mus = np.ndarray((mat.shape[0], mus.shape[0], mus.shape[1]))
-        x_minus_mus.T[:,] = mat.T
-        x_minus_mus -= mus
-        x_minus_mus = x_minus_mus ** 2
-        x_minus_mus *= inv_sigmas
-        components = np.exp(-0.5 * x_minus_mus.sum(axis=1))
-        ret[:, state_id] = np.log(np.dot(components, pis))
-    return ret
-
-
-def padding(nframes, x):
-    """ padding with (nframes-1)/2 frames before & after for *.mfc mat x"""
-    ba = (nframes - 1) / 2
-    x_f = np.zeros((x.shape[0], nframes * x.shape[1]), dtype='float32')
-    for i in range(x.shape[0]):
-        x_f[i] = np.pad(x[max(0, i-ba):i+ba+1].flatten(),
-                (max(0, (ba-i) * x.shape[1]), max(0, 
-                    ((i+ba+1) - x.shape[0]) * x.shape[1])), 
-                'constant', constant_values=(0,0))
-    return x_f
-
-
-def compute_likelihoods_dbn(dbn, mat, depth=np.iinfo(int).max, normalize=True, unit=False):
-    """ compute the log-likelihoods of each states i according to the Deep 
-    Belief Network (stacked RBMs) in dbn, for each line of mat (input data) 
-    depth is the depth of the DBN at which the likelihoods will pop out,
-    if None, the full DBN is used"""
-    # first normalize or put in the unit ([0-1]) interval
-    # TODO do that only if we did not do that at the full scale of the corpus
-    if normalize:
-        # if the first layer of the DBN is a Gaussian RBM, we need to normalize mat
-        mat = (mat - np.mean(mat, 0)) / np.std(mat, 0)
-    elif unit:
-        # if the first layer of the DBN is a binary RBM, send mat in [0-1] range
-        mat = (mat - np.min(mat, 0)) / np.max(mat, 0)
-
-    import theano.tensor as T
-    ret = np.ndarray((mat.shape[0], dbn.logLayer.b.shape[0].eval()), dtype="float32")
-    from theano import shared#, scan
-    # propagating through the deep belief net
-    batch_size = mat.shape[0] / N_BATCHES_DATASET
-    max_layer = dbn.n_layers
-    out_ret = None
-    if depth < dbn.n_layers:
-        max_layer = min(dbn.n_layers, depth)
-        print(max_layer)
-        out_ret = np.ndarray((mat.shape[0], dbn.rbm_layers[max_layer].W.shape[1].eval()), dtype="float32")
-    else:
-        out_ret = np.ndarray((mat.shape[0], dbn.logLayer.b.shape[0].eval()), dtype="float32")
-
-    for ind in range(0, mat.shape[0]+1, batch_size):
-        output = shared(mat[ind:ind+batch_size])
-        print("evaluating the DBN on all the test input")
-        for layer_ind in range(max_layer):
-            [pre, output] = dbn.rbm_layers[layer_ind].propup(output)
-        if depth >= dbn.n_layers:
-            print("dbn output shape", output.shape.eval())
-            ret = T.nnet.softmax(T.dot(output, dbn.logLayer.W) + dbn.logLayer.b)
-            out_ret[ind:ind+batch_size] = T.log(ret).eval()
-        else:
-            out_ret[ind:ind+batch_size] = T.log(output).eval()
-    return out_ret
-
-
 def phones_mapping(gmms):
     map_states_to_phones = {}
     i = 0
@@ -174,46 +203,52 @@ def phones_mapping(gmms):
     return map_states_to_phones
 
 
-def string_mlf(map_states_to_phones, states, phones_only=False):
+def string_mlf(map_states_to_phones, states, phones_only=False,
+        phones_matrix=None):
+    """ MLF body of the [(state, posterior)] path, run-length encoded:
+    "start end phone score" lines if phones_only, else one line per state
+    "start end state score" with " phone phone_score" appended on the first
+    state of each phone (as HVite -f). Times are in HTK's 100ns units, the
+    scores are the differences of the (cumulated) posteriors. phones_matrix
+    is states_to_phones_matrix(map_states_to_phones), built once by the
+    callers that write many utterances (built here if None) """
+    if not len(states):
+        return ''
+    path = np.fromiter((state for state, _ in states), dtype='int64',
+            count=len(states))
+    scores = np.fromiter((score for _, score in states), dtype='float64',
+            count=len(states))
+    if phones_matrix == None:
+        phones_matrix = states_to_phones_matrix(map_states_to_phones)
+    phones, states_to_phones = phones_matrix
+    phone_ids = states_to_phones.argmax(axis=1)[path]
+
+    def runs(ids): # (first frame, last frame + 1, score) of each run
+        starts = np.concatenate([[0], np.flatnonzero(np.diff(ids)) + 1])
+        ends = np.append(starts[1:], ids.shape[0])
+        before = np.concatenate([[0.0], scores[starts[1:] - 1]])
+        return starts, ends, scores[ends - 1] - before
+
+    p_starts, p_ends, p_scores = runs(phone_ids)
+    if phones_only:
+        return ''.join('%d %d %s %.6f\n' % (start * HTK_FRAME, end * HTK_FRAME,
+            phones[phone_ids[start]], score)
+            for start, end, score in zip(p_starts, p_ends, p_scores))
+    s_starts, s_ends, s_scores = runs(path)
+    first = np.searchsorted(p_starts, s_starts) # phone of each state run
     s = []
-    previous_phone = ''
-    previous_state = '' 
-    total_prob = 0.0
-    n_timesteps_collapsed = 0
-    tmp_s = ''
-    for state, prob in states: 
-        state_s = map_states_to_phones[state]
-        phone = state_s.split('[')[0]
-        # TODO correct timings with forced alignment
-        if phone != previous_phone:
-            tmp_s += phone + ' '
-            previous_phone = phone
-            total_prob = prob # useless as we do not output probs
-            n_timesteps_collapsed = 1 # same as above comment
-        if not phones_only and state_s != previous_state:
-            tmp_s += state_s + ' '
-            if len(s):
-                s[-1] = s[-1] + str(total_prob) + ' ' + str(
-                        total_prob/n_timesteps_collapsed) # divide to correct
-            previous_state = state_s
-            total_prob = prob
-            n_timesteps_collapsed = 1
-        else:
-            total_prob += prob
-            n_timesteps_collapsed += 1
-        if len(tmp_s):
-            s.append(tmp_s)
-            tmp_s = ''
-    if not phones_only:
-        s[-1] = s[-1] + str(total_prob) + ' ' + str(
-                total_prob/n_timesteps_collapsed) # divide to correct
-    s.append('')
-    return '\n'.join(s)
+    for i, (start, end, score) in enumerate(zip(s_starts, s_ends, s_scores)):
+        line = '%d %d %s %.6f' % (start * HTK_FRAME, end * HTK_FRAME,
+                map_states_to_phones[path[start]], score)
+        if first[i] < p_starts.shape[0] and p_starts[first[i]] == start:
+            line += ' %s %.6f' % (phones[phone_ids[start]], p_scores[first[i]])
+        s.append(line + '\n')
+    return ''.join(s)
 
 
-def viterbi(likelihoods, transitions, map_states_to_phones, 
-        using_bigram=False):
-    """ This function applies Viterbi on the likelihoods already computed """
+def initial_scores(n_states, map_states_to_phones, using_bigram=False):
+    """ returns the initial log scores of the states and the ending state
+    (both sentence start/end states when using_bigram, no constraint else) """
     starting_state = None
     ending_state = None
     for state, phone in map_states_to_phones.items():
@@ -222,67 +257,90 @@ def viterbi(likelihoods, transitions, map_states_to_phones,
                 starting_state = state
             if phone == '!EXIT[4]' or phone == 'h#[4]': # hardcoded TODO remove
                 ending_state = state
-    posteriors = np.ndarray((likelihoods.shape[0], likelihoods.shape[1]))
-    posteriors[:] = -1000000.0 # log
-    posteriors[0] = likelihoods[0] # log
-    backpointers = np.ndarray((likelihoods.shape[0]-1, likelihoods.shape[1]), 
-            dtype=int)
-    backpointers[:] = -1
+    init = np.zeros(n_states) # log
     if using_bigram:
-        nonnulls = [starting_state]
+        init[:] = LOG_ZERO
+        init[starting_state] = 0.0
+    return init, ending_state
+
+
+def viterbi_forward(likelihoods, transitions, init, topology=None,
+        beam=None, max_active=None, stats=None):
+    """ Viterbi recursion (sparse if a Topology is given, VITERBI_BACKEND
+    otherwise), returns the posteriors and the backpointers """
+    if topology is not None:
+        return viterbi_sparse(likelihoods, topology, init,
+                beam=beam, max_active=max_active, stats=stats)
+    return viterbi_dense(likelihoods, transitions[1], init,
+            backend=VITERBI_BACKEND, beam=beam, max_active=max_active,
+            stats=stats)
+
+
+def viterbi_lean(likelihoods, transitions, init, last_state=None,
+        topology=None, beam=None, max_active=None, stats=None):
+    """ memory-lean Viterbi (see run_viterbi_lean() in viterbi_kernels.py),
+    returns the best path as [(state, posterior)] """
+    if topology is not None:
+        step = functools.partial(sparse_step, topology)
     else:
-        nonnulls = [jj for jj, val in enumerate(posteriors[0]) if val > -1000000.0] 
-    log_transitions = transitions[1] # log,
-
-    # Main viterbi loop, try with native code if possible
-    try:
-        from scipy import weave
-        from scipy.weave import converters
-        px = likelihoods.shape[0]
-        py = likelihoods.shape[1]
-        code_c = """
-                #line 180 "viterbi.py" (FOR DEBUG)
-                for (int i=1; i < px; ++i) { 
-                    for (int j=0; j < py; ++j) {
-                        float max_ = -100000000000.0;
-                        int max_ind = -2;
-                        for (int k=0; k < py; ++k) {
-                            if (likelihoods(i-1,k) < max_ || log_transitions(k,j) < max_)
-                                continue;
-                            float tmp_prob = posteriors(i-1,k) + log_transitions(k,j);
-                            if (tmp_prob > max_) {
-                                max_ = tmp_prob;
-                                max_ind = k;
-                            }
-                        }
-                        posteriors(i,j) = max_ + likelihoods(i,j);
-                        backpointers(i-1,j) = max_ind;
-                    }
-                }
-                """
-        err = weave.inline(code_c,
-                ['px', 'py', 'log_transitions', 
-                    'likelihoods', 'posteriors', 'backpointers'],
-                type_converters=converters.blitz,
-                compiler = 'gcc')
-    except:
-        for i in range(1, likelihoods.shape[0]):
-            for j in range(likelihoods.shape[1]):
-                max_ = -1000000000000.0 # log
-                max_ind = -2
-                for k in nonnulls:
-                    #if transitions[1][k][j] == 0.0:
-                    if log_transitions[k][j] < max_:
-                        continue
-                    tmp_prob = posteriors[i-1][k] + log_transitions[k][j] # log
-                    if tmp_prob > max_:
-                        max_ = tmp_prob
-                        max_ind = k
-                posteriors[i][j] = max_ + likelihoods[i][j] # log
-                backpointers[i-1][j] = max_ind
-            nonnulls = [jj for jj, val in enumerate(likelihoods[i]) if val > -1000000.0] # log
-            if len(nonnulls) == 0:
-                print(">>>>>>>>> NONNULLS IS EMPTY", i, likelihoods.shape[0], file=sys.stderr)
+        step = functools.partial(dense_step, transitions[1])
+    checkpoint = None
+    spill = None
+    if likelihoods.shape[0] > LEAN_MAX_FRAMES:
+        if SPILL_DIR != None:
+            fd, spill = tempfile.mkstemp(suffix='.bp', dir=SPILL_DIR)
+            os.close(fd)
+        else:
+            checkpoint = 0 # sqrt(T)
+    states, scores = run_viterbi_lean(likelihoods, step, init,
+            last_state=last_state, beam=beam, max_active=max_active,
+            stats=stats, checkpoint=checkpoint, spill=spill)
+    if spill != None:
+        os.remove(spill)
+    return deque(zip(states, scores))
+
+
+def viterbi_scan(likelihoods, transitions, map_states_to_phones, pool,
+        n_blocks, using_bigram=False, topology=None, beam=None,
+        max_active=None, stats=None):
+    """ Viterbi as viterbi() on n_blocks blocks of frames scanned by the
+    workers of pool (see parallel_viterbi.py), returns the best path as
+    [(state, posterior)] """
+    init, ending_state = initial_scores(likelihoods.shape[1],
+            map_states_to_phones, using_bigram)
+    if topology is not None:
+        step = functools.partial(sparse_step, topology)
+    else:
+        step = functools.partial(dense_step, transitions[1])
+    states, scores = parallel_viterbi(likelihoods, step, init, pool,
+            n_blocks, last_state=ending_state, beam=beam,
+            max_active=max_active, stats=stats, directory=SHARED_DIR)
+    if using_bigram and states[-1] != ending_state:
+        print("WARNING: the ending state was pruned, tracing back from the best state", file=sys.stderr)
+    return deque(zip(states, scores))
+
+
+def viterbi(likelihoods, transitions, map_states_to_phones, 
+        using_bigram=False, topology=None, beam=None, max_active=None,
+        stats=None):
+    """ This function applies Viterbi on the likelihoods already computed,
+    on the compact Topology (see viterbi_kernels.py) if one is given, with
+    beam and histogram (max_active) pruning, stats (dict) gets the number
+    of 'frames' and of 'active' states """
+    init, ending_state = initial_scores(likelihoods.shape[1],
+            map_states_to_phones, using_bigram)
+    if LEAN_VITERBI:
+        states = viterbi_lean(likelihoods, transitions, init,
+                last_state=ending_state, topology=topology, beam=beam,
+                max_active=max_active, stats=stats)
+        if using_bigram and states[-1][0] != ending_state:
+            print("WARNING: the ending state was pruned, tracing back from the best state", file=sys.stderr)
+        return states, None
+    posteriors, backpointers = viterbi_forward(likelihoods, transitions, init,
+            topology=topology, beam=beam, max_active=max_active, stats=stats)
+    if using_bigram and posteriors[-1][ending_state] == LOG_ZERO:
+        print("WARNING: the ending state was pruned, tracing back from the best state", file=sys.stderr)
+        using_bigram = False
 
     if using_bigram:
         states = deque([(ending_state, posteriors[likelihoods.shape[0]-1][ending_state])])
@@ -315,6 +373,154 @@ def viterbi(likelihoods, transitions, map_states_to_phones,
     return states, posteriors
 
 
+def viterbi_lattice(likelihoods, transitions, map_states_to_phones,
+        using_bigram=False, topology=None, beam=None, max_active=None,
+        stats=None, name=''):
+    """ Viterbi as viterbi(), but returns the phone Lattice (see lattice.py)
+    of the paths that survived instead of the best one """
+    init, ending_state = initial_scores(likelihoods.shape[1],
+            map_states_to_phones, using_bigram)
+    posteriors, backpointers = viterbi_forward(likelihoods, transitions, init,
+            topology=topology, beam=beam, max_active=max_active, stats=stats)
+    return build_lattice(posteriors, backpointers, transitions, init,
+            ending_state=ending_state, scale_factor=SCALE_FACTOR,
+            insertion_penalty=INSERTION_PENALTY, name=name)
+
+
+def online_viterbi(of, features, comp_likelihoods, transitions,
+        map_states_to_phones, using_bigram=False, topology=None,
+        beam=None, max_active=None, max_delay=None, stats=None):
+    """ frame-synchronous Viterbi (OnlineViterbi in viterbi_kernels.py) on
+    the features, for which likelihoods are computed LIKELIHOODS_CHUNK frames
+    at a time, writing (phones only, as string_mlf()) MLF lines to of as
+    soon as they are decided (a phone once the next one is), keeping at
+    most max_delay undecided frames in memory """
+    init, ending_state = initial_scores(len(map_states_to_phones),
+            map_states_to_phones, using_bigram)
+    if topology is not None:
+        step = functools.partial(sparse_step, topology)
+    else:
+        step = functools.partial(dense_step, transitions[1])
+    decoder = OnlineViterbi(step, init, beam=beam, max_active=max_active,
+            max_delay=max_delay)
+    phone = None # (phone, first frame, posterior before it) being decided
+    n_decided = 0
+    previous_score = 0.0
+    def write_phone(end):
+        of.write('%d %d %s %.6f\n' % (phone[1] * HTK_FRAME, end * HTK_FRAME,
+            phone[0], previous_score - phone[2]))
+    for start in range(0, features.shape[0], LIKELIHOODS_CHUNK):
+        likelihoods = comp_likelihoods(
+                features[start:start + LIKELIHOODS_CHUNK])
+        decided = []
+        for likelihoods_t in likelihoods:
+            decided += decoder.push(likelihoods_t)
+        if start + LIKELIHOODS_CHUNK >= features.shape[0]:
+            decided += decoder.finish(ending_state)
+        for state, score in decided:
+            phn = map_states_to_phones[state].split('[')[0]
+            if phone != None and phn != phone[0]:
+                write_phone(n_decided)
+                phone = None
+            if phone == None:
+                phone = (phn, n_decided, previous_score)
+            previous_score = score
+            n_decided += 1
+        if start + LIKELIHOODS_CHUNK >= features.shape[0] and phone != None:
+            write_phone(n_decided)
+        of.flush()
+    if stats is not None:
+        stats['frames'] = decoder.n_frames
+        stats['active'] = decoder.n_active
+
+
+def viterbi_batch(list_of_likelihoods, transitions, map_states_to_phones,
+        using_bigram=False, topology=None, beam=None, max_active=None,
+        stats=None):
+    """ applies Viterbi on N utterances at once (their likelihoods padded in
+    a (N, T_max, S) tensor), see viterbi(). Returns the list of the best
+    [(state, posterior)] paths, one per utterance """
+    likelihoods, lengths = pad_likelihoods(list_of_likelihoods)
+    init, ending_state = initial_scores(likelihoods.shape[2],
+            map_states_to_phones, using_bigram)
+    if topology is not None:
+        step = functools.partial(sparse_step, topology)
+    else:
+        step = functools.partial(dense_step, transitions[1])
+    posteriors, backpointers = run_viterbi_batch(likelihoods, lengths, step,
+            init, beam=beam, max_active=max_active, stats=stats)
+    paths = []
+    for n, length in enumerate(lengths):
+        last_state = posteriors[n, -1].argmax()
+        if using_bigram:
+            if posteriors[n, -1, ending_state] == LOG_ZERO:
+                print("WARNING: the ending state was pruned, tracing back from the best state", file=sys.stderr)
+            else:
+                last_state = ending_state
+        states = traceback(backpointers[n], last_state)[:length]
+        paths.append(deque(zip(states, posteriors[n, np.arange(length), states])))
+    return paths
+
+
+def states_to_phones_matrix(map_states_to_phones):
+    """ returns (phones names, (S, P) 0/1 matrix of the phone of each state),
+    phones in the order of their states """
+    phones = []
+    for state in range(len(map_states_to_phones)):
+        phn = map_states_to_phones[state].split('[')[0]
+        if phn not in phones:
+            phones.append(phn)
+    states_to_phones = np.zeros((len(map_states_to_phones), len(phones)))
+    for state in range(len(map_states_to_phones)):
+        states_to_phones[state,
+                phones.index(map_states_to_phones[state].split('[')[0])] = 1.0
+    return phones, states_to_phones
+
+
+def forward_backward_batch(list_of_likelihoods, transitions,
+        map_states_to_phones, using_bigram=False, topology=None):
+    """ log-domain forward-backward (run_forward_backward() of
+    viterbi_kernels.py) on N utterances at once, on the compact Topology if
+    one is given. Returns the lists of the (T, S) states posteriors, of the
+    (T, P) phones posteriors and of the log likelihoods of the utterances,
+    and the phones names (columns of the phones posteriors) """
+    likelihoods, lengths = pad_likelihoods(list_of_likelihoods)
+    init, ending_state = initial_scores(likelihoods.shape[2],
+            map_states_to_phones, using_bigram)
+    final = None
+    if using_bigram:
+        final = np.ndarray(likelihoods.shape[2])
+        final[:] = LOG_ZERO
+        final[ending_state] = 0.0
+    if topology is not None:
+        step = functools.partial(sparse_sum_step, topology)
+        back_step = functools.partial(sparse_sum_step,
+                transpose_topology(topology))
+    else:
+        step = functools.partial(dense_sum_step, transitions[1])
+        back_step = functools.partial(dense_sum_step, transitions[1].T)
+    posteriors, log_likelihoods = run_forward_backward(likelihoods, lengths,
+            step, back_step, init, final)
+    phones, states_to_phones = states_to_phones_matrix(map_states_to_phones)
+    states_posteriors = [posteriors[n, :length]
+            for n, length in enumerate(lengths)]
+    return (states_posteriors,
+            [np.dot(p, states_to_phones) for p in states_posteriors],
+            list(log_likelihoods), phones)
+
+
+def forward_backward(likelihoods, transitions, map_states_to_phones,
+        using_bigram=False, topology=None):
+    """ forward-backward on one utterance, see forward_backward_batch().
+    Returns (states posteriors, phones posteriors, log likelihood, phones) """
+    states_posteriors, phones_posteriors, log_likelihoods, phones = \
+            forward_backward_batch([likelihoods], transitions,
+                    map_states_to_phones, using_bigram=using_bigram,
+                    topology=topology)
+    return states_posteriors[0], phones_posteriors[0], log_likelihoods[0], \
+            phones
+
+
 def parse_wdnet(trans, iwdnf):
     """ puts transition probabilities with bigram LM generated wdnet:
         HBuild -m bigramLM dict wdnetbigram
@@ -509,19 +715,159 @@ def parse_lm(trans, f):
     return trans
 
 
+HMM_TOKENS = re.compile(r'<[^>]*>|~[a-z]|"[^"]*"|[^\s<>"]+') # HMMdefs tokens
+UNSUPPORTED_HMM_KEYWORDS = ('<INVCOVAR>', '<LLTCOVAR>', '<FULLC>', '<XFORM>',
+        '<TMIX>') # full covariances, tied mixtures: no GMMs as parse_hmm()'s
+
+
+class HmmTokens(object):
+    """ tokens of HTK HMMdefs text: keywords (upper cased), macro types (~s),
+    macro names (unquoted) and numbers """
+    def __init__(self, text):
+        self.tokens = [t.upper() if t[0] == '<' else t.strip('"')
+                for t in HMM_TOKENS.findall(text)]
+        self.i = 0
+
+    def peek(self):
+        if self.i < len(self.tokens):
+            return self.tokens[self.i]
+        return None
+
+    def next(self):
+        token = self.peek()
+        if token == None:
+            raise ValueError("unexpected end of the HMMdefs")
+        self.i += 1
+        return token
+
+    def floats(self, n):
+        values = self.tokens[self.i:self.i + n]
+        if len(values) < n:
+            raise ValueError("unexpected end of the HMMdefs")
+        self.i += n
+        return np.array(list(map(float, values)), dtype='float32')
+
+    def skip(self):
+        """ skips the current keyword (or ~o) and its numeric arguments """
+        if self.next() in UNSUPPORTED_HMM_KEYWORDS:
+            raise ValueError("unsupported HMMdefs keyword " +
+                    self.tokens[self.i - 1])
+        while self.peek() != None and self.peek()[0] in '-+.0123456789':
+            self.i += 1
+
+
+def hmm_macro(macros, kind, name):
+    """ the (previously defined) macro ~kind "name" """
+    if (kind, name) not in macros:
+        raise ValueError("undefined macro " + kind + ' "' + name + '"')
+    return macros[kind, name]
+
+
+def parse_component(tokens, macros, weight):
+    """ [weight, mean, variance] of a Gaussian (<MEAN> / ~u, <VARIANCE> /
+    ~v, or a ~m macro) """
+    if tokens.peek() == '~m':
+        tokens.next()
+        return [weight] + hmm_macro(macros, '~m', tokens.next())
+    component = [weight]
+    while tokens.peek() in ('<MEAN>', '<VARIANCE>', '~u', '~v', '<GCONST>'):
+        token = tokens.next()
+        if token == '<GCONST>': # recomputed from the variances
+            tokens.next()
+        elif token in ('~u', '~v'):
+            component.append(hmm_macro(macros, token, tokens.next()))
+        else:
+            component.append(tokens.floats(int(tokens.next())))
+    if len(component) != 3:
+        raise ValueError("no mean or variance for a Gaussian")
+    return component
+
+
+def parse_state(tokens, macros):
+    """ the Gaussian mixture components [weight, mean, variance] of a state
+    (<MIXTURE>s, or a single Gaussian of weight 1.0) """
+    state = []
+    while True:
+        token = tokens.peek()
+        if token == '<MIXTURE>':
+            tokens.next()
+            tokens.next() # component index
+            state.append(parse_component(tokens, macros,
+                float(tokens.next())))
+        elif token in ('<MEAN>', '~u', '~m') and not len(state):
+            state.append(parse_component(tokens, macros, 1.0))
+        elif token in ('<NUMMIXES>', '<SWEIGHTS>', '<STREAM>', '<GCONST>'):
+            tokens.skip()
+        else:
+            return state
+
+
+def parse_transp(tokens, macros):
+    """ the (N, N) transitions matrix of <TRANSP> N or a ~t macro """
+    if tokens.next() == '~t':
+        return hmm_macro(macros, '~t', tokens.next())
+    n = int(tokens.next())
+    return tokens.floats(n * n).reshape((n, n))
+
+
+def parse_model(tokens, macros):
+    """ (states, transitions matrix) of a ~h model, from <BEGINHMM> to
+    <ENDHMM>, states being shared with the ~s macros they use """
+    states = []
+    transp = None
+    while True:
+        token = tokens.peek()
+        if token == '<STATE>':
+            tokens.next()
+            tokens.next() # state number
+            if tokens.peek() == '~s':
+                tokens.next()
+                states.append(hmm_macro(macros, '~s', tokens.next()))
+            else:
+                states.append(parse_state(tokens, macros))
+        elif token in ('<TRANSP>', '~t'):
+            transp = parse_transp(tokens, macros)
+        elif token == '<ENDHMM>':
+            tokens.next()
+            if transp is None or transp.shape[0] != len(states) + 2:
+                raise ValueError("states and transitions do not match")
+            return states, transp
+        else: # <BEGINHMM>, <NUMSTATES>, options
+            tokens.skip()
+
+
 def parse_hmm(f):
-    """ parse HTK HMMdefs (chapter 7 of the HTK book) in f """
-    l = f.readlines()
-    n_phones = 0
-    n_states_tot = 0
-    for line in l:
-        # GCONST = ln((2*pi)^n det(sigma)) == ln(det(2*pi*sigma))
-        if '~h' in line:
-            n_phones += 1
-        elif '<NUMSTATES>' in line:
-            n_states_tot += int(line.strip().split()[1]) - 2 
-            # we remove init/end states: eg. 5 means 3 states once connected
-    transitions = ({}, np.ndarray((n_states_tot, n_states_tot), 
+    """ parse HTK HMMdefs (chapter 7 of the HTK book) in f: the models (~h)
+    and the macros they use (~s states, ~m Gaussians, ~u means, ~v
+    variances, ~t transitions), defined before their first use. The models
+    whose states are tied (HHEd TI / TB) share the same state (list of
+    components) object in gmms, see tie_states() in scorers.py """
+    tokens = HmmTokens(f.read())
+    macros = {}
+    models = [] # (phn, states, transp)
+    while tokens.peek() != None:
+        kind = tokens.peek()
+        if kind == '~o' or kind[0] != '~':
+            tokens.skip()
+            continue
+        tokens.next()
+        name = tokens.next()
+        if kind == '~h':
+            models.append((name,) + parse_model(tokens, macros))
+        elif kind == '~s':
+            macros[kind, name] = parse_state(tokens, macros)
+        elif kind == '~m':
+            macros[kind, name] = parse_component(tokens, macros, 1.0)[1:]
+        elif kind in ('~u', '~v'):
+            tokens.next() # <MEAN> / <VARIANCE>
+            macros[kind, name] = tokens.floats(int(tokens.next()))
+        elif kind == '~t':
+            macros[kind, name] = parse_transp(tokens, macros)
+        else: # ~w, ~r, ~d...: not used by the decoder
+            while tokens.peek() != None and tokens.peek()[0] != '~':
+                tokens.skip()
+    n_states_tot = sum(len(states) for _, states, _ in models)
+    transitions = ({}, np.zeros((n_states_tot, n_states_tot),
         dtype='float32'))
     # transitions = ( t[phn] = Phone,
     #                               | phn1_s1, phn1_s2, phn1_s3, phn2_s1|
@@ -539,35 +885,17 @@ def parse_hmm(f):
     # gmms[phn] is a list of states, which are a list of Gaussian mixtures 
     # components, which are a list of weight (float) followed by means (vec) 
     # and covar (vec, circular (i.e. diagonal covar matrix) covar)
-    phn = ""
-    phn_id = -1
     current_states_numbers = 0
-    for i, line in enumerate(l):
-        if '~h' in line:
-            phn = clean(line).split()[1].strip('"')
-            phn_id += 1
-            gmms[phn] = []
-        elif '<STATE>' in line:
-            gmms[phn].append([])
-        elif '<MIXTURE>' in line:
-            gmms[phn][-1].append([float(clean(line).split()[2])])
-        elif '<MEAN>' in line or '<VARIANCE>' in line:
-            if not len(gmms[phn][-1]):
-                gmms[phn][-1].append([1.0])
-            gmms[phn][-1][-1].append(np.array(list(map(float, 
-                clean(l[i+1]).split())), dtype='float32'))
-        elif '<TRANSP>' in line:
-            n_st = int(clean(line).split()[1]) - 2  # we also remove init/end
-            transitions[0][phn] = Phone(phn_id, phn)
-            for j in range(n_st):
-                transitions[0][phn].update(current_states_numbers + j)
-                transitions[1][current_states_numbers + j] = \
-                    [0.0 for tmp_k in range(current_states_numbers)] + \
-                    list(map(float, clean(l[i + j + 2]).split()[1:-1])) + \
-                    [0.0 for tmp_k in range(n_states_tot
-                        - current_states_numbers - n_st)]
-            current_states_numbers += n_st
-    assert(n_states_tot == current_states_numbers)
+    for phn_id, (phn, states, transp) in enumerate(models):
+        gmms[phn] = states
+        n_st = len(states) # we remove init/end states
+        transitions[0][phn] = Phone(phn_id, phn)
+        for j in range(n_st):
+            transitions[0][phn].update(current_states_numbers + j)
+            transitions[1][current_states_numbers + j,
+                    current_states_numbers:current_states_numbers + n_st] = \
+                            transp[j + 1, 1:-1]
+        current_states_numbers += n_st
     #print gmms["!EXIT"][0][0][0] # pi_k of state 0 and mixture comp. 0
     #print gmms["!EXIT"][0][0][1] # mu_k
     #print gmms["!EXIT"][0][0][2] # sigma2_k
@@ -581,52 +909,305 @@ def parse_hmm(f):
     return n_states_tot, transitions, gmms
 
 
+class LikelihoodsLoop(object): # to circumvent pickling pbms w/ multiprocessing.map
+    """ likelihoods of one scp line by the (per file) Scorer scorer, from the
+    cache (a DecodeCache) if they were computed with the same scorer_key
+    before. Returns (likelihoods key or None, likelihoods), with out (the
+    .npy of allocate_scores(), map_file_to_start_end) the likelihoods are
+    written at their rows of the memory mapped .npy and None is returned """
+    def __init__(self, scorer, cache=None, scorer_key=None, out=None):
+        self.scorer = scorer
+        self.cache = cache
+        self.scorer_key = scorer_key
+        self.out = out
+    def __call__(self, line):
+        key, likelihoods = self.likelihoods(clean(line))
+        if self.out == None:
+            return key, likelihoods
+        fname, map_file_to_start_end = self.out
+        start, end = map_file_to_start_end[line]
+        if likelihoods.shape[0] != end - start:
+            raise ValueError(line + ": " + str(likelihoods.shape[0]) +
+                    " likelihoods for " + str(end - start) + " frames")
+        matrix = np.load(fname, mmap_mode='r+')
+        matrix[start:end] = likelihoods
+        matrix.flush()
+        return key, None
+    def likelihoods(self, cline):
+        if self.cache == None:
+            return None, self.scorer(cline)
+        key = self.cache.key(self.scorer_key, self.cache.file_key(cline))
+        cached = self.cache.load_likelihoods(key)
+        if cached != None:
+            return key, np.asarray(cached[0])
+        likelihoods = self.scorer(cline)
+        self.cache.save_likelihoods(key, (likelihoods, None))
+        return key, likelihoods
+
+
+class FramesLoop(object): # to circumvent pickling pbms w/ multiprocessing.map
+    """ likelihoods of a chunk of frames by the (per_frame) Scorer scorer """
+    def __init__(self, scorer):
+        self.scorer = scorer
+    def __call__(self, features):
+        return self.scorer.likelihoods(features)
+
+
 class InnerLoop(object): # to circumvent pickling pbms w/ multiprocessing.map
+    """ decodes one scp line, returns the (MLF string, stats). With a
+    cache (DecodeCache), keys maps the scp lines to their decoding keys and
+    the decodings already done with the same key are not redone """
     def __init__(self, likelihoods, map_states_to_phones, transitions,
-            using_bigram=False):
+            using_bigram=False, topology=None, beam=None, max_active=None,
+            cache=None, keys=None, graph=None, lexicon=None):
         self.likelihoods = likelihoods
         self.map_states_to_phones = map_states_to_phones
+        self.phones_matrix = states_to_phones_matrix(map_states_to_phones)
         self.transitions = transitions
         self.using_bigram = using_bigram
+        self.topology = topology
+        self.beam = beam
+        self.max_active = max_active
+        self.cache = cache
+        self.keys = keys
+        self.graph = graph
+        self.lexicon = lexicon
+        self.shared = None
+    def share(self, directory=None, likelihoods=None):
+        """ moves the likelihoods and the log transitions to shared memory
+        (memmap files in directory if given): the Pool tasks then only pickle
+        their names and the workers attach to them without copies, the
+        likelihoods are not copied if they already are the SharedArray
+        likelihoods. Returns the SharedArray tuple, to close() once the Pool
+        is done """
+        if likelihoods is None:
+            likelihoods = SharedArray(self.likelihoods[0], directory)
+        self.shared = (likelihoods,
+                SharedArray(self.transitions[1], directory))
+        self.likelihoods = (self.shared[0].array, self.likelihoods[1])
+        self.transitions = (self.transitions[0], self.shared[1].array)
+        return self.shared
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        if self.shared != None: # the arrays travel by reference
+            state['likelihoods'] = (None, self.likelihoods[1])
+            state['transitions'] = (self.transitions[0], None)
+        return state
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if self.shared != None:
+            self.likelihoods = (self.shared[0].array, self.likelihoods[1])
+            self.transitions = (self.transitions[0], self.shared[1].array)
     def __call__(self, line):
         cline = clean(line)
         start, end = self.likelihoods[1][cline]
         if VERBOSE:
             print(cline)
             print(start, end)
-        s = '"' + cline[:-3] + 'rec"\n' + \
-                string_mlf(self.map_states_to_phones,
-                        viterbi(self.likelihoods[0][start:end],
-                            self.transitions, 
-                            self.map_states_to_phones,
-                            using_bigram=True)[0],#self.using_bigram), # TODO CHANGE
-                        phones_only=True) + '.\n'
-        return s
+        stats = {}
+        if self.graph == None and self.lexicon == None and (
+                LATTICES_DIR != None or N_BEST > 1):
+            lattice = viterbi_lattice(self.likelihoods[0][start:end],
+                    self.transitions, self.map_states_to_phones,
+                    using_bigram=self.using_bigram or FORCE_ENTER_EXIT,
+                    topology=self.topology,
+                    beam=self.beam, max_active=self.max_active, stats=stats,
+                    name=cline)
+            if LATTICES_DIR != None:
+                with open(lattice_fname(LATTICES_DIR, cline), 'w') as latf:
+                    lattice.write_slf(latf)
+            s = '"' + cline[:-3] + 'rec"\n' + \
+                    string_nbest(lattice.nbest(N_BEST)) + '.\n'
+            return s, stats
+        cached = None
+        if self.cache != None:
+            cached = self.cache.load_decode(self.keys[cline])
+        body = cached
+        if body == None and self.lexicon != None: # words
+            body = string_words(self.lexicon,
+                    viterbi_words(self.likelihoods[0][start:end], self.lexicon,
+                        beam=self.beam, max_active=self.max_active,
+                        stats=stats))
+        elif body == None and self.graph != None: # n-gram LM
+            body = string_mlf(self.map_states_to_phones,
+                    viterbi_ngram(self.likelihoods[0][start:end], self.graph,
+                        beam=self.beam, max_active=self.max_active,
+                        stats=stats),
+                    phones_only=not MLF_STATES,
+                    phones_matrix=self.phones_matrix)
+        elif body == None:
+            body = string_mlf(self.map_states_to_phones,
+                    viterbi(self.likelihoods[0][start:end],
+                        self.transitions, 
+                        self.map_states_to_phones,
+                        using_bigram=self.using_bigram or FORCE_ENTER_EXIT,
+                        topology=self.topology,
+                        beam=self.beam, max_active=self.max_active,
+                        stats=stats)[0],
+                    phones_only=not MLF_STATES,
+                    phones_matrix=self.phones_matrix)
+        if self.cache != None and cached == None:
+            self.cache.save_decode(self.keys[cline], body)
+        return '"' + cline[:-3] + 'rec"\n' + body + '.\n', stats
+
+
+class BatchInnerLoop(InnerLoop):
+    """ decodes a list of scp lines at once with viterbi_batch(), returns
+    the (list of MLF strings, stats) """
+    def __call__(self, lines):
+        clines = [clean(line) for line in lines]
+        bodies = {}
+        if self.cache != None:
+            for cline in clines:
+                body = self.cache.load_decode(self.keys[cline])
+                if body != None:
+                    bodies[cline] = body
+        to_decode = [cline for cline in clines if cline not in bodies]
+        list_of_likelihoods = []
+        for cline in to_decode:
+            start, end = self.likelihoods[1][cline]
+            list_of_likelihoods.append(self.likelihoods[0][start:end])
+        if VERBOSE:
+            print(to_decode)
+        stats = {}
+        if len(to_decode):
+            paths = viterbi_batch(list_of_likelihoods,
+                    self.transitions,
+                    self.map_states_to_phones,
+                    using_bigram=self.using_bigram or FORCE_ENTER_EXIT,
+                    topology=self.topology,
+                    beam=self.beam, max_active=self.max_active,
+                    stats=stats)
+            for cline, states in zip(to_decode, paths):
+                bodies[cline] = string_mlf(self.map_states_to_phones, states,
+                        phones_only=not MLF_STATES,
+                        phones_matrix=self.phones_matrix)
+                if self.cache != None:
+                    self.cache.save_decode(self.keys[cline], bodies[cline])
+        return ['"' + cline[:-3] + 'rec"\n' + bodies[cline] + '.\n'
+                for cline in clines], stats
+
+
+_pipeline_loop = None # (InnerLoop, per file Scorer) of a pipeline worker
+
+
+def init_pipeline(inner_loop, scorer):
+    global _pipeline_loop
+    _pipeline_loop = (inner_loop, scorer)
+
+
+def pipeline_task(args):
+    """ decodes (scp line, likelihoods or None: computed here), returns the
+    (MLF string, stats) """
+    cline, likelihoods = args
+    inner_loop, scorer = _pipeline_loop
+    if likelihoods is None:
+        likelihoods = scorer(cline)
+    inner_loop.likelihoods = (likelihoods, {cline: (0, likelihoods.shape[0])})
+    return inner_loop(cline)
+
+
+def pipeline(clines, inner_loop, in_flight, writer, scorer,
+        chunk=PIPELINE_CHUNK):
+    """ producer / consumer decoding of the files clines: a per file Scorer
+    scores them in the workers (GMMs), the others score chunks of chunk
+    files in this process (e.g. the DBN, after scorer.prepare()), and
+    inner_loop decodes them in the Pool as soon as they are scored. At most
+    in_flight utterances (plus the chunk being scored) are scored and not
+    yet decoded: the memory does not grow with the corpus. The MLF strings
+    go to the OrderedWriter writer as they come, returns the stats """
+    list_stats = []
+    failures = []
+    slots = threading.BoundedSemaphore(in_flight)
+    def done(i):
+        def callback(result):
+            writer.write(i, result[0])
+            list_stats.append(result[1])
+            slots.release()
+        return callback
+    def failed(exception):
+        failures.append(exception)
+        slots.release()
+    p = Pool(cpu_count(), initializer=init_pipeline,
+            initargs=(inner_loop, scorer if scorer.per_file else None))
+    for start in range(0, len(clines), chunk):
+        chunk_clines = clines[start:start+chunk]
+        list_of_likelihoods = [None for _ in chunk_clines]
+        if not scorer.per_file:
+            list_of_likelihoods = scorer.chunk(chunk_clines)
+        for i, (cline, likelihoods) in enumerate(zip(chunk_clines,
+                list_of_likelihoods)):
+            slots.acquire() # blocks while in_flight utterances wait
+            p.apply_async(pipeline_task, ((cline, likelihoods),),
+                    callback=done(start + i), error_callback=failed)
+        list_of_likelihoods = None
+    p.close()
+    p.join()
+    if len(failures):
+        raise failures[0]
+    return list_stats
 
 
 def process(ofname, iscpfname, ihmmfname, 
         ilmfname=None, iwdnetfname=None, unibifname=None, 
-        idbnfname=None, idbndictstuple=None):
+        idbnfname=None, idbndictstuple=None, ingramfname=None,
+        idictfname=None, iwlmfname=None, iscoresfname=None):
 
     with open(ihmmfname) as ihmmf:
         n_states, transitions, gmms = parse_hmm(ihmmf)
 
-    gmms_ = precompute_det_inv(gmms)
     map_states_to_phones = phones_mapping(gmms)
-    likelihoods_computer = functools.partial(compute_likelihoods, gmms_)
-    gmm_likelihoods_computer = functools.partial(compute_likelihoods, gmms_) #TODO REMOVE
-
-    dbn = None
-    dbn_to_int_to_state_tuple = None
-    if idbnfname != None:
-        with open(idbnfname) as idbnf:
-            dbn = pickle.load(idbnf)
-        with open(idbndictstuple) as idbndtf:
-            dbn_to_int_to_state_tuple = pickle.load(idbndtf)
-        dbn_phones_to_states = dbn_to_int_to_state_tuple[0]
-        likelihoods_computer = functools.partial(compute_likelihoods_dbn, dbn)
-        # like that = for GRBM first layer (normalize=True, unit=False)
-        # TODO correct the normalize/unit to work on full test dataset
+    # GMMs, DBN (DBN_SCORER, for GRBM first layer: normalize=True) or matrix
+    scorer = load_scorer(gmms, map_states_to_phones, ihmmfname,
+            idbnfname=idbnfname, idbndictstuple=idbndictstuple,
+            iscoresfname=iscoresfname, dbn_scorer=DBN_SCORER)
+    if GS_CODEWORDS != None and type(scorer) is GmmScorer:
+        scorer = ShortlistScorer(gmms, model_files=scorer.model_files,
+                n_codewords=GS_CODEWORDS)
+    elif GS_CODEWORDS != None:
+        print("WARNING: no --gs with", type(scorer).__name__, file=sys.stderr)
+    first_scorer = None
+    if FIRST_PASS_HMM != None and (ONLINE or SCAN_BLOCKS != None
+            or PIPELINE_IN_FLIGHT != None or CACHE_DIR != None):
+        print("WARNING: no --two-pass with --online / --scan / --pipeline / --cache, one pass", file=sys.stderr)
+    elif FIRST_PASS_HMM != None:
+        with open(FIRST_PASS_HMM) as ifirstf:
+            _, _, first_gmms = parse_hmm(ifirstf)
+        if phones_mapping(first_gmms) != map_states_to_phones:
+            print("the states of", FIRST_PASS_HMM, "differ from those of",
+                    ihmmfname, file=sys.stderr)
+            sys.exit(-1)
+        first_scorer = GmmScorer(first_gmms, model_files=[FIRST_PASS_HMM])
+    for s in (scorer, first_scorer):
+        if MEMORY_BUDGET != None and isinstance(s, GmmScorer):
+            s.memory_budget = MEMORY_BUDGET
+
+    graph = None
+    if ingramfname != None: # before the transitions between phones are set
+        with open(ingramfname) as ingramf:
+            graph = LMGraph(parse_arpa(ingramf), transitions,
+                    insertion_penalty=INSERTION_PENALTY,
+                    scale_factor=SCALE_FACTOR)
+        print(graph)
+        if LATTICES_DIR != None or N_BEST > 1:
+            print("WARNING: no lattices / N-best with --ngram", file=sys.stderr)
+    lexicon = None
+    if idictfname != None: # idem
+        word_lm = None
+        if iwlmfname != None:
+            with open(iwlmfname) as iwlmf:
+                word_lm = parse_arpa(iwlmf)
+            if word_lm.order > 2:
+                print("WARNING: only the bigrams of", iwlmfname, "are used",
+                        file=sys.stderr)
+        with open(idictfname) as idictf:
+            lexicon = LexiconTree(parse_dict(idictf, transitions[0]),
+                    transitions, lm=word_lm,
+                    insertion_penalty=INSERTION_PENALTY,
+                    scale_factor=SCALE_FACTOR)
+        print(lexicon)
+        if LATTICES_DIR != None or N_BEST > 1:
+            print("WARNING: no lattices / N-best with --dict", file=sys.stderr)
 
     if iwdnetfname != None:
         with open(iwdnetfname) as iwdnf:
@@ -647,108 +1228,363 @@ def process(ofname, iscpfname, ihmmfname,
         transitions = initialize_transitions(transitions)
     transitions = penalty_scale(transitions, 
             insertion_penalty=INSERTION_PENALTY, scale_factor=SCALE_FACTOR)
+    topology = None
+    if SPARSE_VITERBI:
+        topology = build_topology(transitions)
+        print(topology)
 
 
-    dummy = np.ndarray((2,2)) # to force only 1 compile of Viterbi's C
-    viterbi(dummy, [None, dummy], {}) # also for this compile's debug purposes
+    dummy = np.zeros((2,2)) # to force only 1 compile of the Viterbi kernel
+    viterbi(dummy, [None, dummy], {}) # (before forking the Pool workers)
     
-    if dbn != None:
-        input_n_frames = dbn.rbm_layers[0].n_visible / 39 # TODO generalize
-        print("this is a DBN with", input_n_frames, "frames on the input layer")
-        mfcc_file_name = 'tmp_mfcc_' + str(int(input_n_frames)) + '.npy'
-        map_mfcc_file_name = 'tmp_map_file_to_start_end_' + str(int(input_n_frames)) + '.pickle'
-        try: # TODO remove?
-            print("loading concat MFCC from pickled file", mfcc_file_name)
-            with open(mfcc_file_name) as concat_mfcc:
-                all_mfcc = np.load(concat_mfcc)
-            with open(map_mfcc_file_name) as map_mfcc:
-                map_file_to_start_end = pickle.load(map_mfcc)
-        except:
-            print("concatenating MFCC files") # TODO parallelize + use np.concatenate
-            all_mfcc = np.ndarray((0, dbn.rbm_layers[0].n_visible), dtype='float32')
+    using_bigram = (ilmfname != None or iwdnetfname != None
+            or unibifname != None)
+    with open(iscpfname) as iscpf:
+        clines = [clean(line) for line in iscpf if len(clean(line))]
+    if ONLINE and not scorer.per_file:
+        print("WARNING: no --online with", type(scorer).__name__ + ",",
+                "decoding whole files", file=sys.stderr)
+    elif ONLINE and (graph != None or lexicon != None):
+        print("WARNING: no --online with --ngram / --dict, decoding whole files", file=sys.stderr)
+    elif ONLINE: # one file after the other, frame by frame
+        if LATTICES_DIR != None or N_BEST > 1 or CACHE_DIR != None \
+                or UTTERANCES_PER_BATCH > 1 or PIPELINE_IN_FLIGHT != None:
+            print("WARNING: no --lattices / --n / --cache / --batch / --pipeline with --online, ignored", file=sys.stderr)
+        list_stats = []
+        with open(ofname, 'w') as of:
+            of.write('#!MLF!#\n')
+            for cline in clines:
+                if VERBOSE:
+                    print(cline)
+                of.write('"' + cline[:-3] + 'rec"\n')
+                list_stats.append({})
+                online_viterbi(of, scorer.features(cline), scorer.likelihoods,
+                        transitions, map_states_to_phones,
+                        using_bigram=using_bigram or FORCE_ENTER_EXIT,
+                        topology=topology, beam=BEAM, max_active=MAX_ACTIVE,
+                        max_delay=ONLINE_MAX_DELAY, stats=list_stats[-1])
+                of.write('.\n')
+        print("average number of active states per frame:",
+                average_active(list_stats), "out of", n_states)
+        return
+
+    if SCAN_BLOCKS != None and (graph != None or lexicon != None):
+        print("WARNING: no --scan with --ngram / --dict, decoding the files in parallel", file=sys.stderr)
+    elif SCAN_BLOCKS != None: # one file after the other, on all the workers
+        if PIPELINE_IN_FLIGHT != None:
+            print("WARNING: no --pipeline with --scan, ignored", file=sys.stderr)
+        if BEAM == None and MAX_ACTIVE == None:
+            print("WARNING: --scan without --beam / --max-active, the blocks are re-scanned sequentially", file=sys.stderr)
+        n_blocks = SCAN_BLOCKS or cpu_count()
+        whole = None
+        if not scorer.per_file:
+            whole = scorer.score_all(clines)
+        list_stats = []
+        phones_matrix = states_to_phones_matrix(map_states_to_phones)
+        p = Pool(cpu_count())
+        with open(ofname, 'w') as of:
+            of.write('#!MLF!#\n')
+            for cline in clines:
+                if VERBOSE:
+                    print(cline)
+                if whole != None:
+                    start, end = whole[1][cline]
+                    likelihoods = whole[0][start:end]
+                elif scorer.per_frame: # frames scored in parallel too
+                    features = scorer.features(cline)
+                    likelihoods = np.concatenate(p.map(FramesLoop(scorer),
+                        np.array_split(features, min(n_blocks,
+                            features.shape[0]))), axis=0)
+                else:
+                    likelihoods = scorer(cline)
+                list_stats.append({})
+                states = viterbi_scan(likelihoods, transitions,
+                        map_states_to_phones, p, n_blocks,
+                        using_bigram=using_bigram or FORCE_ENTER_EXIT,
+                        topology=topology, beam=BEAM, max_active=MAX_ACTIVE,
+                        stats=list_stats[-1])
+                of.write('"' + cline[:-3] + 'rec"\n' + string_mlf(
+                    map_states_to_phones, states, phones_only=not MLF_STATES,
+                    phones_matrix=phones_matrix) + '.\n')
+        p.close()
+        p.join()
+        print("average number of active states per frame:", average_active(
+            list_stats), "out of", n_states)
+        print("frames re-scanned by the fix-up:", sum(stats['fixed']
+            for stats in list_stats), "out of", sum(stats['frames']
+                for stats in list_stats))
+        return
+
+    cache = None
+    if CACHE_DIR != None:
+        cache = DecodeCache(CACHE_DIR, float16=CACHE_FLOAT16)
+
+    if PIPELINE_IN_FLIGHT != None: # scoring and decoding overlap
+        if UTTERANCES_PER_BATCH > 1 or CACHE_DIR != None \
+                or SHARED_DIR != None or SAVE_SCORES != None:
+            print("WARNING: no --batch / --cache / --shared-dir / --save-scores with --pipeline, ignored", file=sys.stderr)
+        il = InnerLoop(None, map_states_to_phones, transitions,
+                using_bigram=using_bigram,
+                topology=topology, beam=BEAM, max_active=MAX_ACTIVE,
+                graph=graph, lexicon=lexicon)
+        if not scorer.per_file:
+            print("normalizing the scorer input on the whole scp")
+            scorer.prepare(clines)
+        print("computing likelihoods and viterbi paths, at most",
+                PIPELINE_IN_FLIGHT, "utterances in flight")
+        with open(ofname, 'w') as of:
+            of.write('#!MLF!#\n')
+            list_stats = pipeline(clines, il, PIPELINE_IN_FLIGHT,
+                    OrderedWriter(of), scorer, chunk=PIPELINE_CHUNK)
+        print("average number of active states per frame:", average_active(
+            list_stats), "out of", n_states)
+        return
+
+    likelihoods = None
+    likelihoods_keys = dict((cline, None) for cline in clines)
+    saved = False # likelihoods already written to SAVE_SCORES
+    shared_likelihoods = None # SharedArray of likelihoods[0] (not copied)
+    if first_scorer != None: # scores the pairs kept by the first pass
+        init, ending_state = initial_scores(n_states, map_states_to_phones,
+                using_bigram or FORCE_ENTER_EXIT)
+        final = None
+        if ending_state != None:
+            final = np.zeros(n_states)
+            final[:] = LOG_ZERO
+            final[ending_state] = 0.0
+        first_topology = topology
+        if first_topology is None:
+            first_topology = build_topology(transitions)
+        p = Pool(cpu_count())
+        likelihoods = two_pass_likelihoods(p, first_scorer, scorer, clines,
+                first_topology, init, final=final, beam=TWO_PASS_BEAM,
+                chunk=PIPELINE_CHUNK)
+        p.close()
+        p.join()
+    elif not scorer.per_file: # on the whole scp at once
+        if cache != None:
+            scorer_key = scorer.key(cache, clines)
+            likelihoods_keys = dict((cline, cache.key(scorer_key, cline))
+                    for cline in clines)
+            if scorer.cacheable:
+                likelihoods = cache.load_likelihoods(scorer_key)
+        if likelihoods != None:
+            print("loaded the likelihoods from the cache", CACHE_DIR)
+        else:
+            likelihoods = scorer.score_all(clines)
+            if VERBOSE:
+                print(likelihoods[0])
+                print(likelihoods[0].shape)
+            if cache != None and scorer.cacheable:
+                cache.save_likelihoods(scorer_key, likelihoods)
+    else: # per file in the Pool
+        print("computing likelihoods")
+        scorer_key = None
+        if cache != None:
+            scorer_key = scorer.key(cache)
+        p = Pool(cpu_count())
+        files = list(dict.fromkeys(clines)) # each file scored once
+        files_n_frames = [htk_n_frames(cline) for cline in files]
+        if all(n != None for n in files_n_frames):
+            job_stats = JobStats(cpu_count(), names=files)
+            # preallocated, shared with the decoding workers (the memory
+            # mapped .npy with --save-scores): the whole corpus is never
+            # held twice
+            shared_likelihoods, map_file_to_start_end = allocate_scores(
+                    files, files_n_frames, n_states, fname=SAVE_SCORES,
+                    directory=SHARED_DIR)
+            likelihoods = (shared_likelihoods.array, map_file_to_start_end)
+            out = None
+            if SAVE_SCORES != None:
+                out = (SAVE_SCORES, likelihoods[1])
+                saved = True
+            for i, (key, x) in longest_first(p, LikelihoodsLoop(scorer,
+                cache=cache, scorer_key=scorer_key, out=out), files,
+                files_n_frames, stats=job_stats):
+                if x is not None:
+                    start, end = likelihoods[1][files[i]]
+                    likelihoods[0][start:end] = x
+                likelihoods_keys[files[i]] = key
+        else:
+            job_stats = JobStats(cpu_count(), names=clines)
+            list_of_likelihoods = map_longest_first(p,
+                    LikelihoodsLoop(scorer, cache=cache,
+                        scorer_key=scorer_key), clines, file_costs(clines),
+                    stats=job_stats)
             map_file_to_start_end = {}
-            with open(iscpfname) as iscpf:
-                for line in iscpf:
-                    cline = clean(line)
-                    start = all_mfcc.shape[0]
-                    x = htkmfc.open(cline).getall()
-                    if input_n_frames > 1:
-                        x = padding(input_n_frames, x)
-                    print(all_mfcc.shape)
-                    print(x.shape)
-                    all_mfcc = np.append(all_mfcc, x, axis=0)
-                    map_file_to_start_end[cline] = (start, all_mfcc.shape[0])
-
-            with open(mfcc_file_name, 'w') as concat_mfcc:
-                np.save(concat_mfcc, all_mfcc)
-            with open(map_mfcc_file_name, 'w') as map_mfcc:
-                pickle.dump(map_file_to_start_end, map_mfcc)
-    else: # GMM
-        all_mfcc = np.ndarray((0, 39), dtype='float32') # TODO generalize
-
-    print("computing likelihoods")
-    if dbn != None: # TODO clean
-        # TODO REMOVE
-        #gmm_likelihoods = gmm_likelihoods_computer(all_mfcc[:, xrange(195,234)])
-        #mean_gmms = np.mean(gmm_likelihoods, 0)
-        #print gmm_likelihoods
-        #print gmm_likelihoods.shape
-        tmp_likelihoods = likelihoods_computer(all_mfcc)
-        #mean_dbns = np.mean(tmp_likelihoods, 0)
-        #tmp_likelihoods *= (mean_gmms / mean_dbns)
-        if VERBOSE:
-            print(tmp_likelihoods)
-            print(tmp_likelihoods.shape)
-        print(map_states_to_phones)
-        print(dbn_phones_to_states)
-        assert set(map_states_to_phones.values()) == set(dbn_phones_to_states.keys()), "Phones differ between the HMM and the DBN"
-        columns_remapping = [dbn_phones_to_states[map_states_to_phones[i]] for i in range(tmp_likelihoods.shape[1])]
-        if VERBOSE:
-            print(columns_remapping)
-        likelihoods = (tmp_likelihoods[:, columns_remapping],
-            map_file_to_start_end)
-        #if VERBOSE:
-            #print map_file_to_start_end
-            #print len(map_file_to_start_end)
-            #print likelihoods[0]
-            #print likelihoods[0].shape
-    else:
-        likelihoods = (likelihoods_computer(all_mfcc), map_file_to_start_end)
+            n_frames = 0
+            for cline, (key, x) in zip(clines, list_of_likelihoods):
+                map_file_to_start_end[cline] = (n_frames,
+                        n_frames + x.shape[0])
+                n_frames += x.shape[0]
+                likelihoods_keys[cline] = key
+            likelihoods = (np.concatenate([x for _, x in
+                list_of_likelihoods], axis=0), map_file_to_start_end)
+        p.close()
+        p.join()
+        job_stats.report("likelihoods")
+    if SAVE_SCORES != None and saved:
+        print("wrote the likelihoods to", SAVE_SCORES)
+    elif SAVE_SCORES != None:
+        save_scores(SAVE_SCORES, likelihoods)
+        print("wrote the likelihoods to", SAVE_SCORES)
+
+    decode_keys = None
+    if cache != None:
+        # the transitions come from the HMMs even with --scores
+        lm_key = cache.key(*[cache.file_key(fname) for fname in
+            (ihmmfname, ilmfname, iwdnetfname, unibifname, ingramfname,
+                idictfname, iwlmfname) if fname != None])
+        decode_keys = dict((cline, cache.key(likelihoods_keys[cline], lm_key,
+            MATRIX_BIGRAM, UNIGRAMS_ONLY, INSERTION_PENALTY, SCALE_FACTOR,
+            BEAM, MAX_ACTIVE, MLF_STATES, FORCE_ENTER_EXIT))
+            for cline in clines)
 
     print("computing viterbi paths")
-    list_mlf_string = []
-    with open(iscpfname) as iscpf:
-        il = InnerLoop(likelihoods,
+    list_stats = []
+    utterances_per_batch = UTTERANCES_PER_BATCH
+    if LATTICES_DIR != None or N_BEST > 1 or graph != None or lexicon != None:
+        utterances_per_batch = 1 # lattices / n-grams / words per utterance
+    n_frames = [likelihoods[1][cline][1] - likelihoods[1][cline][0]
+            for cline in clines]
+    with open(ofname, 'w') as of:
+        of.write('#!MLF!#\n')
+        inner_loop = InnerLoop if utterances_per_batch <= 1 else BatchInnerLoop
+        il = inner_loop(likelihoods,
                 map_states_to_phones, transitions,
-                using_bigram=(ilmfname != None 
-                    or iwdnetfname != None 
-                    or unibifname != None))
+                using_bigram=using_bigram,
+                topology=topology, beam=BEAM, max_active=MAX_ACTIVE,
+                cache=cache, keys=decode_keys, graph=graph, lexicon=lexicon)
+        shared = il.share(SHARED_DIR, likelihoods=shared_likelihoods)
         #p = Pool(1)
         p = Pool(cpu_count())
-        list_mlf_string = p.map(il, iscpf)
-    with open(ofname, 'w') as of:
-        of.write('#!MLF!#\n')
-        for line in list_mlf_string:
-            of.write(line)
+        writer = OrderedWriter(of) # longest utterances first, in scp order
+        if utterances_per_batch <= 1:
+            job_stats = JobStats(cpu_count(), names=clines)
+            for i, (mlf_string, stats) in longest_first(p, il, clines,
+                    n_frames, stats=job_stats, chunksize=IMAP_CHUNKSIZE):
+                writer.write(i, mlf_string)
+                list_stats.append(stats)
+        else:
+            # batches of utterances of similar lengths (less padding)
+            order = np.argsort(n_frames)[::-1]
+            batches = [order[i:i+utterances_per_batch] 
+                    for i in range(0, len(order), utterances_per_batch)]
+            job_stats = JobStats(cpu_count(), names=[
+                clines[batch[0]] + ' (+' + str(len(batch) - 1) + ')'
+                for batch in batches])
+            for b, (strings, stats) in longest_first(p, il,
+                    [[clines[i] for i in batch] for batch in batches],
+                    [n_frames[batch[0]] * len(batch) for batch in batches],
+                    stats=job_stats):
+                for i, mlf_string in zip(batches[b], strings):
+                    writer.write(i, mlf_string)
+                list_stats.append(stats)
+        p.close()
+        p.join()
+    job_stats.report("viterbi")
+    for shared_array in shared:
+        shared_array.close()
+    print("average number of active states per frame:", average_active(
+        list_stats), "out of", n_states)
 
 
-if __name__ == "__main__":
-    if len(sys.argv) > 3:
-        if '--help' in sys.argv:
+def main(argv):
+    """ parses the options in argv (as sys.argv) and runs process() """
+    global VERBOSE, SPARSE_VITERBI, VITERBI_BACKEND, UTTERANCES_PER_BATCH
+    global MLF_STATES, LEAN_VITERBI, SPILL_DIR, CACHE_DIR, CACHE_FLOAT16
+    global PIPELINE_IN_FLIGHT, SHARED_DIR, LATTICES_DIR, N_BEST, BEAM
+    global MAX_ACTIVE, INSERTION_PENALTY, SCALE_FACTOR, ONLINE
+    global ONLINE_MAX_DELAY, SAVE_SCORES, SCAN_BLOCKS, FIRST_PASS_HMM
+    global TWO_PASS_BEAM, GS_CODEWORDS, MEMORY_BUDGET
+    if len(argv) > 3:
+        if '--help' in argv:
             print(usage)
             sys.exit(0)
-        args = dict(enumerate(sys.argv))
-        options = [ind_x for ind_x in enumerate(sys.argv) if '--' in ind_x[1][0:2]]
+        args = dict(enumerate(argv))
+        options = [ind_x for ind_x in enumerate(argv) if '--' in ind_x[1][0:2]]
         input_unibi_fname = None # my bigram LM
         input_lm_fname = None # HStats bigram LMs (either matrix of ARPA-MIT)
         input_wdnet_fname = None # HTK's wdnet (with bigram probas)
+        input_ngram_fname = None # ARPA n-gram LM (any order)
+        input_dict_fname = None # HTK dictionary (word decoding)
+        input_wlm_fname = None # ARPA word bigram LM
         dbn_fname = None # DBN cPickle
         dbn_dicts_fname = None # DBN to_int and to_states dicts tuple
+        input_scores_fname = None # likelihoods matrix (.npy + .pickle map)
         if len(options): # we have options
             for ind, option in options:
                 args.pop(ind)
                 if option == '--v' or option=='--verbose':
                     VERBOSE = True
+                if option == '--sparse':
+                    SPARSE_VITERBI = True
+                if option == '--backend':
+                    VITERBI_BACKEND = args[ind+1]
+                    args.pop(ind+1)
+                    if VITERBI_BACKEND not in BACKENDS:
+                        print("unknown Viterbi backend", VITERBI_BACKEND, file=sys.stderr)
+                        print(usage, file=sys.stderr)
+                        sys.exit(-1)
+                if option == '--batch':
+                    UTTERANCES_PER_BATCH = int(args[ind+1])
+                    args.pop(ind+1)
+                if option == '--states':
+                    MLF_STATES = True
+                if option == '--lean':
+                    LEAN_VITERBI = True
+                if option == '--spill':
+                    SPILL_DIR = args[ind+1]
+                    args.pop(ind+1)
+                if option == '--cache':
+                    CACHE_DIR = args[ind+1]
+                    args.pop(ind+1)
+                if option == '--cache-float16':
+                    CACHE_FLOAT16 = True
+                if option == '--pipeline':
+                    PIPELINE_IN_FLIGHT = int(args[ind+1])
+                    args.pop(ind+1)
+                if option == '--shared-dir':
+                    SHARED_DIR = args[ind+1]
+                    args.pop(ind+1)
+                if option == '--lattices':
+                    LATTICES_DIR = args[ind+1]
+                    args.pop(ind+1)
+                if option == '--n':
+                    N_BEST = int(args[ind+1])
+                    args.pop(ind+1)
+                if option == '--beam':
+                    BEAM = float(args[ind+1])
+                    args.pop(ind+1)
+                if option == '--max-active':
+                    MAX_ACTIVE = int(args[ind+1])
+                    args.pop(ind+1)
+                if option == '--online':
+                    ONLINE = True
+                    ONLINE_MAX_DELAY = int(args[ind+1]) or None
+                    args.pop(ind+1)
+                if option == '--scan':
+                    SCAN_BLOCKS = int(args[ind+1])
+                    args.pop(ind+1)
+                if option == '--two-pass':
+                    FIRST_PASS_HMM = args[ind+1]
+                    args.pop(ind+1)
+                if option == '--two-pass-beam':
+                    TWO_PASS_BEAM = float(args[ind+1])
+                    args.pop(ind+1)
+                if option == '--memory-budget':
+                    MEMORY_BUDGET = int(float(args[ind+1]) * 2**20)
+                    args.pop(ind+1)
+                if option == '--gs':
+                    GS_CODEWORDS = int(args[ind+1])
+                    args.pop(ind+1)
+                if option == '--scores':
+                    input_scores_fname = args[ind+1]
+                    args.pop(ind+1)
+                    print("will use the likelihoods of", input_scores_fname)
+                if option == '--save-scores':
+                    SAVE_SCORES = args[ind+1]
+                    args.pop(ind+1)
                 if option == '--p':
                     INSERTION_PENALTY = float(args[ind+1])
                     args.pop(ind+1)
@@ -768,16 +1604,23 @@ if __name__ == "__main__":
                     args.pop(ind+1)
                     print("initialize the transitions between phones with the wordnet", input_wdnet_fname)
                     print("WILL IGNORE LANGUAGE MODELS!")
+                if option == '--ngram':
+                    input_ngram_fname = args[ind+1]
+                    args.pop(ind+1)
+                    print("decode with the n-gram lm", input_ngram_fname)
+                if option == '--dict':
+                    input_dict_fname = args[ind+1]
+                    args.pop(ind+1)
+                    print("decode words of the dictionary", input_dict_fname)
+                if option == '--wlm':
+                    input_wlm_fname = args[ind+1]
+                    args.pop(ind+1)
+                    print("with the word lm", input_wlm_fname)
                 if option == '--d':
                     if not (ind+2) in args:
                         print("We need the DBN and the states/phones mapping", file=sys.stderr)
                         print(usage, file=sys.stderr)
                         sys.exit(-1)
-                    try:
-                        from DBN_Gaussian_timit import DBN # not Gaussian if no GRBM
-                    except:
-                        print("experimental: TO BE LAUNCHED FROM THE 'DBN/' DIR", file=sys.stderr)
-                        sys.exit(-1)
                     dbn_fname = args[ind+1]
                     args.pop(ind+1)
                     print("will use the following DBN to estimate states likelihoods", dbn_fname)
@@ -792,7 +1635,13 @@ if __name__ == "__main__":
         process(output_fname, input_scp_fname, 
                 input_hmm_fname, input_lm_fname, 
                 input_wdnet_fname, input_unibi_fname,
-                dbn_fname, dbn_dicts_fname)
+                dbn_fname, dbn_dicts_fname, ingramfname=input_ngram_fname,
+                idictfname=input_dict_fname, iwlmfname=input_wlm_fname,
+                iscoresfname=input_scores_fname)
     else:
         print(usage)
         sys.exit(-1)
+
+
+if __name__ == "__main__":
+    main(sys.argv)
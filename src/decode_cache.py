@@ -0,0 +1,103 @@
+"""
+Content-addressed cache of likelihoods matrices and decoding results.
+
+Everything is keyed by SHA-1 digests of what produced it, never by file
+names or shapes: the features files, the model files (HMMs, DBN), the LM
+and the decoder parameters. A change in any of them gives another key and
+unchanged work is found again on partial reruns:
+
+    likelihoods key = key(model files digests, features digest(s))
+    decoding key    = key(likelihoods key, LM digest, decoder parameters)
+
+Likelihoods are .npy files (np.load(mmap_mode='r') able), optionally in
+float16 (half the disk and I/O, lossy: ~3 significant digits, log
+likelihoods below -65504 become -inf). Decoding results are the MLF body of
+an utterance. Files are written to a temporary name then renamed, so that
+concurrent workers never read half written entries.
+
+    cache = DecodeCache(directory)
+    k = cache.key(cache.file_key(hmm_fname), cache.file_key(mfc_fname))
+    if cache.load_likelihoods(k) == None:
+        cache.save_likelihoods(k, (likelihoods, None))
+"""
+
+import os, hashlib, pickle, tempfile
+import numpy as np
+
+CHUNK = 1 << 20 # bytes read at once when hashing files
+
+
+class DecodeCache(object):
+    def __init__(self, directory, float16=False):
+        self.directory = directory
+        self.float16 = float16
+        self.file_keys = {} # file name -> digest, per process
+
+    def key(self, *parts):
+        """ digest of parts (digests, parameters...), in order """
+        h = hashlib.sha1()
+        for part in parts:
+            h.update(repr(part).encode('utf-8'))
+            h.update(b'\0')
+        return h.hexdigest()
+
+    def file_key(self, fname):
+        """ digest of the content of the file fname (once per process) """
+        if fname not in self.file_keys:
+            h = hashlib.sha1()
+            with open(fname, 'rb') as f:
+                for chunk in iter(lambda: f.read(CHUNK), b''):
+                    h.update(chunk)
+            self.file_keys[fname] = h.hexdigest()
+        return self.file_keys[fname]
+
+    def path(self, kind, key, extension):
+        return os.path.join(self.directory, kind, key[:2], key + extension)
+
+    def write(self, fname, write):
+        """ calls write(f) on a temporary file renamed to fname """
+        directory = os.path.dirname(fname)
+        if not os.path.isdir(directory):
+            os.makedirs(directory, exist_ok=True)
+        fd, tmp_fname = tempfile.mkstemp(dir=directory)
+        with os.fdopen(fd, 'wb') as f:
+            write(f)
+        os.replace(tmp_fname, fname)
+
+    def load_likelihoods(self, key):
+        """ (likelihoods, map_file_to_start_end or None) tuple or None, the
+        likelihoods memory mapped (float32 copy if stored in float16) """
+        fname = self.path('likelihoods', key, '.npy')
+        if not os.path.exists(fname):
+            return None
+        likelihoods = np.load(fname, mmap_mode='r')
+        if likelihoods.dtype == np.float16:
+            likelihoods = likelihoods.astype('float32')
+        mapping = None
+        if os.path.exists(fname[:-4] + '.pickle'):
+            with open(fname[:-4] + '.pickle', 'rb') as f:
+                mapping = pickle.load(f)
+        return likelihoods, mapping
+
+    def save_likelihoods(self, key, likelihoods):
+        """ stores the (likelihoods, map_file_to_start_end or None) tuple """
+        fname = self.path('likelihoods', key, '.npy')
+        if likelihoods[1] != None: # the mapping first, the .npy is the flag
+            self.write(fname[:-4] + '.pickle',
+                    lambda f: pickle.dump(likelihoods[1], f))
+        array = likelihoods[0]
+        if self.float16:
+            array = array.astype('float16')
+        self.write(fname, lambda f: np.save(f, array))
+
+    def load_decode(self, key):
+        """ MLF body (without the "file.rec" header) or None """
+        fname = self.path('decodes', key, '.rec')
+        if not os.path.exists(fname):
+            return None
+        with open(fname, 'rb') as f:
+            return f.read().decode('utf-8')
+
+    def save_decode(self, key, s):
+        self.write(self.path('decodes', key, '.rec'),
+                lambda f: f.write(s.encode('utf-8')))
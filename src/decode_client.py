@@ -0,0 +1,39 @@
+import sys, os, socket
+
+usage = """
+python decode_client.py SOCKET INPUT_SCP [OUTPUT[.mlf]]
+
+Sends the features files of INPUT_SCP (made absolute) to the decode_server.py
+listening on SOCKET and writes the MLF it streams back in OUTPUT (on the
+standard output if absent) as the utterances are decoded.
+"""
+
+BUFFER_SIZE = 65536 # bytes read from the socket at once
+
+
+def process(socket_fname, iscpfname, of):
+    with open(iscpfname) as iscpf:
+        lines = [os.path.abspath(line.strip()) for line in iscpf
+                if len(line.strip())]
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.connect(socket_fname)
+    sock.sendall(('\n'.join(lines) + '\n').encode('utf-8'))
+    sock.shutdown(socket.SHUT_WR) # end of the job
+    while True:
+        data = sock.recv(BUFFER_SIZE)
+        if not len(data):
+            break
+        of.write(data.decode('utf-8'))
+        of.flush()
+    sock.close()
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 3 or '--help' in sys.argv:
+        print(usage)
+        sys.exit(0 if '--help' in sys.argv else -1)
+    if len(sys.argv) > 3:
+        with open(sys.argv[3], 'w') as of:
+            process(sys.argv[1], sys.argv[2], of)
+    else:
+        process(sys.argv[1], sys.argv[2], sys.stdout)
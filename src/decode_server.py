@@ -0,0 +1,254 @@
+import numpy as np
+import sys, os, time, threading, socketserver, signal
+from multiprocessing import Pool, cpu_count
+sys.path.append(os.getcwd())
+sys.path.append('DBN')
+
+import batch_viterbi
+from batch_viterbi import phones_mapping, parse_hmm
+from batch_viterbi import parse_lm, parse_lm_matrix, parse_wdnet
+from batch_viterbi import initialize_transitions, penalty_scale
+from batch_viterbi import viterbi, string_mlf, clean
+from batch_viterbi import states_to_phones_matrix
+from viterbi_kernels import build_topology
+from shared_arrays import SharedArray
+from scorers import load_scorer
+
+usage = """
+python decode_server.py SOCKET INPUT_HMM
+        [--p INSERTION_PENALTY] [--s SCALE_FACTOR]
+        [--b INPUT_LM] [--w WDNET] [--ub UNI&BIGRAM_LM]
+        [--sparse] [--beam LOG_BEAM] [--max-active N_STATES]
+        [--workers N_PROCESSES]
+        [--d DBN_PICKLED_FILE DBN_TO_INT_TO_STATE_DICTS_TUPLE]
+        [--verbose]
+
+Resident decoder: parses the HMMs and the LM, builds the transitions (and
+unpickles / compiles the DBN) once, forks its Pool of workers, then serves
+decoding jobs on the Unix-domain socket SOCKET until interrupted (Ctrl-C or
+SIGTERM).
+
+A job is a connection: the client sends the features files (one per line,
+as in a .scp, paths as seen by the server) and closes its writing side (or
+sends an empty line), the server streams back the MLF (as batch_viterbi.py
+writes it) utterance by utterance, in the order of the scp, and closes the
+connection. Use decode_client.py:
+    python decode_client.py SOCKET INPUT_SCP [OUTPUT[.mlf]]
+
+The options are those of batch_viterbi.py (--b, --w and --ub are exclusive),
+--workers followed by the number of decoding processes (default: all CPUs).
+"""
+
+VERBOSE = False
+UNIGRAMS_ONLY = False # says if we use only unigrams when we have _our_ bigrams
+MATRIX_BIGRAM = True # is the bigram file format a matrix? (ARPA-MIT if False)
+SCALE_FACTOR = 1.0 # importance of the LM w.r.t. the acoustics
+INSERTION_PENALTY = 2.5 # penalty of inserting a new phone (in the Viterbi)
+SPARSE_VITERBI = False # Viterbi on the compact topology (phones band + P*P)
+BEAM = None # log score beam w.r.t. the best state of each frame (None: no beam)
+MAX_ACTIVE = None # max number of active states per frame (None: all)
+N_WORKERS = cpu_count() # decoding processes of the server (--workers)
+
+_decoder = None # the Decoder, set before forking the workers (inherited)
+
+
+class Decoder(object):
+    """ everything that does not depend on the utterances: transitions,
+    topology, GMMs or DBN, loaded once """
+    def __init__(self, ihmmfname, ilmfname=None, iwdnetfname=None,
+            unibifname=None, idbnfname=None, idbndictstuple=None):
+        with open(ihmmfname) as ihmmf:
+            self.n_states, transitions, gmms = parse_hmm(ihmmf)
+        self.map_states_to_phones = phones_mapping(gmms)
+        self.phones_matrix = states_to_phones_matrix(
+                self.map_states_to_phones)
+        self.scorer = load_scorer(gmms, self.map_states_to_phones, ihmmfname,
+                idbnfname=idbnfname, idbndictstuple=idbndictstuple)
+        if not self.scorer.per_file:
+            self.scorer_lock = threading.Lock() # one job at a time on the DBN
+        if iwdnetfname != None:
+            with open(iwdnetfname) as iwdnf:
+                transitions = parse_wdnet(transitions, iwdnf)
+        elif ilmfname != None:
+            with open(ilmfname) as ilmf:
+                if MATRIX_BIGRAM:
+                    transitions = parse_lm_matrix(transitions, ilmf)
+                else:
+                    transitions = parse_lm(transitions, ilmf)
+        elif unibifname != None:
+            with open(unibifname) as ubf:
+                transitions = initialize_transitions(transitions, ubf,
+                        unigrams_only=UNIGRAMS_ONLY)
+        else:
+            transitions = initialize_transitions(transitions)
+        self.transitions = penalty_scale(transitions,
+                insertion_penalty=INSERTION_PENALTY, scale_factor=SCALE_FACTOR)
+        self.using_bigram = (ilmfname != None or iwdnetfname != None
+                or unibifname != None)
+        self.topology = None
+        if SPARSE_VITERBI:
+            self.topology = build_topology(self.transitions)
+        dummy = np.zeros((2,2)) # to force only 1 compile of the Viterbi kernel
+        viterbi(dummy, [None, dummy], {}) # (before forking the Pool workers)
+
+    def whole_likelihoods(self, clines):
+        """ likelihoods of the features files clines for the scorers that
+        need all of them (DBN), computed at once in the server process,
+        returns (SharedArray, {cline: (start, end)}) """
+        with self.scorer_lock:
+            likelihoods = self.scorer.score_all(clines)
+        return (SharedArray(likelihoods[0]), likelihoods[1])
+
+    def __call__(self, cline, likelihoods=None):
+        """ MLF string of the features file cline, likelihoods being None
+        (per file scorer, computed here) or the whole_likelihoods() tuple """
+        if likelihoods != None:
+            start, end = likelihoods[1][cline]
+            lls = likelihoods[0].array[start:end]
+        else:
+            lls = self.scorer(cline)
+        states, _ = viterbi(lls, self.transitions, self.map_states_to_phones,
+                using_bigram=self.using_bigram
+                or batch_viterbi.FORCE_ENTER_EXIT, topology=self.topology,
+                beam=BEAM, max_active=MAX_ACTIVE)
+        return '"' + cline[:-3] + 'rec"\n' + string_mlf(
+                self.map_states_to_phones, states, phones_only=True,
+                phones_matrix=self.phones_matrix) + '.\n'
+
+
+def decode_line(args):
+    """ Pool task: (cline, likelihoods or None) -> MLF string ('' if the
+    file could not be decoded) """
+    cline, likelihoods = args
+    if VERBOSE:
+        print(cline)
+    try:
+        s = _decoder(cline, likelihoods)
+    except Exception as e: # a bad file must not kill the job
+        print("WARNING: could not decode", cline, e, file=sys.stderr)
+        return ''
+    return s
+
+
+class JobHandler(socketserver.StreamRequestHandler):
+    """ one connection = one job: scp lines in, MLF streamed out """
+    def handle(self):
+        clines = []
+        for line in self.rfile:
+            cline = clean(line.decode('utf-8'))
+            if not len(cline):
+                break
+            clines.append(cline)
+        start_time = time.time()
+        likelihoods = None
+        if not _decoder.scorer.per_file and len(clines):
+            likelihoods = _decoder.whole_likelihoods(clines)
+        self.wfile.write(b'#!MLF!#\n')
+        n_decoded = 0
+        try:
+            for s in self.server.pool.imap(decode_line,
+                    [(cline, likelihoods) for cline in clines]):
+                if len(s):
+                    n_decoded += 1
+                self.wfile.write(s.encode('utf-8'))
+                self.wfile.flush()
+        except (BrokenPipeError, ConnectionResetError):
+            print("WARNING: client left before the end of its job",
+                    file=sys.stderr)
+        finally:
+            if likelihoods != None:
+                likelihoods[0].close()
+        print("decoded", n_decoded, "out of", len(clines), "files in",
+                "%.2f" % (time.time() - start_time), "s")
+
+
+class DecodeServer(socketserver.ThreadingMixIn,
+        socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def process(socket_fname, ihmmfname, ilmfname=None, iwdnetfname=None,
+        unibifname=None, idbnfname=None, idbndictstuple=None):
+    global _decoder
+    start_time = time.time()
+    _decoder = Decoder(ihmmfname, ilmfname=ilmfname, iwdnetfname=iwdnetfname,
+            unibifname=unibifname, idbnfname=idbnfname,
+            idbndictstuple=idbndictstuple)
+    pool = Pool(N_WORKERS) # forked after the models are loaded
+    if os.path.exists(socket_fname):
+        os.remove(socket_fname)
+    server = DecodeServer(socket_fname, JobHandler)
+    server.pool = pool
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    print("models loaded in", "%.2f" % (time.time() - start_time),
+            "s, serving on", socket_fname, "with", N_WORKERS, "workers")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print("shutting down")
+    finally:
+        server.server_close()
+        os.remove(socket_fname)
+        pool.terminate()
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 2:
+        if '--help' in sys.argv:
+            print(usage)
+            sys.exit(0)
+        args = dict(enumerate(sys.argv))
+        options = [ind_x for ind_x in enumerate(sys.argv) if '--' in ind_x[1][0:2]]
+        input_unibi_fname = None # my bigram LM
+        input_lm_fname = None # HStats bigram LMs (either matrix of ARPA-MIT)
+        input_wdnet_fname = None # HTK's wdnet (with bigram probas)
+        dbn_fname = None # DBN cPickle
+        dbn_dicts_fname = None # DBN to_int and to_states dicts tuple
+        for ind, option in options:
+            args.pop(ind)
+            if option == '--v' or option == '--verbose':
+                VERBOSE = True
+            if option == '--sparse':
+                SPARSE_VITERBI = True
+            if option == '--beam':
+                BEAM = float(args[ind+1])
+                args.pop(ind+1)
+            if option == '--max-active':
+                MAX_ACTIVE = int(args[ind+1])
+                args.pop(ind+1)
+            if option == '--workers':
+                N_WORKERS = int(args[ind+1])
+                args.pop(ind+1)
+            if option == '--p':
+                INSERTION_PENALTY = float(args[ind+1])
+                args.pop(ind+1)
+            if option == '--s':
+                SCALE_FACTOR = float(args[ind+1])
+                args.pop(ind+1)
+            if option == '--ub':
+                input_unibi_fname = args[ind+1]
+                args.pop(ind+1)
+            if option == '--b':
+                input_lm_fname = args[ind+1]
+                args.pop(ind+1)
+            if option == '--w':
+                input_wdnet_fname = args[ind+1]
+                args.pop(ind+1)
+            if option == '--d':
+                if not (ind+2) in args:
+                    print("We need the DBN and the states/phones mapping", file=sys.stderr)
+                    print(usage, file=sys.stderr)
+                    sys.exit(-1)
+                dbn_fname = args[ind+1]
+                args.pop(ind+1)
+                dbn_dicts_fname = args[ind+2]
+                args.pop(ind+2)
+        socket_fname = list(args.values())[1]
+        input_hmm_fname = list(args.values())[2]
+        process(socket_fname, input_hmm_fname,
+                ilmfname=input_lm_fname, iwdnetfname=input_wdnet_fname,
+                unibifname=input_unibi_fname,
+                idbnfname=dbn_fname, idbndictstuple=dbn_dicts_fname)
+    else:
+        print(usage)
+        sys.exit(-1)
@@ -0,0 +1,277 @@
+import numpy as np
+import sys, os
+from multiprocessing import Pool, cpu_count
+sys.path.append(os.getcwd())
+sys.path.append('DBN')
+
+from batch_viterbi import phones_mapping, parse_hmm, clean
+from scorers import load_scorer
+from viterbi_kernels import Topology, viterbi_sparse, LOG_ZERO
+from scheduler import JobStats, map_longest_first, file_costs
+from shared_arrays import SharedArray
+
+usage = """
+python forced_align.py OUTPUT[.mlf] INPUT_SCP INPUT_HMM INPUT_MLF
+        [--d DBN_PICKLED_FILE DBN_TO_INT_TO_STATE_DICTS_TUPLE]
+        [--beam LOG_BEAM] [--verbose]
+
+Aligns the phones transcriptions of INPUT_MLF (e.g. train.mlf) on the
+features of INPUT_SCP with the HMMs of INPUT_HMM and writes the full states
+alignment in OUTPUT, as `HVite -a -f` (make align) does:
+    start end state loglik [phone phone_loglik]
+(timit_to_numpy.py / mocha_timit_to_numpy.py inputs).
+
+    --d followed by a pickled DBN file and a pickled tuple of dicts (states
+        map), the DBN gives the states likelihoods instead of the GMMs
+        (experimental: to be launched from the 'DBN/' dir)
+    --beam followed by the log score beam (as HVite -t), no pruning if absent
+"""
+
+VERBOSE = False
+BEAM = None # log score beam w.r.t. the best state of each frame (None: no beam)
+epsilon = 1E-5 # degree of precision for floating (0.0-1.0 probas) operations
+HTK_FRAME = 100000 # duration of a frame in HTK's 100ns units (TARGETRATE)
+
+
+def parse_mlf(f):
+    """ parses the transcriptions of an MLF file in f, lines being either
+    "phone" or "start end phone [...]", returns {label file without extension:
+    [phones]} """
+    transcripts = {}
+    name = None
+    for line in f:
+        line = clean(line)
+        if not len(line) or line == '#!MLF!#':
+            continue
+        if line[0] == '"':
+            name = os.path.splitext(line.strip('"'))[0]
+            transcripts[name] = []
+        elif line == '.':
+            name = None
+        elif name != None:
+            l = line.split()
+            transcripts[name].append(l[2] if l[0].isdigit() else l[0])
+    return transcripts
+
+
+def find_transcript(transcripts, cline):
+    """ transcript of the features file cline, by full path or '*/' pattern """
+    name = os.path.splitext(cline)[0]
+    if name in transcripts:
+        return transcripts[name]
+    return transcripts.get('*/' + os.path.basename(name))
+
+
+def linear_topology(phones, transitions):
+    """ Topology of the left-to-right concatenation of the HMMs of phones
+    (list of phones names), transitions being the (phones dict, probabilities)
+    returned by parse_hmm(). All the arcs are in the predecessors band, the
+    exit probability of a state is what its row lacks to sum to 1.
+    Returns (Topology, HMM state of each state of the graph, log probability
+    of leaving the graph from each of its states) """
+    states = []
+    preds = []
+    exits = [] # (graph state, log proba) leaving the previous phone
+    for phn in phones:
+        ind = transitions[0][phn].to_ind
+        block = transitions[1][np.ix_(ind, ind)]
+        offset = len(states)
+        for j in range(len(ind)):
+            p = [(offset + k, np.log(block[k, j]))
+                    for k in range(len(ind)) if block[k, j] > 0.0]
+            if j == 0:
+                p += exits
+            preds.append(p)
+        exits = [(offset + k, np.log(1.0 - block[k].sum()))
+                for k in range(len(ind)) if 1.0 - block[k].sum() > epsilon]
+        states.extend(ind)
+    n_preds = max(1, max(len(p) for p in preds))
+    pred_from = np.zeros((len(states), n_preds), dtype='int64')
+    pred_logp = np.ndarray((len(states), n_preds), dtype='float64')
+    pred_logp[:] = LOG_ZERO
+    for j, p in enumerate(preds):
+        for i, (k, logp) in enumerate(p):
+            pred_from[j, i] = k
+            pred_logp[j, i] = logp
+    exit_logp = np.ndarray(len(states), dtype='float64')
+    exit_logp[:] = LOG_ZERO
+    for k, logp in exits:
+        exit_logp[k] = logp
+    no_phone = np.zeros(0, dtype='int64')
+    return (Topology(pred_from, pred_logp, no_phone, no_phone,
+        np.zeros((0, 0), dtype='float64')), np.array(states), exit_logp)
+
+
+def align(likelihoods, phones, transitions, map_states_to_phones, beam=None):
+    """ forced alignment of the likelihoods (T, S) on the phones (list of
+    phones names), returns the list of (start frame, end frame (excluded),
+    state name, log likelihood, phone or None, phone log likelihood) or None
+    if no path goes through the whole transcription """
+    topology, states, exit_logp = linear_topology(phones, transitions)
+    init = np.ndarray(len(states), dtype='float64')
+    init[:] = LOG_ZERO
+    init[0] = 0.0
+    posteriors, backpointers = viterbi_sparse(likelihoods[:, states],
+            topology, init, beam=beam)
+    final = posteriors[-1] + exit_logp
+    if final.max() == LOG_ZERO:
+        return None
+    path = [final.argmax()]
+    for i in range(likelihoods.shape[0] - 2, -1, -1):
+        path.append(backpointers[i][path[-1]])
+    path.reverse()
+    phone_starts = np.cumsum([0] + [len(transitions[0][phn].to_ind)
+        for phn in phones])
+    phone_of_graph_state = np.searchsorted(phone_starts,
+            np.arange(len(states)), side='right') - 1
+    segments = []
+    start = 0
+    previous_score = 0.0
+    for t in range(1, len(path) + 1):
+        if t < len(path) and path[t] == path[t-1]:
+            continue
+        g = path[t-1]
+        segment = [start, t, map_states_to_phones[states[g]],
+                posteriors[t-1][g] - previous_score, None, 0.0]
+        if not len(segments) or phone_of_graph_state[g] != \
+                phone_of_graph_state[path[start-1]]:
+            segment[4] = phones[phone_of_graph_state[g]] # 1st state of phone
+            head = segment
+        head[5] += segment[3]
+        segments.append(segment)
+        start = t
+        previous_score = posteriors[t-1][g]
+    segments[-1][3] += exit_logp[path[-1]] # leaving the last phone
+    head[5] += exit_logp[path[-1]]
+    return [tuple(segment) for segment in segments]
+
+
+def string_aligned_mlf(segments):
+    s = ''
+    for start, end, state, loglik, phone, phone_loglik in segments:
+        s += str(start * HTK_FRAME) + ' ' + str(end * HTK_FRAME) + ' ' + \
+                state + ' ' + '%.6f' % loglik
+        if phone != None:
+            s += ' ' + phone + ' ' + '%.6f' % phone_loglik
+        s += '\n'
+    return s
+
+
+class AlignLoop(object): # to circumvent pickling pbms w/ multiprocessing.map
+    """ aligns one scp line, with the likelihoods computed by the (per
+    file) Scorer scorer or found in the (SharedArray of the likelihoods,
+    map_file_to_start_end) tuple likelihoods (DBN) """
+    def __init__(self, transcripts, map_states_to_phones, transitions,
+            scorer=None, likelihoods=None, beam=None):
+        self.transcripts = transcripts
+        self.map_states_to_phones = map_states_to_phones
+        self.transitions = transitions
+        self.scorer = scorer
+        self.likelihoods = likelihoods
+        self.beam = beam
+    def __call__(self, line):
+        cline = clean(line)
+        if VERBOSE:
+            print(cline)
+        phones = find_transcript(self.transcripts, cline)
+        if phones == None:
+            print("WARNING: no transcription for", cline, file=sys.stderr)
+            return ''
+        unknown = [phn for phn in phones if phn not in self.transitions[0]]
+        if len(unknown):
+            print("WARNING: no HMM for", unknown, "in", cline, file=sys.stderr)
+            return ''
+        if self.likelihoods != None:
+            start, end = self.likelihoods[1][cline]
+            likelihoods = self.likelihoods[0].array[start:end]
+        else:
+            likelihoods = self.scorer(cline)
+        segments = align(likelihoods, phones, self.transitions,
+                self.map_states_to_phones, beam=self.beam)
+        if segments == None:
+            print("WARNING: no alignment found for", cline, file=sys.stderr)
+            return ''
+        return '"' + cline[:-3] + 'lab"\n' + string_aligned_mlf(segments) \
+                + '.\n'
+
+
+def process(ofname, iscpfname, ihmmfname, imlffname,
+        idbnfname=None, idbndictstuple=None):
+    with open(ihmmfname) as ihmmf:
+        n_states, transitions, gmms = parse_hmm(ihmmf)
+    map_states_to_phones = phones_mapping(gmms)
+    with open(imlffname) as imlff:
+        transcripts = parse_mlf(imlff)
+    with open(iscpfname) as iscpf:
+        lines = iscpf.readlines()
+
+    scorer = load_scorer(gmms, map_states_to_phones, ihmmfname,
+            idbnfname=idbnfname, idbndictstuple=idbndictstuple)
+    likelihoods = None
+    if not scorer.per_file: # DBN, normalized on the whole scp
+        likelihoods = scorer.score_all([clean(line) for line in lines])
+        # shared with the workers, not pickled with every task
+        likelihoods = (SharedArray(likelihoods[0]), likelihoods[1])
+        scorer = None
+
+    print("aligning")
+    al = AlignLoop(transcripts, map_states_to_phones, transitions,
+            scorer=scorer, likelihoods=likelihoods,
+            beam=BEAM)
+    p = Pool(cpu_count())
+    clines = [clean(line) for line in lines]
+    costs = file_costs(clines)
+    if likelihoods != None:
+        costs = [likelihoods[1][cline][1] - likelihoods[1][cline][0]
+                for cline in clines]
+    job_stats = JobStats(cpu_count(), names=clines)
+    list_mlf_string = map_longest_first(p, al, lines, costs, stats=job_stats)
+    p.close()
+    p.join()
+    if likelihoods != None:
+        likelihoods[0].close()
+    job_stats.report("alignment")
+    with open(ofname, 'w') as of:
+        of.write('#!MLF!#\n')
+        for s in list_mlf_string:
+            of.write(s)
+    print("aligned", sum(1 for s in list_mlf_string if len(s)), "out of",
+            len(lines), "files in", ofname)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 4:
+        if '--help' in sys.argv:
+            print(usage)
+            sys.exit(0)
+        args = dict(enumerate(sys.argv))
+        options = [ind_x for ind_x in enumerate(sys.argv) if '--' in ind_x[1][0:2]]
+        dbn_fname = None # DBN cPickle
+        dbn_dicts_fname = None # DBN to_int and to_states dicts tuple
+        for ind, option in options:
+            args.pop(ind)
+            if option == '--v' or option == '--verbose':
+                VERBOSE = True
+            if option == '--beam':
+                BEAM = float(args[ind+1])
+                args.pop(ind+1)
+            if option == '--d':
+                if not (ind+2) in args:
+                    print("We need the DBN and the states/phones mapping", file=sys.stderr)
+                    print(usage, file=sys.stderr)
+                    sys.exit(-1)
+                dbn_fname = args[ind+1]
+                args.pop(ind+1)
+                print("will use the following DBN to estimate states likelihoods", dbn_fname)
+                dbn_dicts_fname = args[ind+2]
+                args.pop(ind+2)
+                print("and the following to_int / to_state dicts tuple", dbn_dicts_fname)
+        output_fname = list(args.values())[1]
+        input_scp_fname = list(args.values())[2]
+        input_hmm_fname = list(args.values())[3]
+        input_mlf_fname = list(args.values())[4]
+        process(output_fname, input_scp_fname, input_hmm_fname,
+                input_mlf_fname, dbn_fname, dbn_dicts_fname)
+    else:
+        print(usage)
+        sys.exit(-1)
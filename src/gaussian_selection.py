@@ -0,0 +1,244 @@
+"""
+Gaussian selection (VQ shortlists) for the GMM scorer.
+
+With the mixtures of the Makefile's TRMU steps (up to 17 components per
+state), scoring evaluates 186 x 17 Gaussians per frame although a frame is
+only close to a few of them. GaussianSelection quantizes the frames:
+
+    * offline, a k-means codebook is trained on the means of all the
+      Gaussians (scaled by the average standard deviations), and each
+      codeword gets a shortlist: the components that score within
+      SHORTLIST_BEAM of the best component of their state at the codeword,
+      for the states that score within FLOOR_BEAM of the best state there,
+    * at runtime, each frame only evaluates the shortlist of its nearest
+      codeword (one matrix multiply per codeword, as compute_log_likelihoods()
+      in scorers.py), the other states get a floor: their log likelihood at
+      the codeword.
+
+ShortlistScorer is the GmmScorer that scores with it (batch_viterbi.py --gs).
+
+usage (speed / accuracy report against the exact scoring):
+python gaussian_selection.py INPUT_SCP INPUT_HMM [--codewords N_CODEWORDS]
+        [--beam SHORTLIST_BEAM] [--floor FLOOR_BEAM]
+
+    reports the scoring times, the fraction of the Gaussians evaluated, the
+    errors on the state log likelihoods and the agreement of the best state
+    of each frame and of the Viterbi states paths (uniform phone bigram)
+    with those of the exact scoring
+"""
+
+import sys, os, time
+import numpy as np
+from scorers import GmmScorer, pack_gmms, quadratic_features, tie_states
+from scorers import segment_logsumexp, compute_log_likelihoods, gemm_frames
+
+N_CODEWORDS = 512 # size of the VQ codebook
+SHORTLIST_BEAM = 10.0 # log score beam of a component w.r.t. its state's best
+FLOOR_BEAM = 40.0 # states below the best one by more than that are floored
+KMEANS_ITERATIONS = 20 # Lloyd iterations of the codebook training
+SEED = 0 # random init of the codebook
+
+
+def gmm_components(gmms):
+    """ (means (C, D), variances (C, D), state of each component (C,)) of
+    all the Gaussians of gmms, in the order of pack_gmms() """
+    means = []
+    variances = []
+    states = []
+    state_id = 0
+    for _, gm in gmms.items():
+        for gm_st in gm:
+            for component in gm_st:
+                means.append(component[1])
+                variances.append(component[2])
+                states.append(state_id)
+            state_id += 1
+    return (np.array(means, dtype='float64'),
+            np.array(variances, dtype='float64'), np.array(states))
+
+
+def nearest(codebook, x):
+    """ index of the nearest codeword (Euclidean) of each line of x """
+    return np.argmax(np.dot(x, codebook.T)
+            - 0.5 * (codebook ** 2).sum(axis=1), axis=1)
+
+
+def kmeans(x, k, n_iterations=KMEANS_ITERATIONS, seed=SEED):
+    """ (k, D) codebook of the lines of x (Lloyd's algorithm) """
+    rng = np.random.RandomState(seed)
+    k = min(k, x.shape[0])
+    codebook = x[rng.choice(x.shape[0], k, replace=False)].copy()
+    for _ in range(n_iterations):
+        codes = nearest(codebook, x)
+        counts = np.bincount(codes, minlength=k)
+        sums = np.zeros(codebook.shape)
+        np.add.at(sums, codes, x)
+        filled = counts > 0 # empty cells keep their codeword
+        codebook[filled] = sums[filled] / counts[filled][:, None]
+    return codebook
+
+
+class GaussianSelection(object):
+    """ VQ codebook and per codeword shortlists of the GMMs gmms (from
+    parse_hmm()), see the module docstring """
+    def __init__(self, gmms, n_codewords=N_CODEWORDS, beam=SHORTLIST_BEAM,
+            floor_beam=FLOOR_BEAM, seed=SEED):
+        self.n_codewords = n_codewords
+        self.beam = beam
+        self.floor_beam = floor_beam
+        self.seed = seed
+        self.packed = pack_gmms(gmms)
+        weights, starts = self.packed
+        means, variances, self.states = gmm_components(gmms)
+        self.scale = 1.0 / np.sqrt(variances.mean(axis=0))
+        self.codebook = kmeans(means * self.scale, n_codewords, seed=seed)
+        densities = np.dot(quadratic_features(self.codebook / self.scale),
+                weights) # (K, C)
+        best_components = np.maximum.reduceat(densities, starts, axis=1)
+        self.floor = segment_logsumexp(densities, starts).astype('float32')
+        kept_states = self.floor >= (self.floor.max(axis=1)
+                - floor_beam)[:, None]
+        kept = (densities >= best_components[:, self.states] - beam) \
+                & kept_states[:, self.states]
+        self.shortlists = [np.flatnonzero(k) for k in kept]
+
+    def __repr__(self):
+        return "GaussianSelection: " + str(self.codebook.shape[0]) + \
+                " codewords, " + "%.1f" % np.mean([s.shape[0] for s in
+                    self.shortlists]) + " Gaussians per shortlist out of " + \
+                str(self.states.shape[0])
+
+    def codes(self, mat):
+        """ nearest codeword of each line of mat """
+        return nearest(self.codebook, np.asarray(mat, dtype='float64')
+                * self.scale)
+
+    def likelihoods(self, mat, budget=None):
+        """ (T, S) log likelihoods of the lines of mat, the shortlisted
+        Gaussians of their codeword only, the floor for the other states
+        (by chunks of lines within budget bytes, see gemm_frames()) """
+        weights, _ = self.packed
+        chunk = gemm_frames(self.packed, budget)
+        codes = self.codes(mat)
+        ret = self.floor[codes]
+        for start in range(0, mat.shape[0], chunk):
+            features = quadratic_features(mat[start:start+chunk])
+            chunk_codes = codes[start:start+chunk]
+            for c in np.unique(chunk_codes):
+                rows = start + np.flatnonzero(chunk_codes == c)
+                components = self.shortlists[c]
+                states = self.states[components]
+                firsts = np.flatnonzero(np.concatenate([[True],
+                    states[1:] != states[:-1]]))
+                ret[np.ix_(rows, states[firsts])] = segment_logsumexp(
+                        np.dot(features[rows - start], weights[:, components]),
+                        firsts)
+        return ret
+
+    def evaluated(self, mat):
+        """ fraction of the Gaussians evaluated for the lines of mat """
+        return np.mean([self.shortlists[c].shape[0] for c in
+            self.codes(mat)]) / self.states.shape[0]
+
+
+class ShortlistScorer(GmmScorer):
+    """ GmmScorer with Gaussian selection (a GaussianSelection of its tied
+    gmms, with the keyword arguments of GaussianSelection), the two-pass
+    active pairs (likelihoods_active()) are scored exactly """
+    def __init__(self, gmms, model_files=(), **kwargs):
+        GmmScorer.__init__(self, gmms, model_files)
+        self.selection = GaussianSelection(tie_states(gmms)[0], **kwargs)
+        print(self.selection)
+
+    def likelihoods(self, features):
+        return self.logical(self.selection.likelihoods(features,
+            budget=self.memory_budget))
+
+    def key(self, cache, clines=None):
+        s = self.selection
+        return cache.key(GmmScorer.key(self, cache, clines), 'shortlists',
+                s.n_codewords, s.beam, s.floor_beam, s.seed)
+
+
+def report(features, gmms, transitions, map_states_to_phones, **kwargs):
+    """ speed / accuracy of a GaussianSelection(gmms, **kwargs) against the
+    exact scoring on the list of features matrices (see the usage) """
+    from viterbi import viterbi
+    start = time.time()
+    selection = GaussianSelection(gmms, **kwargs)
+    print(selection, "built in", "%.2f s" % (time.time() - start))
+    packed = pack_gmms(gmms)
+    exact_time = 0.0
+    selection_time = 0.0
+    n_frames = 0
+    n_best = 0
+    n_path = 0
+    n_floored = 0
+    errors = []
+    evaluated = 0.0
+    for x in features:
+        start = time.time()
+        exact = compute_log_likelihoods(packed, x)
+        exact_time += time.time() - start
+        start = time.time()
+        selected = selection.likelihoods(x)
+        selection_time += time.time() - start
+        evaluated += selection.evaluated(x) * x.shape[0]
+        n_frames += x.shape[0]
+        best = exact.argmax(axis=1)
+        n_best += (selected.argmax(axis=1) == best).sum()
+        floored = selected == selection.floor[selection.codes(x)]
+        n_floored += floored.sum()
+        errors.append(np.abs(selected - exact)[~floored])
+        paths = [np.array([state for state, _ in viterbi(ll, transitions,
+            map_states_to_phones)[0]]) for ll in (exact, selected)]
+        n_path += (paths[0] == paths[1]).sum()
+    errors = np.concatenate(errors)
+    print("scoring:", "%.2f s exact," % exact_time, "%.2f s selected" %
+            selection_time, "(x%.1f)," % (exact_time / max(1E-9,
+                selection_time)), "%.1f%%" % (100.0 * evaluated / n_frames),
+            "of the Gaussians evaluated")
+    print("states log likelihoods: %.1f%% floored," % (100.0 * n_floored
+        / (n_frames * len(map_states_to_phones))), "abs error of the others",
+        "%.4f mean, %.4f max" % (errors.mean(), errors.max()))
+    print("best state of the frame: %.2f%% agree" % (100.0 * n_best
+        / n_frames))
+    print("Viterbi states: %.2f%% of the frames agree" % (100.0 * n_path
+        / n_frames))
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 2:
+        if '--help' in sys.argv:
+            print(__doc__)
+            sys.exit(0)
+        sys.path.append(os.getcwd())
+        import htkmfc
+        from viterbi import parse_hmm, phones_mapping, clean
+        from viterbi import initialize_transitions, penalty_scale
+        args = dict(enumerate(sys.argv))
+        options = [ind_x for ind_x in enumerate(sys.argv) if '--' in ind_x[1][0:2]]
+        kwargs = {}
+        for ind, option in options:
+            args.pop(ind)
+            if option == '--codewords':
+                kwargs['n_codewords'] = int(args[ind+1])
+                args.pop(ind+1)
+            if option == '--beam':
+                kwargs['beam'] = float(args[ind+1])
+                args.pop(ind+1)
+            if option == '--floor':
+                kwargs['floor_beam'] = float(args[ind+1])
+                args.pop(ind+1)
+        iscpfname = list(args.values())[1]
+        ihmmfname = list(args.values())[2]
+        with open(ihmmfname) as ihmmf:
+            _, transitions, gmms = parse_hmm(ihmmf)
+        transitions = penalty_scale(initialize_transitions(transitions))
+        with open(iscpfname) as iscpf:
+            features = [htkmfc.open(clean(line)).getall() for line in iscpf
+                    if len(clean(line))]
+        report(features, gmms, transitions, phones_mapping(gmms), **kwargs)
+    else:
+        print(__doc__)
+        sys.exit(-1)
@@ -0,0 +1,307 @@
+"""
+Phone lattices and N-best lists from the Viterbi decoder (viterbi.py,
+batch_viterbi.py), written / read as HTK Standard Lattice Format (SLF).
+
+build_lattice() works on the posteriors (T, S) and backpointers (T-1, S)
+returned by the viterbi_kernels.py recursions: a lattice node is the end
+(frame, state) of a phone, the phone is traced back through the
+backpointers to its entry frame, and every phone exit of the previous frame
+that enters it within LATTICE_BEAM of the best one (at most MAX_LINKS)
+becomes a link. As in HVite, links carry the acoustic log likelihood (a, HMM
+transitions included) of the phone they lead to and the (unscaled) log
+probability (l) of the transition between the two phones, so that the best
+path or N-best with another insertion penalty, grammar scale factor or
+bigram only costs a pass over the lattice.
+
+usage (rescoring):
+python lattice.py OUTPUT[.mlf] INPUT_LATTICES_SCP
+        [--p INSERTION_PENALTY] [--s SCALE_FACTOR] [--n N_BEST]
+        [--ub UNI&BIGRAM_LM --hmm INPUT_HMM]
+
+    --p / --s as in viterbi.py, replace those stored in the lattices
+    --n followed by the number of alternatives per utterance (/// separated)
+    --ub followed by a pickled bigram file (src/produce_LM.py) and --hmm by
+        the HMMs it was decoded with: replaces the phone transitions
+"""
+
+import sys, os, heapq
+import numpy as np
+
+FRAME_DURATION = 0.01 # in seconds (HTK TARGETRATE of 100000 x 100ns)
+HTK_FRAME = 100000 # FRAME_DURATION in HTK's 100ns units (MLF times)
+LATTICE_BEAM = 10.0 # log score beam w.r.t. the best predecessor of a phone
+MAX_LINKS = 5 # max number of predecessors kept for each phone (lattice depth)
+NULL = '!NULL' # HTK's label of the lattice start / end nodes
+
+
+class Lattice:
+    """ phone lattice: nodes[i] = (time in frames, phone), links[j] =
+    (start node, end node, a, l), topologically sorted (by time, the start
+    node is the first one and the end node the last one), a path scores
+        sum(a + lm_scale * l - penalty) over its links """
+    def __init__(self, name='', lm_scale=1.0, penalty=0.0):
+        self.name = name
+        self.lm_scale = lm_scale
+        self.penalty = penalty
+        self.nodes = []
+        self.links = []
+
+    def __repr__(self):
+        return "Lattice " + self.name + ": " + str(len(self.nodes)) + \
+                " nodes, " + str(len(self.links)) + " links"
+
+    def set_lm(self, transitions, epsilon_log=1E-80):
+        """ replaces the l of the links between phones with those of the
+        (not log, not scaled) transitions of viterbi.initialize_transitions """
+        phones = transitions[0]
+        links = []
+        for start, end, a, l in self.links:
+            phn1 = self.nodes[start][1]
+            phn2 = self.nodes[end][1]
+            if phn1 != NULL and phn2 != NULL:
+                l = np.log(transitions[1][phones[phn1].to_ind[-1]]
+                        [phones[phn2].to_ind[0]] + epsilon_log)
+            links.append((start, end, a, l))
+        self.links = links
+
+    def nbest(self, n=1, lm_scale=None, penalty=None):
+        """ returns the (at most) n best [(score, [(phone, start, end)])],
+        start and end in frames, paths with the same phones are merged,
+        lm_scale and penalty default to those of the decoding """
+        if lm_scale is None:
+            lm_scale = self.lm_scale
+        if penalty is None:
+            penalty = self.penalty
+        n_paths = 4 * n # more paths than asked, because of the merges
+        incoming = [[] for _ in self.nodes]
+        for j, (start, end, a, l) in enumerate(self.links):
+            incoming[end].append(j)
+        # best[i] = [(score, link to node i, rank in best[start of the link])]
+        best = [[] for _ in self.nodes]
+        best[0] = [(0.0, None, None)]
+        for i in range(1, len(self.nodes)):
+            candidates = []
+            for j in incoming[i]:
+                start, _, a, l = self.links[j]
+                score = a + lm_scale * l - penalty
+                for rank, (previous, _, _) in enumerate(best[start]):
+                    candidates.append((previous + score, j, rank))
+            best[i] = heapq.nlargest(n_paths, candidates,
+                    key=lambda c: c[0])
+        ret = []
+        seen = set()
+        for score, j, rank in best[-1]:
+            path = []
+            while j is not None:
+                start, end, _, _ = self.links[j]
+                if self.nodes[end][1] != NULL:
+                    path.append((self.nodes[end][1], self.nodes[start][0],
+                        self.nodes[end][0]))
+                _, j, rank = best[start][rank]
+            path.reverse()
+            phones = tuple(phn for phn, _, _ in path)
+            if phones in seen:
+                continue
+            seen.add(phones)
+            ret.append((score, path))
+            if len(ret) == n:
+                break
+        return ret
+
+    def write_slf(self, f):
+        f.write('VERSION=1.0\n')
+        f.write('UTTERANCE=' + self.name + '\n')
+        f.write('lmscale=' + str(self.lm_scale) + ' wdpenalty='
+                + str(-self.penalty) + '\n')
+        f.write('N=' + str(len(self.nodes)) + ' L=' + str(len(self.links))
+                + '\n')
+        for i, (time, phn) in enumerate(self.nodes):
+            f.write('I=' + str(i) + ' t=' + '%.2f' % (time * FRAME_DURATION)
+                    + ' W=' + phn + '\n')
+        for j, (start, end, a, l) in enumerate(self.links):
+            f.write('J=' + str(j) + ' S=' + str(start) + ' E=' + str(end)
+                    + ' a=' + '%.4f' % a + ' l=' + '%.4f' % l + '\n')
+
+
+def read_slf(f):
+    """ reads a Lattice written by Lattice.write_slf() (or HVite's, with
+    nodes and links in topological order) """
+    lattice = Lattice()
+    for line in f:
+        fields = dict(field.split('=', 1) for field in line.split()
+                if '=' in field)
+        if 'UTTERANCE' in fields:
+            lattice.name = fields['UTTERANCE']
+        if 'lmscale' in fields:
+            lattice.lm_scale = float(fields['lmscale'])
+        if 'wdpenalty' in fields:
+            lattice.penalty = -float(fields['wdpenalty'])
+        if 'I' in fields:
+            lattice.nodes.append((int(round(float(fields['t'])
+                / FRAME_DURATION)), fields.get('W', NULL)))
+        if 'J' in fields:
+            lattice.links.append((int(fields['S']), int(fields['E']),
+                float(fields.get('a', 0.0)), float(fields.get('l', 0.0))))
+    return lattice
+
+
+def build_lattice(posteriors, backpointers, transitions, init,
+        ending_state=None, scale_factor=1.0, insertion_penalty=0.0,
+        lattice_beam=LATTICE_BEAM, max_links=MAX_LINKS, name=''):
+    """ builds the Lattice of the phones sequences that survived the
+    Viterbi (see module docstring), transitions are the log transitions of
+    viterbi.penalty_scale (from which l is unscaled), init the initial log
+    scores, ending_state the final state (if any, else the best state of
+    each phone at the last frame, within the lattice beam) """
+    phones = sorted(transitions[0].values(), key=lambda phone: phone.phn_id)
+    log_trans = transitions[1]
+    n_frames, n_states = posteriors.shape
+    entries = np.array([phone.to_ind[0] for phone in phones])
+    exits = np.array([phone.to_ind[-1] for phone in phones])
+    phone_of_state = np.zeros(n_states, dtype='int64')
+    for p, phone in enumerate(phones):
+        phone_of_state[phone.to_ind] = p
+    is_exit = np.zeros(n_states, dtype=bool)
+    is_exit[exits] = True
+
+    lattice = Lattice(name, lm_scale=scale_factor, penalty=insertion_penalty)
+    lattice.nodes.append((0, NULL))
+    node_ids = {} # node_ids[(end frame, end state)] = node id
+    to_expand = []
+    def node(frame, state):
+        if (frame, state) not in node_ids:
+            node_ids[(frame, state)] = len(lattice.nodes)
+            lattice.nodes.append((frame + 1, phones[phone_of_state[state]].phn))
+            to_expand.append((frame, state))
+        return node_ids[(frame, state)]
+
+    last = posteriors[-1]
+    if ending_state is not None and last[ending_state] > -np.inf:
+        final_states = [ending_state]
+    else:
+        final_states = [phone.to_ind[last[phone.to_ind].argmax()]
+                for phone in phones]
+        final_states = [state for state in final_states
+                if last[state] >= last.max() - lattice_beam]
+        final_states.sort(key=lambda state: -last[state])
+        final_states = final_states[:max_links]
+    final_links = [node(n_frames - 1, state) for state in final_states]
+
+    while len(to_expand):
+        frame, state = to_expand.pop()
+        end = node_ids[(frame, state)]
+        score = posteriors[frame][state]
+        p = phone_of_state[state]
+        while frame > 0: # trace the phone back to its entry frame
+            previous = backpointers[frame - 1][state]
+            if phone_of_state[previous] != p or (state == entries[p]
+                    and is_exit[previous] and previous != state):
+                break
+            state = previous
+            frame -= 1
+        if frame == 0:
+            lattice.links.append((0, end, score - init[state], init[state]))
+            continue
+        previous = backpointers[frame - 1][state]
+        a = score - posteriors[frame - 1][previous] \
+                - log_trans[previous][state]
+        candidates = posteriors[frame - 1][exits] + log_trans[exits, state]
+        candidates[exits == state] = -np.inf # 1 state phone: not a new phone
+        best = candidates.max()
+        for q in np.argsort(-candidates)[:max_links]:
+            if candidates[q] == -np.inf or \
+                    candidates[q] < best - lattice_beam:
+                break
+            l = (log_trans[exits[q]][state] + insertion_penalty) \
+                    / scale_factor
+            lattice.links.append((node(frame - 1, exits[q]), end, a, l))
+
+    lattice.nodes.append((n_frames, NULL))
+    for start in final_links:
+        lattice.links.append((start, len(lattice.nodes) - 1, 0.0, 0.0))
+
+    # topological (time) order, stable so that the start / end stay in place
+    order = sorted(range(len(lattice.nodes)),
+            key=lambda i: lattice.nodes[i][0])
+    new_id = np.empty(len(order), dtype='int64')
+    new_id[order] = np.arange(len(order))
+    lattice.nodes = [lattice.nodes[i] for i in order]
+    lattice.links = sorted([(int(new_id[start]), int(new_id[end]), a, l)
+        for start, end, a, l in lattice.links], key=lambda link: link[1])
+    return lattice
+
+
+def string_nbest(nbest):
+    """ MLF "start end phone" lines of the N-best phones strings, separated
+    by /// (HTK) """
+    return '///\n'.join(''.join('%d %d %s\n' % (start * HTK_FRAME,
+        end * HTK_FRAME, phn) for phn, start, end in path)
+            for _, path in nbest)
+
+
+def lattice_fname(lattice_dir, cline):
+    """ lattice file of the features file cline, in lattice_dir """
+    return os.path.join(lattice_dir,
+            os.path.splitext(os.path.basename(cline))[0] + '.lat')
+
+
+def process(ofname, iscpfname, insertion_penalty=None, scale_factor=None,
+        n_best=1, transitions=None):
+    with open(iscpfname) as iscpf, open(ofname, 'w') as of:
+        of.write('#!MLF!#\n')
+        for line in iscpf:
+            cline = line.strip()
+            with open(cline) as f:
+                lattice = read_slf(f)
+            if transitions is not None:
+                lattice.set_lm(transitions)
+            nbest = lattice.nbest(n_best, lm_scale=scale_factor,
+                    penalty=insertion_penalty)
+            of.write('"' + os.path.splitext(cline)[0] + '.rec"\n')
+            of.write(string_nbest(nbest) + '.\n')
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 2:
+        if '--help' in sys.argv:
+            print(__doc__)
+            sys.exit(0)
+        args = dict(enumerate(sys.argv))
+        options = [ind_x for ind_x in enumerate(sys.argv) if '--' in ind_x[1][0:2]]
+        insertion_penalty = None
+        scale_factor = None
+        n_best = 1
+        input_unibi_fname = None
+        input_hmm_fname = None
+        for ind, option in options:
+            args.pop(ind)
+            if option == '--p':
+                insertion_penalty = float(args[ind+1])
+                args.pop(ind+1)
+            if option == '--s':
+                scale_factor = float(args[ind+1])
+                args.pop(ind+1)
+            if option == '--n':
+                n_best = int(args[ind+1])
+                args.pop(ind+1)
+            if option == '--ub':
+                input_unibi_fname = args[ind+1]
+                args.pop(ind+1)
+            if option == '--hmm':
+                input_hmm_fname = args[ind+1]
+                args.pop(ind+1)
+        transitions = None
+        if input_unibi_fname != None:
+            if input_hmm_fname == None:
+                print("--ub needs the HMMs (--hmm)", file=sys.stderr)
+                sys.exit(-1)
+            from viterbi import parse_hmm, initialize_transitions
+            with open(input_hmm_fname) as ihmmf:
+                _, transitions, _ = parse_hmm(ihmmf)
+            with open(input_unibi_fname, 'rb') as ubf:
+                transitions = initialize_transitions(transitions, ubf)
+        process(list(args.values())[1], list(args.values())[2],
+                insertion_penalty, scale_factor, n_best, transitions)
+    else:
+        print(__doc__)
+        sys.exit(-1)
@@ -0,0 +1,290 @@
+"""
+Word decoding with an HTK pronunciation dictionary on a lexical prefix tree.
+
+The words of the dict (WORD [OUTSYM] [PROB] PHONE1 PHONE2 ...) are put in a
+tree of phones where the pronunciations share their prefixes: one node per
+distinct prefix, each node owns a copy of the HMM of its last phone. The
+number of decoding states is then sum_{nodes} states(phone) instead of
+sum_{pronunciations} sum_{phones} states(phone), and the word identity is
+only known at the node ending its pronunciation(s).
+
+The word bigram (ARPA, e.g. from HLStats -b or produce_LM.py) is applied at
+the word ends, on the predecessor word carried by each active state. As in
+one pass tree decoders without tree copies, the tree is entered from the best
+word end of the frame only ("1-best" approximation: the predecessor is chosen
+before the next word is known).
+
+The search is the same frame synchronous vectorized Viterbi (with beam /
+max_active pruning) as for the phones: LexiconTree has the pred_from /
+pred_logp band of a Topology, the tree arcs being predecessors of the
+children entries.
+
+usage: python batch_viterbi.py ... --dict DICT [--wlm WORD_LM.arpa]
+"""
+
+import sys, math
+import numpy as np
+from viterbi_kernels import LOG_ZERO, prune
+from ngram_lm import LN10
+
+SENTENCE_BOUNDARIES = [('<s>', '</s>'), ('!ENTER', '!EXIT'),
+        ('!SENT_START', '!SENT_END')] # (start, end) symbols tried in the LM
+LOG10_UNKNOWN = -99.0 # log10 proba of words not in the LM (nor <unk>)
+HTK_FRAME = 100000 # duration of a frame in HTK's 100ns units (TARGETRATE)
+
+
+class Pronunciation:
+    def __init__(self, word, output, log_prob, phones):
+        self.word = word
+        self.output = output # printed symbol ('' for [] words)
+        self.log_prob = log_prob
+        self.phones = phones
+
+    def __repr__(self):
+        return self.word + ": " + ' '.join(self.phones)
+
+
+def parse_dict(f, phones=None):
+    """ parse the HTK dictionary f, returns the list of Pronunciation (the
+    ones with phones not in phones, if given, are left out) """
+    prons = []
+    unknown = set()
+    for line in f:
+        l = line.split()
+        if not len(l):
+            continue
+        word = l[0]
+        output = word
+        i = 1
+        if i < len(l) and l[i].startswith('['):
+            while not l[i].endswith(']'):
+                i += 1
+            output = ' '.join(l[1:i+1])[1:-1]
+            i += 1
+        log_prob = 0.0
+        try:
+            log_prob = math.log(float(l[i]))
+            i += 1
+        except (ValueError, IndexError):
+            pass
+        pron = l[i:]
+        if not len(pron):
+            continue
+        if phones != None and any(phn not in phones for phn in pron):
+            unknown.update(phn for phn in pron if phn not in phones)
+            continue
+        prons.append(Pronunciation(word, output, log_prob, pron))
+    if len(unknown):
+        print("WARNING: left out the words with the phones", sorted(unknown),
+                "(no HMM)", file=sys.stderr)
+    print("Parsed", len(prons), "pronunciations of",
+            len(set(p.word for p in prons)), "words")
+    return prons
+
+
+class LexiconTree:
+    """ prefix tree of the pronunciations on the HMMs (module docstring):
+        * states[g]: HMM state of graph state g, pred_from / pred_logp: the
+          intra-phone band and the parent exit -> child entry arcs,
+        * firsts: entries of the nodes of the first phones (tree roots),
+        * per pronunciation e: end_state[e] (exit of its last node),
+          end_word[e] and end_logp[e] (HMM exit + pronunciation log proba),
+        * words (names), outputs, and the scaled word bigram (see lm_logp)
+    """
+    def __init__(self, prons, transitions, lm=None, insertion_penalty=0.0,
+            scale_factor=1.0):
+        phones, probs = transitions
+        self.words = sorted(set(p.word for p in prons))
+        word_index = dict((w, i) for i, w in enumerate(self.words))
+        self.outputs = [''] * len(self.words)
+        for p in prons:
+            self.outputs[word_index[p.word]] = p.output
+        self.insertion_penalty = insertion_penalty
+
+        nodes = {} # phones prefix tuple -> (entry, exit, log exit proba)
+        states = []
+        preds = []
+        firsts = []
+        end_state, end_word, end_logp = [], [], []
+        for p in sorted(prons, key=lambda p: p.phones):
+            for k in range(1, len(p.phones) + 1):
+                prefix = tuple(p.phones[:k])
+                if prefix in nodes:
+                    continue
+                ind = phones[prefix[-1]].to_ind
+                block = probs[np.ix_(ind, ind)]
+                offset = len(states)
+                for j in range(len(ind)):
+                    preds.append([(offset + i, math.log(block[i, j]))
+                        for i in range(len(ind)) if block[i, j] > 0.0])
+                if k > 1: # arc from the exit of the parent
+                    parent_exit, parent_logp = nodes[prefix[:-1]][1:]
+                    preds[offset].append((parent_exit, parent_logp))
+                else:
+                    firsts.append(offset)
+                states.extend(ind)
+                nodes[prefix] = (offset, offset + len(ind) - 1,
+                        math.log(max(1E-30, 1.0 - block[-1].sum())))
+            _, exit, exit_logp = nodes[tuple(p.phones)]
+            end_state.append(exit)
+            end_word.append(word_index[p.word])
+            end_logp.append(exit_logp + p.log_prob)
+        self.n_nodes = len(nodes)
+        self.states = np.array(states, dtype='int64')
+        self.n_states = len(states)
+        n_preds = max(len(p) for p in preds)
+        self.pred_from = np.zeros((self.n_states, n_preds), dtype='int64')
+        self.pred_logp = np.ndarray((self.n_states, n_preds), dtype='float64')
+        self.pred_logp[:] = LOG_ZERO
+        for j, p in enumerate(preds):
+            for i, (k, logp) in enumerate(p):
+                self.pred_from[j, i] = k
+                self.pred_logp[j, i] = logp
+        self.firsts = np.array(firsts, dtype='int64')
+        self.end_state = np.array(end_state, dtype='int64')
+        self.end_word = np.array(end_word, dtype='int64')
+        self.end_logp = np.array(end_logp, dtype='float64')
+        self.set_lm(lm, scale_factor)
+
+    def set_lm(self, lm, scale_factor=1.0):
+        """ scaled log word bigram: history h (word index, or start, the
+        last index) -> w is bigram_logp at key h*(V+1)+w in bigram_keys
+        (sorted) if listed, bow_logp[h] + uni_logp[w] otherwise. final_logp
+        is the log proba of the sentence end after each word """
+        n_words = len(self.words)
+        self.start = n_words # history index of the sentence start
+        self.uni_logp = np.ndarray(n_words, dtype='float64')
+        self.bow_logp = np.zeros(n_words + 1, dtype='float64')
+        self.final_logp = np.zeros(n_words, dtype='float64')
+        self.bigram_keys = np.zeros(0, dtype='int64')
+        self.bigram_logp = np.zeros(0, dtype='float64')
+        if lm == None: # uniform over the words
+            self.uni_logp[:] = -math.log(n_words) * scale_factor
+            return
+        start, end = None, None
+        for s, e in SENTENCE_BOUNDARIES:
+            if (s,) in lm.log10probs:
+                start, end = s, e
+                break
+        unk = lm.log10probs.get(('<unk>',), LOG10_UNKNOWN)
+        missing = [w for w in self.words if (w,) not in lm.log10probs]
+        if len(missing):
+            print("WARNING:", len(missing), "words of the dict are not in the",
+                    "LM, e.g.", missing[:5], file=sys.stderr)
+        scale = scale_factor * LN10
+        history_index = dict((w, i) for i, w in enumerate(self.words))
+        if start != None:
+            history_index[start] = self.start
+        for i, w in enumerate(self.words):
+            self.uni_logp[i] = scale * lm.log10probs.get((w,), unk)
+            if end != None:
+                self.final_logp[i] = scale * lm.log10prob((w,), end)
+        for h, i in history_index.items():
+            self.bow_logp[i] = scale * lm.log10bows.get((h,), 0.0)
+        keys, logps = [], []
+        for ngram, log10prob in lm.log10probs.items():
+            if len(ngram) == 2 and ngram[0] in history_index \
+                    and ngram[1] in history_index and ngram[1] != start:
+                keys.append(history_index[ngram[0]] * (n_words + 1)
+                        + history_index[ngram[1]])
+                logps.append(scale * log10prob)
+        order = np.argsort(keys)
+        self.bigram_keys = np.array(keys, dtype='int64')[order]
+        self.bigram_logp = np.array(logps, dtype='float64')[order]
+
+    def lm_logp(self, histories, words):
+        """ scaled log P(words | histories), vectorized """
+        keys = histories * (len(self.words) + 1) + words
+        logp = self.bow_logp[histories] + self.uni_logp[words]
+        if self.bigram_keys.shape[0]:
+            pos = np.minimum(np.searchsorted(self.bigram_keys, keys),
+                    self.bigram_keys.shape[0] - 1)
+            found = self.bigram_keys[pos] == keys
+            logp[found] = self.bigram_logp[pos[found]]
+        return logp
+
+    def __repr__(self):
+        return "LexiconTree: " + str(len(self.words)) + " words, " + \
+                str(self.end_state.shape[0]) + " pronunciations, " + \
+                str(self.n_nodes) + " nodes, " + str(self.n_states) + " states"
+
+
+def word_ends(tree, prev, histories):
+    """ best word end of the frame: (score, word, graph state) """
+    active = np.flatnonzero(prev[tree.end_state] > LOG_ZERO)
+    if not active.shape[0]:
+        return LOG_ZERO, -1, -1
+    ends = tree.end_state[active]
+    words = tree.end_word[active]
+    scores = prev[ends] + tree.end_logp[active] + \
+            tree.lm_logp(histories[ends], words) - tree.insertion_penalty
+    best = scores.argmax()
+    return scores[best], words[best], ends[best]
+
+
+def viterbi_words(likelihoods, tree, beam=None, max_active=None, stats=None):
+    """ best words sequence of the (T, S) HMM states likelihoods through the
+    LexiconTree, returns a list of (word index, first frame, last frame) """
+    likelihoods = likelihoods[:, tree.states]
+    n_frames = likelihoods.shape[0]
+    rows = np.arange(tree.n_states)
+    backpointers = np.ndarray((n_frames, tree.n_states), dtype='int64')
+    entered = np.zeros(n_frames, dtype='int64') # word ended before frame t
+    prev = np.ndarray(tree.n_states, dtype='float64')
+    prev[:] = LOG_ZERO
+    prev[tree.firsts] = 0.0
+    prev += likelihoods[0]
+    histories = np.ndarray(tree.n_states, dtype='int64')
+    histories[:] = tree.start
+    backpointers[0] = -1
+    n_active = prune(prev, beam, max_active)
+    for t in range(1, n_frames):
+        root, word, root_from = word_ends(tree, prev, histories)
+        cand = prev[tree.pred_from] + tree.pred_logp
+        k = cand.argmax(axis=-1)
+        scores = cand[rows, k]
+        bp = tree.pred_from[rows, k]
+        histories = histories[bp]
+        better = tree.firsts[root > scores[tree.firsts]]
+        scores[better] = root
+        bp[better] = -2 - root_from # entered from the word end root_from
+        histories[better] = word
+        entered[t] = word
+        scores += likelihoods[t]
+        backpointers[t] = bp
+        n_active += prune(scores, beam, max_active)
+        prev = scores
+    if stats is not None:
+        stats['frames'] = stats.get('frames', 0) + n_frames
+        stats['active'] = stats.get('active', 0) + n_active
+
+    final = prev[tree.end_state] + tree.end_logp + tree.lm_logp(
+            histories[tree.end_state], tree.end_word) + \
+                    tree.final_logp[tree.end_word]
+    if final.max() > LOG_ZERO:
+        state = tree.end_state[final.argmax()]
+        word = tree.end_word[final.argmax()]
+    else:
+        print("WARNING: no word end survived the pruning", file=sys.stderr)
+        state = prev.argmax()
+        word = -1 # unfinished last word, not output
+    words = []
+    last = n_frames - 1
+    for t in range(n_frames - 1, 0, -1):
+        bp = backpointers[t][state]
+        if bp <= -2: # word boundary between t-1 and t
+            words.append((word, t, last))
+            word = entered[t]
+            last = t - 1
+            state = -2 - bp
+        else:
+            state = bp
+    words.append((word, 0, last))
+    return [w for w in words[::-1] if w[0] >= 0]
+
+
+def string_words(tree, words):
+    """ MLF body of the words, "start end word" lines (the [] output
+    symbols are not printed) """
+    return ''.join('%d %d %s\n' % (first * HTK_FRAME, (last + 1) * HTK_FRAME,
+        tree.outputs[w]) for w, first, last in words if len(tree.outputs[w]))
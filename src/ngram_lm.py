@@ -0,0 +1,248 @@
+"""
+N-gram (any order) ARPA backoff phone language models for the decoder.
+
+parse_lm() / parse_lm_matrix() flatten a bigram into the S x S transitions
+matrix. For n >= 3 the phone alone is not the LM state anymore and a dense
+expansion would be (S.P^(n-2))^2, so the decoding graph (LMGraph) only
+materializes the histories listed in the ARPA file:
+
+    * one LM state per listed k-gram (k < n) plus the empty history (root),
+      each LM state but the root owns a copy of the HMM of its last phone,
+    * one arc per listed n-gram h.q, from LM state h to the copy of the LM
+      state of the longest listed suffix of h.q, with log P(q|h),
+    * one backoff arc per LM state h to its longest listed proper suffix,
+      with the backoff weight of h.
+
+Backoff is applied on the fly at each frame by lm_step(): the phone exits
+scores go up the backoff arcs (highest order first) before going through
+the n-gram arcs, so the graph has O(#n-grams) arcs. The scores are kept
+per (LM state, next phone) and a history only backs off for the phones it
+does not list (Katz: the explicit n-gram is the only way to its phone), so
+the decoding is exact: an order 2 LM gives the path of the dense bigram
+transitions (see regression.py).
+
+As penalty_scale() does for the bigram transitions, the arcs carry
+scale_factor * log(HMM exit proba * LM proba) - insertion_penalty.
+
+usage: python batch_viterbi.py ... --ngram LM.arpa, LMs can
+be produced with produce_LM.py train.mlf --order N
+"""
+
+import sys, math, functools
+import numpy as np
+from viterbi_kernels import LOG_ZERO, run_viterbi, traceback
+
+LN10 = math.log(10.0) # ARPA files are in log10
+START = '!ENTER' # sentence start / end phones (as in the MLFs)
+END = '!EXIT'
+
+
+class NGramLM:
+    """ ARPA backoff LM: log10probs[ngram tuple], log10bows[ngram tuple] """
+    def __init__(self, order, log10probs, log10bows):
+        self.order = order
+        self.log10probs = log10probs
+        self.log10bows = log10bows
+
+    def __repr__(self):
+        return "NGramLM: order " + str(self.order) + ", " + \
+                str(len(self.log10probs)) + " n-grams"
+
+    def log10prob(self, history, phone):
+        """ Katz backoff log10 P(phone | history) """
+        history = tuple(history)[max(0, len(history) - self.order + 1):]
+        backoff = 0.0
+        while True:
+            ngram = history + (phone,)
+            if ngram in self.log10probs:
+                return backoff + self.log10probs[ngram]
+            if not len(history):
+                return LOG_ZERO
+            backoff += self.log10bows.get(history, 0.0)
+            history = history[1:]
+
+
+def parse_arpa(f):
+    """ parse the ARPA (MIT-LL, any order) backoff LM in f """
+    log10probs = {}
+    log10bows = {}
+    order = 0
+    n = 0
+    for line in f:
+        line = line.strip()
+        if not len(line):
+            continue
+        if line.startswith('\\') and line.endswith('-grams:'):
+            n = int(line[1:line.index('-')])
+            order = max(order, n)
+        elif line == '\\end\\':
+            break
+        elif n > 0:
+            l = line.split()
+            if len(l) < n + 1:
+                print("bad language model file format", line, file=sys.stderr)
+                sys.exit(-1)
+            ngram = tuple(l[1:n+1])
+            log10probs[ngram] = float(l[0])
+            if len(l) > n + 1:
+                log10bows[ngram] = float(l[n+1])
+    lm = NGramLM(order, log10probs, log10bows)
+    print("Parsed", lm)
+    return lm
+
+
+class LMGraph:
+    """ decoding graph of an NGramLM on the HMMs (see the module docstring):
+        * states[g]: HMM state of graph state g, pred_from / pred_logp: the
+          intra-phone band (as in Topology),
+        * per LM state c: exits[c] / entries[c] (-1 for the root), exit_logp
+          (scaled log exit proba of the HMM), parent[c] (backoff LM state)
+          and bow_logp[c] (scaled log backoff weight),
+        * levels: LM states of each order, highest order first,
+        * arcs: arc_from / arc_to (LM states), arc_phone (index in vocab of
+          the phone of the n-gram), arc_logp,
+        * listed[c, q]: LM state c lists the n-gram c.vocab[q] (no backoff
+          for that phone),
+        * init (log scores at t=0) and ends (graph states that can end)
+    """
+    def __init__(self, lm, transitions, insertion_penalty=0.0,
+            scale_factor=1.0):
+        phones, probs = transitions
+        unknown = set(w for ngram in lm.log10probs for w in ngram
+                if w not in phones)
+        if len(unknown):
+            print("WARNING: ignoring the n-grams with", sorted(unknown),
+                    "(no HMM)", file=sys.stderr)
+        known = lambda ngram: all(w in phones for w in ngram)
+        self.contexts = [()] + sorted((ngram for ngram in lm.log10probs
+            if len(ngram) < lm.order and known(ngram)),
+            key=lambda ngram: (len(ngram), ngram))
+        index = dict((c, i) for i, c in enumerate(self.contexts))
+        n_contexts = len(self.contexts)
+
+        def state_of(ngram): # LM state reached after ngram
+            ngram = ngram[max(0, len(ngram) - lm.order + 1):]
+            while ngram not in index:
+                ngram = ngram[1:]
+            return index[ngram]
+
+        states = []
+        preds = []
+        self.exits = -np.ones(n_contexts, dtype='int64')
+        self.entries = -np.ones(n_contexts, dtype='int64')
+        self.exit_logp = np.zeros(n_contexts, dtype='float64')
+        self.parent = np.zeros(n_contexts, dtype='int64')
+        self.bow_logp = np.zeros(n_contexts, dtype='float64')
+        for c, context in enumerate(self.contexts[1:], 1):
+            ind = phones[context[-1]].to_ind
+            block = probs[np.ix_(ind, ind)]
+            offset = len(states)
+            for j in range(len(ind)):
+                preds.append([(offset + k, math.log(block[k, j]))
+                    for k in range(len(ind)) if block[k, j] > 0.0])
+            states.extend(ind)
+            self.entries[c] = offset
+            self.exits[c] = offset + len(ind) - 1
+            self.exit_logp[c] = scale_factor * math.log(max(1E-30,
+                1.0 - block[-1].sum()))
+            self.parent[c] = state_of(context[1:])
+            self.bow_logp[c] = scale_factor * LN10 * lm.log10bows.get(
+                    context, 0.0)
+        self.states = np.array(states, dtype='int64')
+        self.n_states = len(states)
+        n_preds = max(1, max(len(p) for p in preds))
+        self.pred_from = np.zeros((self.n_states, n_preds), dtype='int64')
+        self.pred_logp = np.ndarray((self.n_states, n_preds), dtype='float64')
+        self.pred_logp[:] = LOG_ZERO
+        for j, p in enumerate(preds):
+            for i, (k, logp) in enumerate(p):
+                self.pred_from[j, i] = k
+                self.pred_logp[j, i] = logp
+        lengths = np.array([len(c) for c in self.contexts])
+        self.levels = [np.flatnonzero(lengths == n)
+                for n in range(lm.order - 1, 0, -1)]
+
+        ngrams = [(ngram, log10prob) for ngram, log10prob in
+                lm.log10probs.items() if known(ngram) and ngram[:-1] in index]
+        self.vocab = sorted(set(ngram[-1] for ngram, _ in ngrams))
+        phone_index = dict((phn, q) for q, phn in enumerate(self.vocab))
+        self.listed = np.zeros((n_contexts, len(self.vocab)), dtype=bool)
+        for ngram, _ in ngrams:
+            self.listed[index[ngram[:-1]], phone_index[ngram[-1]]] = True
+        arcs = [(index[ngram[:-1]], state_of(ngram), phone_index[ngram[-1]],
+            scale_factor * LN10 * log10prob - insertion_penalty)
+            for ngram, log10prob in ngrams if log10prob > -99.0]
+        self.arc_from = np.array([a[0] for a in arcs], dtype='int64')
+        self.arc_to = np.array([a[1] for a in arcs], dtype='int64')
+        self.arc_phone = np.array([a[2] for a in arcs], dtype='int64')
+        self.arc_logp = np.array([a[3] for a in arcs], dtype='float64')
+        self.origin = np.repeat(self.exits[:, None], len(self.vocab), axis=1)
+
+        self.init = np.ndarray(self.n_states, dtype='float64')
+        self.init[:] = LOG_ZERO
+        if (START,) in index:
+            self.init[self.entries[index[(START,)]]] = 0.0
+        else: # unigram of the first phone
+            root = self.arc_from == 0
+            self.init[self.entries[self.arc_to[root]]] = self.arc_logp[root]
+        self.ends = np.array([self.exits[c] for c, context in
+            enumerate(self.contexts) if len(context) and context[-1] == END],
+            dtype='int64')
+        if not self.ends.shape[0]:
+            self.ends = np.arange(self.n_states)
+
+    def __repr__(self):
+        return "LMGraph: " + str(self.n_states) + " states, " + \
+                str(len(self.contexts)) + " LM states, " + \
+                str(self.arc_from.shape[0]) + " n-gram arcs"
+
+
+def lm_step(graph, prev, likelihoods_t):
+    """ one frame of the Viterbi recursion on the LMGraph, prev being the
+    (S_graph,) scores. Returns (scores, backpointers) for this frame """
+    g = graph
+    cand = prev[g.pred_from] + g.pred_logp # intra-phone band
+    k = cand.argmax(axis=-1)
+    rows = np.arange(g.n_states)
+    scores = cand[rows, k]
+    bp = g.pred_from[rows, k]
+    # best phone exit reaching each (LM state, next phone), up the backoff
+    # arcs of the histories that do not list that phone
+    reach = np.ndarray(g.listed.shape, dtype='float64')
+    reach[0] = LOG_ZERO
+    reach[1:] = (prev[g.exits[1:]] + g.exit_logp[1:])[:, None]
+    origin = g.origin.copy()
+    for level in g.levels:
+        backoff = reach[level] + g.bow_logp[level][:, None]
+        backoff[g.listed[level]] = LOG_ZERO
+        parents = g.parent[level]
+        np.maximum.at(reach, parents, backoff)
+        rows, phones = np.nonzero((backoff == reach[parents, :])
+                & (backoff > LOG_ZERO))
+        origin[parents[rows], phones] = origin[level[rows], phones]
+    # n-gram arcs to the entries of the LM states copies
+    arc_scores = reach[g.arc_from, g.arc_phone] + g.arc_logp
+    best = np.ndarray(g.exits.shape[0], dtype='float64')
+    best[:] = LOG_ZERO
+    np.maximum.at(best, g.arc_to, arc_scores)
+    won = (arc_scores == best[g.arc_to]) & (arc_scores > LOG_ZERO)
+    best_from = np.zeros(g.exits.shape[0], dtype='int64')
+    best_from[g.arc_to[won]] = origin[g.arc_from[won], g.arc_phone[won]]
+    entries = g.entries[1:]
+    better = best[1:] > scores[entries]
+    scores[entries[better]] = best[1:][better]
+    bp[entries[better]] = best_from[1:][better]
+    scores += likelihoods_t
+    return scores, bp
+
+
+def viterbi_ngram(likelihoods, graph, beam=None, max_active=None, stats=None):
+    """ best path of the (T, S) HMM states likelihoods through the LMGraph,
+    returns the list of (HMM state, score) per frame (as viterbi()) """
+    likelihoods = likelihoods[:, graph.states]
+    posteriors, backpointers = run_viterbi(likelihoods,
+            functools.partial(lm_step, graph), graph.init, beam=beam,
+            max_active=max_active, stats=stats)
+    last = graph.ends[posteriors[-1][graph.ends].argmax()]
+    path = traceback(backpointers, last)
+    return [(graph.states[g], posteriors[i][g]) for i, g in enumerate(path)]
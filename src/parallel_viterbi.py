@@ -0,0 +1,167 @@
+"""
+Viterbi of one long utterance on all the workers of a Pool.
+
+The recursion v_t = (v_{t-1} (x) A) + l_t is a product of max-plus matrices
+(x: max-plus product, A: log transitions, l_t: likelihoods of frame t), so
+the frames can be cut in blocks that are scanned in parallel if each block
+knows the scores entering it. It does not need them exactly: max-plus
+products of many transition matrices quickly have rank 1 ("rank
+convergence", Maleki et al., PPoPP 2014), i.e. after a few frames the scores
+of a block started from any vector are the exact ones plus a constant, and
+the backpointers (argmax), the pruning (relative to the best score) and thus
+the path are the same. Hence the blocked scan:
+
+    1. forward in parallel: each block is scanned from a guess (log uniform
+       scores, the real init for the first block), its scores and
+       backpointers go to memmap files shared with the workers,
+    2. fix-up in order: each block is re-scanned from the exact scores of
+       the end of the previous block until its scores are parallel to the
+       stored ones (usually a few frames), the rest of the block only gets
+       the constant offset,
+    3. traceback on the backpointers of the whole utterance.
+
+The path is the one of run_viterbi() + traceback(), up to floating point
+ties, for T.S work (plus the fix-up frames) spread on the blocks instead of
+a sequential pass over T. A block that never converges is re-scanned
+entirely, as it would be by the sequential recursion: without pruning, the
+states only reachable from the initial scores (!ENTER) keep the scores of
+the guess apart from the others, use a beam (or max_active) with it.
+
+    states, scores = parallel_viterbi(likelihoods, step, init, pool, n_blocks)
+"""
+
+import os, tempfile
+import numpy as np
+from viterbi_kernels import LOG_ZERO, prune, traceback, backpointers_dtype
+from shared_arrays import SharedArray
+
+MIN_BLOCK_FRAMES = 200 # frames per block at least (fix-up vs parallel scan)
+PARALLEL_TOLERANCE = 1E-6 # max spread of the score differences of parallel rows
+
+
+def blocks(n_frames, n_blocks, min_frames=None):
+    """ (start, end) frames of at most n_blocks blocks of similar sizes, of
+    min_frames (MIN_BLOCK_FRAMES if None) at least """
+    if min_frames == None:
+        min_frames = MIN_BLOCK_FRAMES
+    n_blocks = max(1, min(n_blocks, n_frames // max(1, min_frames)))
+    bounds = np.linspace(0, n_frames, n_blocks + 1).astype('int64')
+    return [(int(start), int(end)) for start, end in zip(bounds[:-1],
+        bounds[1:])]
+
+
+def parallel_offset(scores, stored):
+    """ (True, c) if scores == stored + c on the same active states,
+    (False, None) otherwise """
+    active = scores > LOG_ZERO
+    if not active.any() or (active != (stored > LOG_ZERO)).any():
+        return False, None
+    diff = scores[active] - stored[active]
+    if diff.max() - diff.min() > PARALLEL_TOLERANCE:
+        return False, None
+    return True, diff.mean()
+
+
+def memmap(directory, dtype, shape):
+    """ new .npy memmap file in directory, returns its name """
+    fd, fname = tempfile.mkstemp(suffix='.npy', dir=directory)
+    os.close(fd)
+    np.lib.format.open_memmap(fname, mode='w+', dtype=dtype, shape=shape)
+    return fname
+
+
+class BlockLoop(object): # to circumvent pickling pbms w/ multiprocessing.map
+    """ forward scan of a (start, end) block of frames (phase 1), writes its
+    scores and backpointers in the memmap files, returns its active states
+    count """
+    def __init__(self, likelihoods, step, init, posteriors_fname,
+            backpointers_fname, beam=None, max_active=None):
+        self.likelihoods = likelihoods # SharedArray
+        self.step = step
+        self.init = init
+        self.posteriors_fname = posteriors_fname
+        self.backpointers_fname = backpointers_fname
+        self.beam = beam
+        self.max_active = max_active
+    def __call__(self, block):
+        start, end = block
+        likelihoods = self.likelihoods.array
+        posteriors = np.load(self.posteriors_fname, mmap_mode='r+')
+        backpointers = np.load(self.backpointers_fname, mmap_mode='r+')
+        if start == 0:
+            scores = self.init + likelihoods[0]
+        else: # guess: any state, log uniform
+            scores, backpointers[start-1] = self.step(
+                    np.zeros(likelihoods.shape[1]), likelihoods[start])
+        n_active = prune(scores, self.beam, self.max_active)
+        posteriors[start] = scores
+        for i in range(start + 1, end):
+            scores, backpointers[i-1] = self.step(scores, likelihoods[i])
+            n_active += prune(scores, self.beam, self.max_active)
+            posteriors[i] = scores
+        posteriors.flush()
+        backpointers.flush()
+        return n_active
+
+
+def fix_up(likelihoods, step, posteriors, backpointers, start, end,
+        beam=None, max_active=None):
+    """ re-scans the block (start, end) from the exact scores of frame
+    start-1 until its rows are parallel to the stored ones, then offsets
+    the rest of the block. Returns the number of re-scanned frames """
+    scores = posteriors[start-1]
+    for i in range(start, end):
+        scores, bp = step(scores, likelihoods[i])
+        prune(scores, beam, max_active)
+        parallel, offset = parallel_offset(scores, posteriors[i])
+        posteriors[i] = scores
+        backpointers[i-1] = bp
+        if parallel:
+            posteriors[i+1:end] += offset
+            return i - start + 1
+    return end - start
+
+
+def parallel_viterbi(likelihoods, step, init, pool, n_blocks, last_state=None,
+        beam=None, max_active=None, stats=None, directory=None):
+    """ Viterbi path of the (T, S) likelihoods with step (one of the *_step
+    functions of viterbi_kernels.py with its transitions bound, 1-D scores)
+    from the log scores init, scanned in n_blocks blocks by the workers of
+    pool (see the module docstring). The path ends in last_state if it is
+    given and active, in the best state otherwise. directory is where the
+    likelihoods, scores and backpointers shared with the workers are memory
+    mapped (None: the likelihoods in shared memory, the rest in the temp
+    dir). stats (dict) gets the 'frames', 'active' states and 'fixed'
+    (re-scanned) frames. Returns (states, their scores along the path) """
+    n_frames, n_states = likelihoods.shape
+    shared = SharedArray(likelihoods, directory)
+    if directory == None:
+        directory = tempfile.gettempdir()
+    posteriors_fname = memmap(directory, 'float64', (n_frames, n_states))
+    backpointers_fname = memmap(directory, backpointers_dtype(n_states),
+            (max(1, n_frames - 1), n_states))
+    try:
+        parts = blocks(n_frames, n_blocks)
+        n_active = sum(pool.map(BlockLoop(shared, step, init,
+            posteriors_fname, backpointers_fname, beam=beam,
+            max_active=max_active), parts, chunksize=1))
+        posteriors = np.load(posteriors_fname, mmap_mode='r+')
+        backpointers = np.load(backpointers_fname, mmap_mode='r+')
+        n_fixed = 0
+        for start, end in parts[1:]:
+            n_fixed += fix_up(shared.array, step, posteriors, backpointers,
+                    start, end, beam=beam, max_active=max_active)
+        if last_state is None or posteriors[-1][last_state] == LOG_ZERO:
+            last_state = posteriors[-1].argmax()
+        states = traceback(backpointers[:n_frames - 1], last_state)
+        scores = np.array(posteriors[np.arange(n_frames), states])
+        del posteriors, backpointers # closes the memmaps
+    finally:
+        shared.close()
+        os.remove(posteriors_fname)
+        os.remove(backpointers_fname)
+    if stats is not None:
+        stats['frames'] = stats.get('frames', 0) + n_frames
+        stats['active'] = stats.get('active', 0) + n_active
+        stats['fixed'] = stats.get('fixed', 0) + n_fixed
+    return states, scores
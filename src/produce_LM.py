@@ -1,6 +1,10 @@
-import sys, pickle
+import sys, pickle, math
 from collections import defaultdict
 
+DISCOUNT = 0.5 # absolute discount of the counts of the (n>1)-grams
+START = '!ENTER' # sentence start / end symbols of the ARPA n-grams
+END = '!EXIT'
+
 unigrams = defaultdict(int)
 bigrams = defaultdict(lambda: defaultdict(int))
 
@@ -36,8 +40,84 @@ def process(f):
         pickle.dump((uni, bi, discounts), of)
     print(">>> pickled bigram.pickle containing (unigrams, bigrams) dicts")
 
+def process_ngram(f, order):
+    """ writes the absolute discounting / Katz backoff n-gram LM of the
+    phones of the MLF f in ngram_ORDER.arpa (for batch_viterbi.py --ngram) """
+    counts = defaultdict(int) # ngram tuple -> count, all orders
+    sentence = []
+    for line in f:
+        if line[0].isdigit():
+            sentence.append(line.rstrip('\n').split()[2])
+        elif len(sentence): # end of the utterance
+            # MLFs of substitute_phones.py --sentences already have them
+            if sentence[0] != START:
+                sentence.insert(0, START)
+            if sentence[-1] != END:
+                sentence.append(END)
+            for n in range(1, order + 1):
+                for i in range(len(sentence) - n + 1):
+                    counts[tuple(sentence[i:i+n])] += 1
+            sentence = []
+    totals = defaultdict(int) # history -> count of its continuations
+    for ngram, c in counts.items():
+        totals[ngram[:-1]] += c
+    totals[()] -= counts[(START,)]
+    probs = {}
+    for ngram, c in counts.items():
+        if len(ngram) == 1:
+            probs[ngram] = 1.0 * c / totals[()] if ngram != (START,) else 0.0
+        else:
+            probs[ngram] = (c - DISCOUNT) / totals[ngram[:-1]]
+    continuations = defaultdict(list)
+    for ngram in counts.keys():
+        if len(ngram) > 1:
+            continuations[ngram[:-1]].append(ngram[-1])
+    bows = {}
+    def katz(history, phone): # backed off P(phone | history)
+        if history + (phone,) in probs:
+            return probs[history + (phone,)]
+        if not len(history):
+            return 0.0
+        return bows.get(history, 1.0) * katz(history[1:], phone)
+    for history in sorted(continuations.keys(), key=len): # lower orders first
+        seen = continuations[history]
+        left = 1.0 - sum(probs[history + (phone,)] for phone in seen)
+        lower = 1.0 - sum(katz(history[1:], phone) for phone in seen)
+        if lower <= 1E-10: # every phone is seen: nothing to back off to,
+            for phone in seen: # their probs get the discounted mass
+                probs[history + (phone,)] /= 1.0 - left
+            bows[history] = 1.0
+        else:
+            bows[history] = left / lower
+
+    log10 = lambda p: math.log10(p) if p > 0.0 else -99.0
+    ofname = 'ngram_' + str(order) + '.arpa'
+    with open(ofname, 'w') as of:
+        of.write('\\data\\\n')
+        for n in range(1, order + 1):
+            of.write('ngram ' + str(n) + '=' + str(len([ngram for ngram in
+                counts if len(ngram) == n])) + '\n')
+        for n in range(1, order + 1):
+            of.write('\n\\' + str(n) + '-grams:\n')
+            for ngram in sorted(ngram for ngram in counts if len(ngram) == n):
+                of.write('%.6f' % log10(probs[ngram]) + '\t' + ' '.join(ngram))
+                if ngram in bows:
+                    of.write('\t%.6f' % log10(bows[ngram]))
+                of.write('\n')
+        of.write('\n\\end\\\n')
+    print(">>> wrote", ofname, "containing the", order, "-grams ARPA LM")
+
 if len(sys.argv) < 2:
-    print("python produce_LM.py train.mlf")
+    print("python produce_LM.py train.mlf [--order N]")
+    print("    --order N (N > 1) writes an ARPA N-gram LM (ngram_N.arpa)")
+    print("    instead of the pickled (unigrams, bigrams) of bigram.pickle")
+    sys.exit(-1)
 
+order = None
+if '--order' in sys.argv:
+    order = int(sys.argv[sys.argv.index('--order') + 1])
 with open(sys.argv[1]) as f: 
-    process(f)
+    if order == None:
+        process(f)
+    else:
+        process_ngram(f, order)
@@ -0,0 +1,460 @@
+"""
+Regression checks of the decoders on a synthetic HMM set (no corpus
+needed): small random GMM HMMs (some states tied) are written as HTK
+HMMdefs, random features are drawn from their GMMs, and each decoding mode
+is compared with a plain dense Viterbi (the reference: the recursion of
+the original viterbi.py, written here without pruning nor any of the
+kernels), on the uniform phone loop from !ENTER to !EXIT.
+
+usage: python regression.py [--seed SEED] [--verbose]
+
+    prints one line per check (ok / FAIL / skip), exits with the number of
+    failed checks, --verbose lets the decoders print their own output
+"""
+
+import sys, os, io, copy, subprocess, tempfile, contextlib
+from multiprocessing import Pool
+import numpy as np
+
+SEED = 0 # of the synthetic HMMs, features and LM corpus
+N_PHONES = 8 # phones of the synthetic HMMs, !ENTER and !EXIT included
+N_STATES = 3 # emitting states per phone
+N_MIXTURES = 2 # Gaussians per state
+N_FEATURES = 4 # dimension of the synthetic features
+N_UTTERANCES = 6 # synthetic utterances decoded by each check
+TIED = (('p2', 1), ('p3', 1)) # (phone, state) tied with a ~s macro
+INSERTION_PENALTY = 2.5
+SCALE_FACTOR = 3.0
+VERBOSE = False
+
+
+def synthetic_hmms(rng, n_phones=N_PHONES, n_states=N_STATES,
+        n_mixtures=N_MIXTURES, n_features=N_FEATURES):
+    """ [(phone, [(weights, means, variances)], transp)] of n_phones random
+    left-to-right HMMs (!ENTER, !EXIT, p2, p3...), the TIED states are the
+    same tuple """
+    hmms = []
+    shared = None
+    for phn in ['!ENTER', '!EXIT'] + ['p' + str(i)
+            for i in range(2, n_phones)]:
+        states = []
+        for state in range(n_states):
+            if (phn, state) in TIED and shared != None:
+                states.append(shared)
+                continue
+            states.append((rng.dirichlet(np.ones(n_mixtures)),
+                rng.normal(0.0, 3.0, (n_mixtures, n_features)),
+                rng.uniform(0.5, 2.0, (n_mixtures, n_features))))
+            if (phn, state) in TIED:
+                shared = states[-1]
+        transp = np.zeros((n_states + 2, n_states + 2))
+        transp[0, 1] = 1.0
+        for state in range(1, n_states + 1):
+            transp[state, state] = rng.uniform(0.3, 0.8)
+            transp[state, state + 1] = 1.0 - transp[state, state]
+        hmms.append((phn, states, transp))
+    return hmms
+
+
+def string_hmmdefs(hmms, tied=True):
+    """ HTK HMMdefs text of the synthetic_hmms(), with the TIED states and
+    the transitions as ~s / ~t macros if tied, written out in each model
+    otherwise """
+    vector = lambda v: ' '.join('%.9e' % x for x in v) + '\n'
+    n_features = hmms[0][1][0][1].shape[1]
+    def state(weights, means, variances):
+        s = '<NUMMIXES> ' + str(len(weights)) + '\n'
+        for k in range(len(weights)):
+            s += '<MIXTURE> ' + str(k + 1) + ' %.9e\n' % weights[k] + \
+                    '<MEAN> ' + str(n_features) + '\n' + vector(means[k]) + \
+                    '<VARIANCE> ' + str(n_features) + '\n' + \
+                    vector(variances[k])
+        return s
+    def transp(t):
+        return '<TRANSP> ' + str(t.shape[0]) + '\n' + \
+                ''.join(vector(row) for row in t)
+    s = '~o\n<STREAMINFO> 1 ' + str(n_features) + '\n<VECSIZE> ' + \
+            str(n_features) + '<NULLD><USER><DIAGC>\n'
+    if tied:
+        phn, i = TIED[0]
+        s += '~s "tied"\n' + state(*dict((h[0], h) for h in hmms)[phn][1][i])
+        s += '~t "loop"\n' + transp(hmms[0][2])
+    for phn, states, t in hmms:
+        s += '~h "' + phn + '"\n<BEGINHMM>\n<NUMSTATES> ' + \
+                str(len(states) + 2) + '\n'
+        for i, st in enumerate(states):
+            s += '<STATE> ' + str(i + 2) + '\n'
+            s += '~s "tied"\n' if tied and (phn, i) in TIED else state(*st)
+        s += '~t "loop"\n' if tied and t is hmms[0][2] else transp(t)
+        s += '<ENDHMM>\n'
+    return s
+
+
+def synthetic_mlf(rng, phones, n_sentences=200):
+    """ MLF of random sentences of phones (a sparse random bigram, every
+    phone following the first one, to exercise the backoff weights) """
+    successors = dict((phn, rng.choice(phones, 3, replace=False))
+            for phn in phones)
+    s = ['#!MLF!#\n']
+    for n in range(n_sentences):
+        sentence = [rng.choice(phones)]
+        for _ in range(rng.randint(2, 10)):
+            if rng.uniform() < 0.8:
+                sentence.append(rng.choice(successors[sentence[-1]]))
+            else:
+                sentence.append(rng.choice(phones))
+        if n < len(phones):
+            sentence = [phones[0], phones[n]]
+        s.append('"s' + str(n) + '.lab"\n' + ''.join('%d %d %s\n' % (i,
+            i + 1, phn) for i, phn in enumerate(sentence)) + '.\n')
+    return ''.join(s)
+
+
+def synthetic_features(rng, hmms, n_utterances=N_UTTERANCES):
+    """ features of random phone sequences from !ENTER to !EXIT, drawn from
+    the GMMs of the synthetic_hmms() """
+    models = dict((phn, states) for phn, states, _ in hmms)
+    phones = [phn for phn in models if phn not in ('!ENTER', '!EXIT')]
+    utterances = []
+    for _ in range(n_utterances):
+        frames = []
+        for phn in ['!ENTER'] + list(rng.choice(phones, rng.randint(3, 8))) \
+                + ['!EXIT']:
+            for weights, means, variances in models[phn]:
+                for _ in range(rng.randint(1, 6)):
+                    k = rng.choice(len(weights), p=weights)
+                    frames.append(rng.normal(means[k], np.sqrt(variances[k])))
+        utterances.append(np.array(frames))
+    return utterances
+
+
+def reference_viterbi(likelihoods, log_transitions, init, last_state=None):
+    """ plain dense Viterbi: best states path of the (T, S) likelihoods,
+    ending in last_state if it is reachable, in the best state otherwise """
+    n_frames, n_states = likelihoods.shape
+    scores = init + likelihoods[0]
+    backpointers = np.zeros((n_frames, n_states), dtype='int64')
+    for t in range(1, n_frames):
+        candidates = scores[:, None] + log_transitions
+        backpointers[t] = candidates.argmax(axis=0)
+        scores = candidates.max(axis=0) + likelihoods[t]
+    state = scores.argmax()
+    if last_state is not None and scores[last_state] > -np.inf:
+        state = last_state
+    path = [state]
+    for t in range(n_frames - 1, 0, -1):
+        state = backpointers[t][state]
+        path.append(state)
+    return path[::-1]
+
+
+def report(name, n_different, n_total, what="utterances differ"):
+    """ the result line of a check """
+    return ("ok  " if not n_different else "FAIL") + " " + name + \
+            ("" if not n_different else ": " + str(n_different) + " of " +
+                str(n_total) + " " + what)
+
+
+def states_of(path):
+    """ the states of a [(state, posterior)] path """
+    return [int(state) for state, _ in path]
+
+
+class Setup(object):
+    """ the synthetic HMMs, features, likelihoods, reference paths and LMs
+    of the checks, in directory """
+    def __init__(self, directory, seed=SEED):
+        import batch_viterbi
+        from scorers import GmmScorer
+        self.directory = directory
+        rng = np.random.RandomState(seed)
+        self.hmms = synthetic_hmms(rng)
+        self.hmm_fname = os.path.join(directory, 'hmmdefs')
+        with open(self.hmm_fname, 'w') as f:
+            f.write(string_hmmdefs(self.hmms))
+        with open(self.hmm_fname) as f:
+            self.n_states, self.transitions, self.gmms = \
+                    batch_viterbi.parse_hmm(f)
+        self.map_states_to_phones = batch_viterbi.phones_mapping(self.gmms)
+        self.phones = list(self.gmms.keys())
+        self.scorer = GmmScorer(self.gmms)
+        self.features = synthetic_features(rng, self.hmms)
+        self.likelihoods = [self.scorer.likelihoods(x) for x in self.features]
+        self.log_transitions = batch_viterbi.penalty_scale(
+                batch_viterbi.initialize_transitions(
+                    copy.deepcopy(self.transitions)),
+                insertion_penalty=INSERTION_PENALTY,
+                scale_factor=SCALE_FACTOR)
+        self.init, self.ending_state = batch_viterbi.initial_scores(
+                self.n_states, self.map_states_to_phones, using_bigram=True)
+        self.references = [reference_viterbi(likelihoods,
+            self.log_transitions[1], self.init, self.ending_state)
+            for likelihoods in self.likelihoods]
+        self.mlf_fname = os.path.join(directory, 'train.mlf')
+        with open(self.mlf_fname, 'w') as f:
+            f.write(synthetic_mlf(rng, [phn for phn in self.phones
+                if phn not in ('!ENTER', '!EXIT')]))
+
+    def arpa(self, order):
+        """ the ARPA LM of order produce_LM.py writes for the MLF """
+        produce_lm = os.path.join(os.path.dirname(os.path.abspath(
+            __file__)), 'produce_LM.py')
+        subprocess.check_call([sys.executable, produce_lm, self.mlf_fname,
+            '--order', str(order)], cwd=self.directory,
+            stdout=subprocess.DEVNULL)
+        return os.path.join(self.directory, 'ngram_' + str(order) + '.arpa')
+
+    def compare(self, name, decode):
+        """ report() of decode(n, likelihoods) (a states path) against the
+        reference paths """
+        n_different = sum(list(decode(n, likelihoods)) != reference
+                for n, (likelihoods, reference) in enumerate(zip(
+                    self.likelihoods, self.references)))
+        return report(name, n_different, len(self.likelihoods))
+
+
+@contextlib.contextmanager
+def patched(module, **values):
+    """ sets the globals values of module, restores them on exit """
+    saved = dict((name, getattr(module, name)) for name in values)
+    for name, value in values.items():
+        setattr(module, name, value)
+    try:
+        yield
+    finally:
+        for name, value in saved.items():
+            setattr(module, name, value)
+
+
+def check_tied_hmms(setup):
+    """ the ~s / ~t macros parse as the models written out in full, and the
+    tied states (scored once) get the likelihoods of the expanded ones """
+    import batch_viterbi
+    from scorers import GmmScorer
+    with io.StringIO(string_hmmdefs(setup.hmms, tied=False)) as f:
+        n_states, transitions, gmms = batch_viterbi.parse_hmm(f)
+    n_different = int(n_states != setup.n_states or not np.array_equal(
+        transitions[1], setup.transitions[1]))
+    scorer = GmmScorer(gmms)
+    n_different += sum(not np.allclose(scorer.likelihoods(x), likelihoods)
+            for x, likelihoods in zip(setup.features, setup.likelihoods))
+    return report("tied HMMs == expanded HMMs", n_different,
+            len(setup.features) + 1, "models / utterances differ")
+
+
+def check_log_likelihoods(setup):
+    """ the log domain GMMs (GmmScorer) are the original densities """
+    from scorers import precompute_det_inv, compute_likelihoods
+    gmms_ = precompute_det_inv(setup.gmms)
+    n_different = sum(not np.allclose(compute_likelihoods(gmms_, x),
+        likelihoods, rtol=1E-4, atol=1E-3) for x, likelihoods in zip(
+            setup.features, setup.likelihoods))
+    return report("compute_log_likelihoods == compute_likelihoods",
+            n_different, len(setup.features))
+
+
+def check_backend(backend):
+    """ viterbi() with the dense Viterbi kernel backend """
+    def check(setup):
+        import batch_viterbi
+        from viterbi_kernels import numba
+        name = "viterbi --backend " + backend
+        if backend == 'compiled' and numba is None:
+            return "skip " + name + ": numba is not installed"
+        with patched(batch_viterbi, VITERBI_BACKEND=backend):
+            return setup.compare(name, lambda n, likelihoods: states_of(
+                batch_viterbi.viterbi(likelihoods, setup.log_transitions,
+                    setup.map_states_to_phones, using_bigram=True)[0]))
+    check.__name__ = 'check_backend_' + backend
+    return check
+
+
+def check_sparse(setup):
+    """ viterbi() on the compact topology """
+    import batch_viterbi
+    from viterbi_kernels import build_topology
+    topology = build_topology(setup.log_transitions)
+    return setup.compare("viterbi --sparse", lambda n, likelihoods:
+            states_of(batch_viterbi.viterbi(likelihoods,
+                setup.log_transitions, setup.map_states_to_phones,
+                using_bigram=True, topology=topology)[0]))
+
+
+def check_pruning(setup):
+    """ viterbi() with a beam and a max number of active states that keep
+    the best path """
+    import batch_viterbi
+    return setup.compare("viterbi --beam --max-active", lambda n,
+            likelihoods: states_of(batch_viterbi.viterbi(likelihoods,
+                setup.log_transitions, setup.map_states_to_phones,
+                using_bigram=True, beam=1E4, max_active=setup.n_states - 1)[0]))
+
+
+def check_batch(sparse):
+    """ viterbi_batch() on all the (padded) utterances at once """
+    def check(setup):
+        import batch_viterbi
+        from viterbi_kernels import build_topology
+        topology = build_topology(setup.log_transitions) if sparse else None
+        paths = batch_viterbi.viterbi_batch(setup.likelihoods,
+                setup.log_transitions, setup.map_states_to_phones,
+                using_bigram=True, topology=topology)
+        return setup.compare("viterbi_batch --batch" + (" --sparse"
+            if sparse else ""), lambda n, likelihoods: states_of(paths[n]))
+    check.__name__ = 'check_batch' + ('_sparse' if sparse else '')
+    return check
+
+
+def check_lean(max_frames, spill):
+    """ viterbi() --lean, checkpointed or spilling beyond max_frames """
+    def check(setup):
+        import batch_viterbi
+        name = "viterbi --lean" + (" (checkpoints)" if max_frames and not
+                spill else "") + (" --spill" if spill else "")
+        with patched(batch_viterbi, LEAN_VITERBI=True,
+                LEAN_MAX_FRAMES=max_frames or batch_viterbi.LEAN_MAX_FRAMES,
+                SPILL_DIR=setup.directory if spill else None):
+            return setup.compare(name, lambda n, likelihoods: states_of(
+                batch_viterbi.viterbi(likelihoods, setup.log_transitions,
+                    setup.map_states_to_phones, using_bigram=True)[0]))
+    check.__name__ = 'check_lean'
+    return check
+
+
+def check_online(setup):
+    """ online_viterbi() on the features (likelihoods by small chunks), its
+    phones against those of the reference path """
+    import batch_viterbi
+    n_different = 0
+    with patched(batch_viterbi, LIKELIHOODS_CHUNK=7):
+        for x, reference in zip(setup.features, setup.references):
+            with io.StringIO() as of:
+                batch_viterbi.online_viterbi(of, x, setup.scorer.likelihoods,
+                        setup.log_transitions, setup.map_states_to_phones,
+                        using_bigram=True)
+                hyp = [line.split()[:3] for line in
+                        of.getvalue().splitlines()]
+            ref = [line.split()[:3] for line in batch_viterbi.string_mlf(
+                setup.map_states_to_phones, [(state, 0.0) for state in
+                    reference], phones_only=True).splitlines()]
+            n_different += hyp != ref
+    return report("online_viterbi --online", n_different,
+            len(setup.features))
+
+
+def check_scan(setup):
+    """ viterbi_scan() on blocks of frames scanned by a Pool of workers """
+    import batch_viterbi, parallel_viterbi
+    with patched(parallel_viterbi, MIN_BLOCK_FRAMES=8), \
+            patched(batch_viterbi, SHARED_DIR=setup.directory):
+        p = Pool(2)
+        try:
+            return setup.compare("viterbi_scan --scan --beam", lambda n,
+                    likelihoods: states_of(batch_viterbi.viterbi_scan(
+                        likelihoods, setup.log_transitions,
+                        setup.map_states_to_phones, p, 3, using_bigram=True,
+                        beam=30.0)))
+        finally:
+            p.close()
+            p.join()
+
+
+def check_two_pass(setup):
+    """ second pass on the pairs of the first pass (same GMMs) """
+    import batch_viterbi
+    from viterbi_kernels import build_topology
+    from two_pass import active_pairs
+    topology = build_topology(setup.log_transitions)
+    final = np.zeros(setup.n_states)
+    final[:] = batch_viterbi.LOG_ZERO
+    final[setup.ending_state] = 0.0
+    def decode(n, likelihoods):
+        active = active_pairs(likelihoods, topology, setup.init, final=final)
+        return states_of(batch_viterbi.viterbi(setup.scorer.likelihoods_active(
+            setup.features[n], active), setup.log_transitions,
+            setup.map_states_to_phones, using_bigram=True)[0])
+    return setup.compare("--two-pass (first pass: same GMMs)", decode)
+
+
+def check_lattice(setup):
+    """ the best path of the phone lattice has the phone of the reference
+    path at each frame (string_mlf() would merge a repeated phone) """
+    import batch_viterbi
+    n_different = 0
+    for likelihoods, reference in zip(setup.likelihoods, setup.references):
+        lattice = batch_viterbi.viterbi_lattice(likelihoods,
+                setup.log_transitions, setup.map_states_to_phones,
+                using_bigram=True)
+        hyp = [phn for phn, start, end in lattice.nbest(1)[0][1]
+                for _ in range(start, end)]
+        ref = [setup.map_states_to_phones[state].split('[')[0]
+                for state in reference]
+        n_different += hyp != ref
+    return report("viterbi_lattice --lattices --n (1-best)", n_different,
+            len(setup.likelihoods))
+
+
+def check_ngram_bigram(setup):
+    """ an order 2 --ngram decode (LMGraph, backoff on the fly) is the
+    decode of the dense bigram transitions of the same (Katz) LM """
+    import batch_viterbi
+    from ngram_lm import parse_arpa, LMGraph, viterbi_ngram, LOG_ZERO
+    with open(setup.arpa(2)) as f:
+        lm = parse_arpa(f)
+    graph = LMGraph(lm, setup.transitions,
+            insertion_penalty=INSERTION_PENALTY, scale_factor=SCALE_FACTOR)
+    phones, probs = setup.transitions
+    probs = probs.copy()
+    for phn1, phone1 in phones.items():
+        exit_prob = 1.0 - setup.transitions[1][phone1.to_ind[-1]].sum()
+        for phn2, phone2 in phones.items():
+            log10prob = lm.log10prob((phn1,), phn2)
+            probs[phone1.to_ind[-1], phone2.to_ind[0]] = 0.0 if \
+                    log10prob <= -99.0 or log10prob == LOG_ZERO else \
+                    exit_prob * 10 ** log10prob
+    log_transitions = batch_viterbi.penalty_scale((phones, probs),
+            insertion_penalty=INSERTION_PENALTY,
+            scale_factor=SCALE_FACTOR)[1]
+    n_different = 0
+    for likelihoods in setup.likelihoods:
+        ref = reference_viterbi(likelihoods, log_transitions, setup.init,
+                setup.ending_state)
+        n_different += ref != states_of(viterbi_ngram(likelihoods, graph))
+    return report("--ngram order 2 == dense bigram", n_different,
+            len(setup.likelihoods))
+
+
+CHECKS = [check_tied_hmms, check_log_likelihoods, check_backend('numpy'),
+        check_backend('compiled'), check_sparse, check_pruning,
+        check_batch(False), check_batch(True), check_lean(None, False),
+        check_lean(10, False), check_lean(10, True), check_online,
+        check_scan, check_two_pass, check_lattice, check_ngram_bigram]
+
+
+def main(argv):
+    global VERBOSE
+    seed = SEED
+    if '--help' in argv:
+        print(__doc__)
+        sys.exit(0)
+    if '--seed' in argv:
+        seed = int(argv[argv.index('--seed') + 1])
+    VERBOSE = '--verbose' in argv
+    n_failed = 0
+    with tempfile.TemporaryDirectory() as directory, \
+            open(os.devnull, 'w') as devnull, np.errstate(divide='ignore'):
+        quiet = lambda: contextlib.redirect_stdout(sys.stdout if VERBOSE
+                else devnull) # the decoders are chatty
+        with quiet():
+            setup = Setup(directory, seed=seed)
+        for check in CHECKS:
+            with quiet():
+                line = check(setup)
+            print(line)
+            n_failed += line.startswith("FAIL")
+    print(len(CHECKS) - n_failed, "of", len(CHECKS), "checks passed")
+    return n_failed
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -0,0 +1,134 @@
+"""
+Longest-first dynamic scheduling of the Pool jobs, with per task timing.
+
+Pool.map hands out the tasks in chunks in the order of the scp: a few long
+utterances (or songs) at the end keep one or two workers busy while the
+others are idle. longest_first() sorts the tasks by decreasing cost (frames
+of the utterance, features file size when the frames are not known) and
+dispatches them one by one (imap_unordered) to the first free worker (LPT
+scheduling). Each task is timed in its worker, and JobStats reports the
+utilization of the workers and the slowest tasks of the job:
+
+    stats = JobStats(n_workers, names=clines)
+    for i, result in longest_first(pool, func, tasks, costs, stats=stats):
+        writer.write(i, result)  # completion order, OrderedWriter: scp order
+    stats.report("viterbi")
+"""
+
+import os, sys, time, struct
+import numpy as np
+
+N_SLOWEST = 5 # slowest tasks listed by JobStats.report()
+
+
+class OrderedWriter(object):
+    """ writes the strings numbered 0, 1, ... to f in that order whatever
+    the order in which they are given (the early ones wait in pending) """
+    def __init__(self, f):
+        self.f = f
+        self.next = 0
+        self.pending = {}
+    def write(self, i, s):
+        self.pending[i] = s
+        while self.next in self.pending:
+            self.f.write(self.pending.pop(self.next))
+            self.next += 1
+
+
+def htk_n_frames(fname):
+    """ number of frames of the HTK features file fname (from its header),
+    None if it is not one """
+    try:
+        with open(fname, 'rb') as f:
+            n_samples, _, samp_size, _ = struct.unpack('>iihh', f.read(12))
+        if n_samples >= 0 and samp_size > 0 and \
+                12 + n_samples * samp_size == os.path.getsize(fname):
+            return n_samples
+    except (IOError, OSError, struct.error):
+        pass
+    return None
+
+
+def file_costs(fnames):
+    """ cost of the tasks on the files fnames: HTK frames when they are HTK
+    features files, sizes in bytes otherwise (0 if missing) """
+    frames = [htk_n_frames(fname) for fname in fnames]
+    if all(n != None for n in frames):
+        return np.array(frames, dtype='float64')
+    return np.array([os.path.getsize(fname) if os.path.exists(fname) else 0
+        for fname in fnames], dtype='float64')
+
+
+class TimedTask(object): # to circumvent pickling pbms w/ multiprocessing.map
+    """ (index, task) -> (index, func(task) or func(*task) if star, wall
+    time in the worker, worker pid) """
+    def __init__(self, func, star=False):
+        self.func = func
+        self.star = star
+    def __call__(self, indexed_task):
+        i, task = indexed_task
+        start = time.time()
+        if self.star:
+            result = self.func(*task)
+        else:
+            result = self.func(task)
+        return i, result, time.time() - start, os.getpid()
+
+
+class JobStats(object):
+    """ wall times of the tasks of a job on n_workers workers """
+    def __init__(self, n_workers, names=None):
+        self.n_workers = n_workers
+        self.names = names
+        self.seconds = {} # task index -> wall time in its worker
+        self.pids = set()
+        self.start = time.time()
+        self.end = None
+
+    def add(self, i, seconds, pid):
+        self.seconds[i] = seconds
+        self.pids.add(pid)
+        self.end = time.time()
+
+    def utilization(self):
+        """ busy time of the workers / (n_workers * wall time of the job) """
+        wall = (self.end or time.time()) - self.start
+        return sum(self.seconds.values()) / max(1E-9, self.n_workers * wall)
+
+    def report(self, job, n_slowest=N_SLOWEST, f=sys.stdout):
+        if not len(self.seconds):
+            return
+        wall = self.end - self.start
+        slowest = sorted(self.seconds, key=self.seconds.get)[::-1][:n_slowest]
+        name = lambda i: str(self.names[i]) if self.names != None else str(i)
+        print(job + ":", len(self.seconds), "tasks in", "%.2f" % wall,
+                "s on", self.n_workers, "workers (" + str(len(self.pids)),
+                "used), utilization", "%.1f%%" % (100 * self.utilization()),
+                file=f)
+        print("    slowest tasks:", ', '.join(name(i) + " %.2f s"
+            % self.seconds[i] for i in slowest), file=f)
+
+
+def longest_first(pool, func, tasks, costs, star=False, stats=None,
+        chunksize=1):
+    """ runs func on the tasks in the Pool, the costliest first, yields the
+    (index in tasks, result) in their order of completion. stats (JobStats)
+    gets the wall time of each task """
+    order = np.argsort(-np.asarray(costs, dtype='float64'), kind='stable')
+    for i, result, seconds, pid in pool.imap_unordered(
+            TimedTask(func, star=star),
+            ((i, tasks[i]) for i in order), chunksize=chunksize):
+        if stats is not None:
+            stats.add(i, seconds, pid)
+        yield i, result
+
+
+def map_longest_first(pool, func, tasks, costs, star=False, stats=None,
+        chunksize=1):
+    """ as Pool.map (results in the order of tasks), scheduled by
+    longest_first() """
+    results = [None for _ in tasks]
+    for i, result in longest_first(pool, func, tasks, costs, star=star,
+            stats=stats, chunksize=chunksize):
+        results[i] = result
+    return results
@@ -0,0 +1,566 @@
+"""
+Acoustic scorers: the (T, S) log likelihoods of the HMM states (in the
+order of phones_mapping()) that the decoders search, whatever the acoustic
+model. The decoders (batch_viterbi.py and its front ends viterbi.py and
+batch_mocha_viterbi.py, forced_align.py, sweep.py, decode_server.py) only
+talk to a Scorer:
+
+    * GmmScorer: the GMMs of the HMMs, per file (computed in the workers),
+      each tied (physical) state once,
+    * DbnScorer: a DBN on the (padded) MFCC, normalized on the whole scp,
+    * MatrixScorer: likelihoods computed beforehand (.npy + .pickle map, as
+      written by batch_viterbi.py --save-scores or found in a --cache),
+    * MochaDbnScorer (batch_mocha_viterbi.py): a two streams DBN on the
+      MFCC and the articulatory (EMA) features,
+    * ShortlistScorer (gaussian_selection.py): the GMMs with Gaussian
+      selection (VQ shortlists).
+
+    scorer = load_scorer(gmms, map_states_to_phones, hmm_fname)
+    if scorer.per_file:
+        likelihoods = scorer(cline)            # in any process, any order
+    else:
+        likelihoods, map_file_to_start_end = scorer.score_all(clines)
+
+Scorers that are not per_file depend on the whole scp (normalization of the
+DBN input): score_all() scores it at once, or prepare() computes what they
+need on the whole scp and chunk() then scores a few files at a time.
+likelihoods_active() / chunk_active() only score the (frame, state) pairs
+that a first pass kept (two_pass.py).
+"""
+
+import sys, math, pickle
+import numpy as np
+from numpy import linalg
+from functools import reduce
+import htkmfc
+from viterbi_kernels import LOG_ZERO, logsumexp
+from shared_arrays import SharedArray
+
+N_BATCHES_DATASET = 32 # number of batches in which we divide the dataset
+                      # (to fit in the GPU memory, only 2Gb at home)
+N_MFCC = 39 # MFCC coefficients per frame at the input of the DBNs
+MEMORY_BUDGET = 256 * 2**20 # bytes of temporaries per scoring call (frames chunks)
+
+
+def eval_gauss_mixt(v, gmixt):
+    assert(len(gmixt[0]) == gmixt[1].shape[0] == gmixt[2].shape[0])
+    def eval_gauss_comp(mix_comp): # closure
+        pi_k, mu_k, sigma_k_inv = mix_comp
+        return pi_k * math.exp(-0.5 * np.dot((v - mu_k).T,
+                    np.dot(sigma_k_inv, v - mu_k)))
+    return reduce(lambda x, y: x + y, list(map(eval_gauss_comp,
+        zip(gmixt[0], gmixt[1], gmixt[2]))))
+
+
+def log_gconst(sigma2_k):
+    """ HTK's GCONST ln(det(2*pi*sigma)) of the diagonal covariance sigma2_k,
+    summed in the log domain (det(2*pi*sigma) over- or underflows) """
+    return np.sum(np.log(2 * np.pi * np.asarray(sigma2_k, dtype='float64')))
+
+
+def precompute_det_inv(gmms):
+    # /!\ iteration order is important, this gives us:
+    ret = []
+    for _, gm in gmms.items():
+        for gm_st in gm:
+            pi_k = []
+            mu_k = []
+            inv_sqrt_det_sigma = []
+            inv_sigma = []
+            for component in gm_st:
+                pi_k.append(component[0])
+                mu_k.append(component[1])
+                sigma2_k = np.asarray(component[2], dtype='float64')
+                inv_sqrt_det_sigma.append(np.exp(-0.5 * log_gconst(sigma2_k)))
+                inv_sigma.append(1.0 / np.array(sigma2_k))
+                assert((inv_sigma[-1] == np.diag(linalg.inv(np.diag(sigma2_k)))).all())
+            ret.append((np.array(pi_k) * np.array(inv_sqrt_det_sigma),
+                    np.array(mu_k).T,
+                    np.array(inv_sigma).T))
+    return ret
+
+
+def budget_frames(bytes_per_frame, budget=None):
+    """ number of frames whose temporaries fit in budget bytes
+    (MEMORY_BUDGET if None), at least 1 """
+    if budget == None:
+        budget = MEMORY_BUDGET
+    return max(1, int(budget // bytes_per_frame))
+
+
+def compute_likelihoods(gmms_, mat, active=None, budget=None):
+    """ compute the log-likelihoods of each states i according to the Gaussian
+    mixture in gmms_[i], for each line of mat (input data), only for the
+    (line, state) pairs of the boolean matrix active if it is given
+    (LOG_ZERO for the others), by chunks of lines whose (lines, D, M)
+    temporaries fit in budget bytes (MEMORY_BUDGET if None). The densities
+    underflow to -inf far from the means, compute_log_likelihoods() does not """
+    ret = np.ndarray((mat.shape[0], len(gmms_)), dtype="float32")
+    ret[:] = 0.0 if active is None else LOG_ZERO
+    n_mixtures = max([mixture[0].shape[0] for mixture in gmms_] + [1])
+    chunk = budget_frames(2 * 8 * mat.shape[1] * n_mixtures, budget)
+    for start in range(0, mat.shape[0], chunk):
+        mat_chunk = mat[start:start+chunk]
+        ret_chunk = ret[start:start+chunk]
+        for state_id, mixture in enumerate(gmms_):
+            pis, mus, inv_sigmas = mixture
+            # N_mixtures = len(pis) = mus.shape[1] = inv_sigmas.shape[1]
+            # N_features = mus.shape[0] = inv_sigmas.shape[0]
+            assert(pis.shape[0] == mus.shape[1])
+            assert(pis.shape[0] == inv_sigmas.shape[1])
+            rows = slice(None) if active is None else \
+                    active[start:start+chunk, state_id]
+            x = mat_chunk[rows]
+            if not x.shape[0]:
+                continue
+            x_minus_mus = np.ndarray((x.shape[0], mus.shape[0], mus.shape[1]))
+            x_minus_mus.T[:,] = x.T
+            x_minus_mus -= mus
+            x_minus_mus = x_minus_mus ** 2
+            x_minus_mus *= inv_sigmas
+            components = np.exp(-0.5 * x_minus_mus.sum(axis=1))
+            ret_chunk[rows, state_id] = np.log(np.dot(components, pis))
+    return ret
+
+
+def tie_states(gmms):
+    """ (physical, columns): the distinct states of gmms (from parse_hmm(),
+    whose tied states are the same object in all the models that use
+    them), as a gmms dict in which each state only is in the first model
+    using it, and the index in physical of each (logical) state of gmms,
+    in the order of phones_mapping() """
+    physical = {}
+    ids = {}
+    columns = []
+    for phn, gm in gmms.items():
+        physical[phn] = []
+        for gm_st in gm:
+            if id(gm_st) not in ids:
+                ids[id(gm_st)] = len(ids)
+                physical[phn].append(gm_st)
+            columns.append(ids[id(gm_st)])
+    return physical, np.array(columns, dtype='int64')
+
+
+def pack_gmms(gmms):
+    """ all the Gaussian components of all the states of gmms (parse_hmm(),
+    in the order of phones_mapping()) packed for compute_log_likelihoods():
+    returns (W, starts), W being the (2D+1, C) matrix such that
+    [x**2, x, 1] . W are the log weighted densities of the C components at
+    x, starts the index of the first component of each state """
+    columns = []
+    starts = []
+    for _, gm in gmms.items():
+        for gm_st in gm:
+            starts.append(len(columns))
+            for component in gm_st:
+                mu_k = np.asarray(component[1], dtype='float64')
+                inv_sigma2_k = 1.0 / np.asarray(component[2], dtype='float64')
+                with np.errstate(divide='ignore'): # null weight: log 0
+                    constant = np.log(component[0]) - 0.5 * (
+                            np.dot(mu_k ** 2, inv_sigma2_k)
+                            + log_gconst(component[2]))
+                columns.append(np.concatenate([-0.5 * inv_sigma2_k,
+                    mu_k * inv_sigma2_k, [constant]]))
+    return np.array(columns).T, np.array(starts, dtype='int64')
+
+
+def quadratic_features(mat):
+    """ [x**2, x, 1] for each line x of mat, in float64 """
+    x = np.asarray(mat, dtype='float64')
+    return np.concatenate([x ** 2, x, np.ones((x.shape[0], 1))], axis=1)
+
+
+def segment_logsumexp(a, starts):
+    """ log(sum(exp(a))) of the columns of a in the segments beginning at
+    starts (non empty, in increasing order), one column per segment """
+    m = np.maximum.reduceat(a, starts, axis=1)
+    m = np.where(np.isfinite(m), m, 0.0)
+    lengths = np.diff(np.append(starts, a.shape[1]))
+    with np.errstate(divide='ignore'):
+        return np.log(np.add.reduceat(np.exp(a - np.repeat(m, lengths,
+            axis=1)), starts, axis=1)) + m
+
+
+def gemm_frames(packed, budget=None):
+    """ frames per matrix multiply of the packed GMMs within budget bytes:
+    [x**2, x, 1] and the log densities (with their exp) in float64 """
+    weights, _ = packed
+    return budget_frames(8 * (weights.shape[0] + 3 * weights.shape[1]),
+            budget)
+
+
+def compute_log_likelihoods(packed, mat, active=None, budget=None, out=None):
+    """ compute_likelihoods() with the GMMs packed by pack_gmms(): the log
+    densities of all the components of all the states are one matrix
+    multiply (BLAS) per chunk of lines of mat (temporaries within budget
+    bytes, MEMORY_BUDGET if None), summed per state in the log domain. Only
+    the (line, state) pairs of the boolean matrix active if it is given (a
+    product per state on its active lines, LOG_ZERO elsewhere). Written in
+    out (float32 (lines, states), e.g. memory mapped) if it is given """
+    weights, starts = packed
+    ret = out
+    if ret is None:
+        ret = np.ndarray((mat.shape[0], starts.shape[0]), dtype="float32")
+    chunk = gemm_frames(packed, budget)
+    ends = np.append(starts[1:], weights.shape[1])
+    for start in range(0, mat.shape[0], chunk):
+        features = quadratic_features(mat[start:start+chunk])
+        if active is None:
+            ret[start:start+chunk] = segment_logsumexp(np.dot(features,
+                weights), starts)
+            continue
+        ret_chunk = ret[start:start+chunk]
+        ret_chunk[:] = LOG_ZERO
+        for state_id, (first, last) in enumerate(zip(starts, ends)):
+            rows = active[start:start+chunk, state_id]
+            if rows.any():
+                ret_chunk[rows, state_id] = logsumexp(np.dot(features[rows],
+                    weights[:, first:last]))
+    return ret
+
+
+def padding(nframes, x):
+    """ padding with (nframes-1)/2 frames before & after for *.mfc mat x"""
+    nframes = int(nframes)
+    ba = (nframes - 1) // 2
+    x_f = np.zeros((x.shape[0], nframes * x.shape[1]), dtype='float32')
+    for i in range(x.shape[0]):
+        x_f[i] = np.pad(x[max(0, i-ba):i+ba+1].flatten(),
+                (max(0, (ba-i) * x.shape[1]), max(0,
+                    ((i+ba+1) - x.shape[0]) * x.shape[1])),
+                'constant', constant_values=(0,0))
+    return x_f
+
+
+def compute_likelihoods_dbn(dbn, mat, depth=np.iinfo(int).max, normalize=True, unit=False):
+    """ compute the log-likelihoods of each states i according to the Deep
+    Belief Network (stacked RBMs) in dbn, for each line of mat (input data)
+    depth is the depth of the DBN at which the likelihoods will pop out,
+    if None, the full DBN is used"""
+    # first normalize or put in the unit ([0-1]) interval
+    # TODO do that only if we did not do that at the full scale of the corpus
+    if normalize:
+        # if the first layer of the DBN is a Gaussian RBM, we need to normalize mat
+        mat = (mat - np.mean(mat, 0)) / np.std(mat, 0)
+    elif unit:
+        # if the first layer of the DBN is a binary RBM, send mat in [0-1] range
+        mat = (mat - np.min(mat, 0)) / np.max(mat, 0)
+
+    import theano.tensor as T
+    ret = np.ndarray((mat.shape[0], dbn.logLayer.b.shape[0].eval()), dtype="float32")
+    from theano import shared#, scan
+    # propagating through the deep belief net
+    batch_size = max(1, mat.shape[0] // N_BATCHES_DATASET)
+    max_layer = dbn.n_layers
+    out_ret = None
+    if depth < dbn.n_layers:
+        max_layer = min(dbn.n_layers, depth)
+        print(max_layer)
+        out_ret = np.ndarray((mat.shape[0], dbn.rbm_layers[max_layer].W.shape[1].eval()), dtype="float32")
+    else:
+        out_ret = np.ndarray((mat.shape[0], dbn.logLayer.b.shape[0].eval()), dtype="float32")
+
+    for ind in range(0, mat.shape[0]+1, batch_size):
+        output = shared(mat[ind:ind+batch_size])
+        print("evaluating the DBN on all the test input")
+        for layer_ind in range(max_layer):
+            [pre, output] = dbn.rbm_layers[layer_ind].propup(output)
+        if depth >= dbn.n_layers:
+            print("dbn output shape", output.shape.eval())
+            ret = T.nnet.softmax(T.dot(output, dbn.logLayer.W) + dbn.logLayer.b)
+            out_ret[ind:ind+batch_size] = T.log(ret).eval()
+        else:
+            out_ret[ind:ind+batch_size] = T.log(output).eval()
+    return out_ret
+
+
+def concatenate(list_of_likelihoods, clines):
+    """ (likelihoods of all the files, map_file_to_start_end) """
+    ends = np.cumsum([x.shape[0] for x in list_of_likelihoods])
+    map_file_to_start_end = dict((cline, (int(end) - x.shape[0], int(end)))
+            for cline, x, end in zip(clines, list_of_likelihoods, ends))
+    return np.concatenate(list_of_likelihoods, axis=0), map_file_to_start_end
+
+
+def scatter_active(active, rows, scores):
+    """ (T, S) likelihoods with the scores (of the frames rows) on the
+    active (frame, state) pairs, LOG_ZERO on the others, 0.0 on the frames
+    that are not in rows (one active state: the same for all the paths) """
+    ret = np.where(active, np.float32(0.0), np.float32(LOG_ZERO))
+    ret[rows] = np.where(active[rows], scores, np.float32(LOG_ZERO))
+    return ret
+
+
+class Scorer(object):
+    """ likelihoods of the HMM states for the features files of an scp, see
+    the module docstring. model_files are the files the likelihoods depend
+    on (digested in the cache keys) """
+    per_file = True # likelihoods of a file only depend on that file
+    per_frame = False # likelihoods of a frame only depend on that frame
+    cacheable = True # worth keeping in a DecodeCache
+
+    def __init__(self, model_files=()):
+        self.model_files = [fname for fname in model_files if fname != None]
+
+    def features(self, cline):
+        """ input of the acoustic model for the features file cline """
+        return htkmfc.open(cline).getall()
+
+    def likelihoods(self, features):
+        """ (T, S) float32 log likelihoods of the HMM states """
+        raise NotImplementedError
+
+    def __call__(self, cline):
+        return self.likelihoods(self.features(cline))
+
+    def key(self, cache, clines=None):
+        """ scorer part of the likelihoods keys in the DecodeCache cache:
+        the model files and, when not per_file, all the files of clines """
+        parts = [cache.file_key(fname) for fname in self.model_files]
+        if not self.per_file:
+            parts.append([(cline, cache.file_key(cline)) for cline in clines])
+        return cache.key(*parts)
+
+    def prepare(self, clines):
+        """ what chunk() needs to know about the whole scp clines """
+        pass
+
+    def chunk(self, clines):
+        """ list of the likelihoods of the files clines (after prepare()) """
+        return [self(cline) for cline in clines]
+
+    def score_all(self, clines):
+        """ (likelihoods of all the files clines, map_file_to_start_end) """
+        self.prepare(clines)
+        return concatenate(self.chunk(clines), clines)
+
+    def likelihoods_active(self, features, active):
+        """ likelihoods() of the (frame, state) pairs of the (T, S) boolean
+        active only (second pass of two_pass.py), see scatter_active() """
+        rows = active.sum(axis=1) > 1
+        if self.per_frame:
+            return scatter_active(active, rows,
+                    self.likelihoods(features[rows]))
+        return scatter_active(active, rows, self.likelihoods(features)[rows])
+
+    def chunk_active(self, clines, list_of_active):
+        """ chunk() of the active pairs only (after prepare()) """
+        return [self.likelihoods_active(self.features(cline), active)
+                for cline, active in zip(clines, list_of_active)]
+
+
+class GmmScorer(Scorer):
+    """ GMMs of the HMMs states (from parse_hmm()), all scored at once in
+    the log domain (see compute_log_likelihoods()). Tied states are scored
+    once (see tie_states()), their columns copied to the models sharing
+    them """
+    per_frame = True
+
+    def __init__(self, gmms, model_files=()):
+        Scorer.__init__(self, model_files)
+        physical, columns = tie_states(gmms)
+        self.columns = None # physical states == logical states
+        if columns.shape[0] != len(set(columns)):
+            self.columns = columns
+            print("scoring", len(set(columns)), "tied states for",
+                    columns.shape[0], "states")
+        self.packed = pack_gmms(physical)
+        self.memory_budget = MEMORY_BUDGET # travels to the workers
+
+    def logical(self, likelihoods):
+        """ the (T, S) likelihoods of the states from those of the tied
+        states """
+        if self.columns is None:
+            return likelihoods
+        return likelihoods[:, self.columns]
+
+    def likelihoods(self, features):
+        return self.logical(compute_log_likelihoods(self.packed, features,
+                budget=self.memory_budget))
+
+    def likelihoods_active(self, features, active):
+        """ all the active pairs, one Gaussian mixture each (once per tied
+        state active in any of its models) """
+        if self.columns is None:
+            return compute_log_likelihoods(self.packed, features, active,
+                    budget=self.memory_budget)
+        physical_active = np.zeros((active.shape[0],
+            self.packed[1].shape[0]), dtype='bool')
+        for state_id, column in enumerate(self.columns):
+            physical_active[:, column] |= active[:, state_id]
+        ret = self.logical(compute_log_likelihoods(self.packed, features,
+            physical_active, budget=self.memory_budget))
+        ret[~active] = LOG_ZERO
+        return ret
+
+
+class DbnScorer(Scorer):
+    """ DBN (stacked RBMs + logistic regression) on the MFCC with adjacent
+    frames, its input being normalized on the whole scp. Its outputs are
+    remapped to the HMM states with the dbn_phones_to_states dict """
+    per_file = False
+
+    def __init__(self, dbn, dbn_phones_to_states, map_states_to_phones,
+            model_files=()):
+        Scorer.__init__(self, model_files)
+        self.dbn = dbn
+        assert set(map_states_to_phones.values()) == set(dbn_phones_to_states.keys()), "Phones differ between the HMM and the DBN"
+        self.columns_remapping = [dbn_phones_to_states[map_states_to_phones[i]]
+                for i in range(len(map_states_to_phones))]
+        self.input_n_frames = dbn.rbm_layers[0].n_visible // N_MFCC
+        print("this is a DBN with", self.input_n_frames,
+                "frames on the input layer")
+        self.mean = None
+        self.std = None
+
+    def features(self, cline):
+        x = htkmfc.open(cline).getall()
+        if self.input_n_frames > 1:
+            x = padding(self.input_n_frames, x)
+        return x
+
+    def likelihoods(self, features, normalize=True):
+        return compute_likelihoods_dbn(self.dbn, features,
+                normalize=normalize)[:, self.columns_remapping]
+
+    def prepare(self, clines):
+        """ mean and standard deviation of the features of all the files
+        clines, as likelihoods(normalize=True) computes them on their
+        concatenation, reading one file at a time """
+        n_frames = 0
+        total = 0.0
+        total_squares = 0.0
+        for cline in clines:
+            x = np.asarray(self.features(cline), dtype='float64')
+            n_frames += x.shape[0]
+            total = total + x.sum(0)
+            total_squares = total_squares + (x ** 2).sum(0)
+        self.mean = total / n_frames
+        self.std = np.sqrt(np.maximum(total_squares / n_frames
+            - self.mean ** 2, 0.0))
+
+    def chunk(self, clines):
+        """ likelihoods of a chunk of files, normalized with the statistics
+        of the whole scp (prepare()), one matrix per file """
+        list_of_features = [self.features(cline) for cline in clines]
+        likelihoods = self.likelihoods(((np.concatenate(list_of_features,
+            axis=0) - self.mean) / self.std).astype('float32'),
+            normalize=False)
+        ends = np.cumsum([x.shape[0] for x in list_of_features])
+        return np.split(likelihoods, ends[:-1], axis=0)
+
+    def chunk_active(self, clines, list_of_active):
+        """ chunk() on the frames with more than one active state only: the
+        DBN scores all the states of a frame at once """
+        list_of_rows = [active.sum(axis=1) > 1 for active in list_of_active]
+        features = np.concatenate([self.features(cline)[rows] for cline, rows
+            in zip(clines, list_of_rows)], axis=0)
+        likelihoods = np.zeros((0, len(self.columns_remapping)),
+                dtype='float32')
+        if features.shape[0]:
+            likelihoods = self.likelihoods(((features - self.mean)
+                / self.std).astype('float32'), normalize=False)
+        ends = np.cumsum([rows.sum() for rows in list_of_rows])
+        return [scatter_active(active, rows, scores) for active, rows, scores
+                in zip(list_of_active, list_of_rows,
+                    np.split(likelihoods, ends[:-1], axis=0))]
+
+    def score_all(self, clines):
+        print("concatenating MFCC files")
+        list_of_features = [self.features(cline) for cline in clines]
+        all_features, map_file_to_start_end = concatenate(list_of_features,
+                clines)
+        list_of_features = None
+        print("computing likelihoods")
+        return self.likelihoods(all_features), map_file_to_start_end
+
+
+class MatrixScorer(Scorer):
+    """ likelihoods computed beforehand: the .npy matrix fname (memory
+    mapped) and its map_file_to_start_end pickled next to it (.pickle) """
+    per_file = False
+    cacheable = False # already on disk
+
+    def __init__(self, fname):
+        Scorer.__init__(self, [fname])
+        self.matrix = np.load(fname, mmap_mode='r')
+        with open(fname[:-4] + '.pickle', 'rb') as f:
+            self.map_file_to_start_end = pickle.load(f)
+        print("loaded the", self.matrix.shape, "likelihoods of",
+                len(self.map_file_to_start_end), "files from", fname)
+
+    def __call__(self, cline):
+        start, end = self.map_file_to_start_end[cline]
+        return np.asarray(self.matrix[start:end], dtype='float32')
+
+    def prepare(self, clines):
+        missing = [cline for cline in clines
+                if cline not in self.map_file_to_start_end]
+        if len(missing):
+            print("no likelihoods for", len(missing), "files, e.g.",
+                    missing[0], file=sys.stderr)
+            sys.exit(-1)
+
+    def score_all(self, clines):
+        self.prepare(clines)
+        return self.matrix, self.map_file_to_start_end
+
+    def chunk_active(self, clines, list_of_active):
+        return [np.where(active, self(cline), np.float32(LOG_ZERO))
+                for cline, active in zip(clines, list_of_active)]
+
+
+def save_scores(fname, likelihoods):
+    """ writes the (likelihoods, map_file_to_start_end) tuple for
+    MatrixScorer(fname) """
+    np.save(fname, np.asarray(likelihoods[0]))
+    with open(fname[:-4] + '.pickle', 'wb') as f:
+        pickle.dump(likelihoods[1], f)
+
+
+def allocate_scores(clines, n_frames, n_states, fname=None, directory=None):
+    """ (SharedArray, map_file_to_start_end) to fill with the likelihoods of
+    the files clines (of n_frames frames): a float32 (sum(n_frames),
+    n_states) matrix shared with the Pool workers (in shared memory, or a
+    memmap file in directory), or the .npy fname shared in place if given
+    (its .pickle map is written, for MatrixScorer(fname)) """
+    ends = np.cumsum(n_frames, dtype='int64')
+    map_file_to_start_end = dict((cline, (int(end) - n, int(end)))
+            for cline, n, end in zip(clines, n_frames, ends))
+    shape = (int(ends[-1]) if len(ends) else 0, n_states)
+    if fname == None:
+        return SharedArray(directory=directory, shape=shape,
+                dtype='float32'), map_file_to_start_end
+    with open(fname[:-4] + '.pickle', 'wb') as f:
+        pickle.dump(map_file_to_start_end, f)
+    np.lib.format.open_memmap(fname, mode='w+', dtype='float32', shape=shape)
+    return SharedArray.from_npy(fname), map_file_to_start_end
+
+
+def load_dbn(idbnfname, idbndictstuple):
+    """ (DBN, dbn_phones_to_states dict) from their pickled files """
+    try:
+        from DBN_Gaussian_timit import DBN # not Gaussian if no GRBM
+    except ImportError:
+        print("experimental: TO BE LAUNCHED FROM THE 'DBN/' DIR", file=sys.stderr)
+        sys.exit(-1)
+    with open(idbnfname, 'rb') as idbnf:
+        dbn = pickle.load(idbnf)
+    with open(idbndictstuple, 'rb') as idbndtf:
+        dbn_phones_to_states = pickle.load(idbndtf)[0]
+    return dbn, dbn_phones_to_states
+
+
+def load_scorer(gmms, map_states_to_phones, ihmmfname, idbnfname=None,
+        idbndictstuple=None, iscoresfname=None, dbn_scorer=DbnScorer):
+    """ the Scorer of the options: the likelihoods matrix iscoresfname,
+    else the DBN idbnfname (with its dicts tuple idbndictstuple, scored by
+    the DbnScorer class dbn_scorer), else the GMMs gmms of ihmmfname """
+    if iscoresfname != None:
+        return MatrixScorer(iscoresfname)
+    if idbnfname != None:
+        dbn, dbn_phones_to_states = load_dbn(idbnfname, idbndictstuple)
+        return dbn_scorer(dbn, dbn_phones_to_states, map_states_to_phones,
+                model_files=[ihmmfname, idbnfname, idbndictstuple])
+    return GmmScorer(gmms, model_files=[ihmmfname])
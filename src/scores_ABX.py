@@ -10,6 +10,8 @@ from batch_viterbi import precompute_det_inv, phones_mapping, parse_hmm
 from batch_viterbi import compute_likelihoods, compute_likelihoods_dbn
 from batch_viterbi import viterbi, initialize_transitions
 from batch_viterbi import penalty_scale, padding
+from batch_viterbi import forward_backward
+from viterbi_kernels import build_topology
 
 INSERTION_PENALTY = 2.5 # penalty of inserting a new phone (in the Viterbi)
 SCALE_FACTOR = 1.0 # importance of the LM w.r.t. the acoustics
@@ -32,6 +34,7 @@ class InnerLoop(object): # to circumvent pickling pbms w/ multiprocessing.map
         self.likelihoods = likelihoods
         self.map_states_to_phones = map_states_to_phones
         self.transitions = transitions
+        self.topology = build_topology(transitions)
         self.using_bigram = using_bigram
     def __call__(self, mfcc_file):
         print("doing", mfcc_file)
@@ -39,25 +42,28 @@ class InnerLoop(object): # to circumvent pickling pbms w/ multiprocessing.map
         if VERBOSE:
             print(mfcc_file)
             print(start, end)
-        _, posteriorgrams = viterbi(self.likelihoods[0][start:end],
-                                   self.transitions, 
-                                   self.map_states_to_phones,
-                                   using_bigram=self.using_bigram)
+        posteriorgrams, phone_posteriorgrams, _, _ = forward_backward(
+                self.likelihoods[0][start:end], self.transitions,
+                self.map_states_to_phones, using_bigram=self.using_bigram,
+                topology=self.topology)
         if DEBUG:
             assert(not (posteriorgrams == np.NaN).any())
-            assert(not (posteriorgrams < -1000.0).all())
+            assert(not (posteriorgrams == 0).all())
             assert(not (self.depth_1_likelihoods[start:end] == np.NaN).any())
             assert(not (self.depth_2_likelihoods[start:end] == np.NaN).any())
             assert(not (self.likelihoods[0][start:end] == np.NaN).any())
             assert(not (self.likelihoods[0][start:end] < -31.0).all())
-        self.write_file(mfcc_file, start, end, posteriorgrams)
-    def write_file(self, mfcc_file, start, end, posteriorgrams):
+        self.write_file(mfcc_file, start, end, posteriorgrams,
+                phone_posteriorgrams)
+    def write_file(self, mfcc_file, start, end, posteriorgrams,
+            phone_posteriorgrams):
         print(">>> written", mfcc_file)
         scipy.io.savemat(mfcc_file[:-4] + APPEND_NAME, mdict={
             'depth_1_likelihoods': self.depth_1_likelihoods[start:end],
             'depth_2_likelihoods': self.depth_2_likelihoods[start:end],
             'likelihoods': self.likelihoods[0][start:end],
-            'posteriors': posteriorgrams})
+            'posteriors': posteriorgrams,
+            'phone_posteriors': phone_posteriorgrams})
 
 
 
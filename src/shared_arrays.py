@@ -0,0 +1,133 @@
+"""
+NumPy arrays shared with the multiprocessing.Pool workers without copies.
+
+Pool.map pickles the callable (InnerLoop, ...) into every task chunk: a
+corpus-wide likelihoods matrix is copied as many times as there are chunks.
+A SharedArray puts the array in a multiprocessing.shared_memory block (or in
+a memmap file of a given directory, when /dev/shm is too small) and pickles
+only its name, shape and dtype: workers attach to the same pages, once per
+process.
+
+    shared = SharedArray(likelihoods)   # in the parent, before the Pool
+    shared.array                        # np.ndarray view, parent or worker
+    shared.close()                      # in the parent, after the Pool
+
+SharedArray(shape=..., dtype=...) allocates an (uninitialized) shared array
+to fill instead of copying one, SharedArray.from_npy(fname) shares an
+existing .npy file in place (kept on close()).
+"""
+
+import os, tempfile
+import numpy as np
+try:
+    from multiprocessing import shared_memory, resource_tracker
+except ImportError: # Python < 3.8: memmap files only
+    shared_memory = None
+
+_attached = {} # name -> (buffer holder, np.ndarray), per process
+
+
+def _attach(name):
+    """ attaches to the shared memory block name without registering it to
+    the resource tracker: a worker forked before the tracker was started
+    would get its own one, which unlinks the block when the worker exits """
+    try:
+        return shared_memory.SharedMemory(name=name, track=False) # >= 3.13
+    except TypeError:
+        register = resource_tracker.register
+        resource_tracker.register = lambda name, rtype: None
+        try:
+            return shared_memory.SharedMemory(name=name)
+        finally:
+            resource_tracker.register = register
+
+
+class SharedArray(object):
+    """ copy of array in shared memory (or a memmap file in directory),
+    pickled by reference, or an uninitialized one of shape and dtype if
+    array is None. The creating process owns it and close()s it """
+    def __init__(self, array=None, directory=None, shape=None, dtype=None):
+        if array is not None:
+            array = np.ascontiguousarray(array)
+            shape, dtype = array.shape, array.dtype
+        dtype = np.dtype(dtype)
+        self.shape = tuple(shape)
+        self.dtype = dtype.str
+        self.owner = True
+        self.keep = False # file removed on close()
+        if directory == None and shared_memory == None:
+            directory = tempfile.gettempdir()
+        if directory != None:
+            fd, self.name = tempfile.mkstemp(suffix='.npy', dir=directory)
+            os.close(fd)
+            self.kind = 'memmap'
+            holder = np.lib.format.open_memmap(self.name, mode='w+',
+                    dtype=dtype, shape=self.shape)
+            if array is not None:
+                holder[...] = array
+                holder.flush()
+            self.array = holder
+        else:
+            self.kind = 'shm'
+            holder = shared_memory.SharedMemory(create=True,
+                    size=max(1, int(np.prod(self.shape)) * dtype.itemsize))
+            self.name = holder.name
+            self.array = np.ndarray(self.shape, dtype=dtype,
+                    buffer=holder.buf)
+            if array is not None:
+                self.array[...] = array
+        _attached[self.name] = (holder, self.array)
+
+    @classmethod
+    def from_npy(cls, fname):
+        """ the .npy file fname shared in place (memory mapped, read-write
+        in the owner), not removed by close() """
+        shared = cls.__new__(cls)
+        holder = np.load(fname, mmap_mode='r+')
+        shared.shape = holder.shape
+        shared.dtype = holder.dtype.str
+        shared.owner = True
+        shared.keep = True
+        shared.kind = 'memmap'
+        shared.name = os.path.abspath(fname)
+        shared.array = holder
+        _attached[shared.name] = (holder, holder)
+        return shared
+
+    def __getstate__(self):
+        return {'shape': self.shape, 'dtype': self.dtype, 'kind': self.kind,
+                'name': self.name}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.owner = False
+        if self.name not in _attached: # first task of this worker
+            if self.kind == 'memmap':
+                holder = np.load(self.name, mmap_mode='r')
+                array = holder
+            else:
+                holder = _attach(self.name)
+                array = np.ndarray(self.shape, dtype=self.dtype,
+                        buffer=holder.buf)
+            array.flags.writeable = False
+            _attached[self.name] = (holder, array)
+        self.array = _attached[self.name][1]
+
+    def close(self):
+        """ frees the shared block (owner only, once the workers are done) """
+        holder, _ = _attached.pop(self.name, (None, None))
+        self.array = None
+        if not self.owner:
+            return
+        if self.kind == 'memmap':
+            if self.keep:
+                holder.flush()
+                return
+            del holder
+            os.remove(self.name)
+        else:
+            holder.unlink()
+            try:
+                holder.close()
+            except BufferError: # views still alive, unmapped at exit
+                pass
@@ -0,0 +1,282 @@
+import numpy as np
+import sys, os, time
+from multiprocessing import Pool, cpu_count
+sys.path.append(os.getcwd())
+sys.path.append('DBN')
+
+import batch_viterbi
+from batch_viterbi import phones_mapping, parse_hmm
+from batch_viterbi import parse_lm, parse_lm_matrix, parse_wdnet
+from batch_viterbi import initialize_transitions, penalty_scale
+from batch_viterbi import viterbi, string_mlf, clean
+from batch_viterbi import states_to_phones_matrix
+from viterbi_kernels import build_topology
+from forced_align import parse_mlf, find_transcript
+from shared_arrays import SharedArray
+from scheduler import JobStats, longest_first, map_longest_first, file_costs
+from scorers import load_scorer, concatenate
+
+usage = """
+python sweep.py OUTPUT_TABLE INPUT_SCP INPUT_HMM INPUT_MLF
+        [--p-grid P1,P2,...] [--s-grid S1,S2,...]
+        [--b INPUT_LM] [--w WDNET] [--ub UNI&BIGRAM_LM]
+        [--sparse] [--beam LOG_BEAM] [--max-active N_STATES]
+        [--d DBN_PICKLED_FILE DBN_TO_INT_TO_STATE_DICTS_TUPLE]
+        [--verbose]
+
+Tunes the insertion penalty (--p) and the grammar scale factor (--s) of
+batch_viterbi.py: the likelihoods of INPUT_SCP are computed once, then every
+(penalty, scale) point of the grid is decoded (penalty_scale() re-applied to
+the same transitions) and scored against the reference phones of INPUT_MLF
+as HResults does (%Corr, Acc, H, D, S, I, N). The results table, best
+accuracy first, is written in OUTPUT_TABLE.
+
+    --p-grid followed by the comma separated insertion penalties to try
+    --s-grid followed by the comma separated grammar scale factors to try
+    the other options are those of batch_viterbi.py (--b, --w and --ub are
+    exclusive, --d must be launched from the 'DBN/' dir)
+"""
+
+VERBOSE = False
+UNIGRAMS_ONLY = False # says if we use only unigrams when we have _our_ bigrams
+MATRIX_BIGRAM = True # is the bigram file format a matrix? (ARPA-MIT if False)
+PENALTY_GRID = [0.0, 1.0, 2.5, 5.0, 10.0] # insertion penalties tried (--p-grid)
+SCALE_GRID = [0.5, 1.0, 2.0, 5.0] # grammar scale factors tried (--s-grid)
+SPARSE_VITERBI = False # Viterbi on the compact topology (phones band + P*P)
+BEAM = None # log score beam w.r.t. the best state of each frame (None: no beam)
+MAX_ACTIVE = None # max number of active states per frame (None: all)
+SUB_PENALTY = 10 # HResults' alignment costs of a substitution,
+DEL_PENALTY = 7 # of a deletion
+INS_PENALTY = 7 # and of an insertion
+
+_topologies = {} # (log transitions name, point) -> Topology, per process
+
+
+def count_errors(ref, hyp):
+    """ aligns the hyp(othesis) phones list on the ref(erence) one with
+    HResults' costs, returns (hits, deletions, substitutions, insertions) """
+    cost = np.zeros((len(ref) + 1, len(hyp) + 1), dtype='int64')
+    cost[:, 0] = np.arange(len(ref) + 1) * DEL_PENALTY
+    cost[0, :] = np.arange(len(hyp) + 1) * INS_PENALTY
+    for i in range(1, len(ref) + 1):
+        for j in range(1, len(hyp) + 1):
+            cost[i, j] = min(cost[i-1, j-1] + (0 if ref[i-1] == hyp[j-1]
+                else SUB_PENALTY), cost[i-1, j] + DEL_PENALTY,
+                cost[i, j-1] + INS_PENALTY)
+    h, d, s, n_ins = 0, 0, 0, 0
+    i, j = len(ref), len(hyp)
+    while i > 0 or j > 0:
+        if i > 0 and j > 0 and cost[i, j] == cost[i-1, j-1] + (
+                0 if ref[i-1] == hyp[j-1] else SUB_PENALTY):
+            if ref[i-1] == hyp[j-1]:
+                h += 1
+            else:
+                s += 1
+            i, j = i - 1, j - 1
+        elif i > 0 and cost[i, j] == cost[i-1, j] + DEL_PENALTY:
+            d += 1
+            i -= 1
+        else:
+            n_ins += 1
+            j -= 1
+    return h, d, s, n_ins
+
+
+class SweepLoop(object): # to circumvent pickling pbms w/ multiprocessing.map
+    """ decodes one utterance for every (penalty, scale) point, the
+    likelihoods and the (points, S, S) log transitions being SharedArray,
+    returns the errors counts per point (None without reference) """
+    def __init__(self, likelihoods, map_file_to_start_end, phones,
+            log_transitions, map_states_to_phones, transcripts,
+            using_bigram=False):
+        self.likelihoods = likelihoods
+        self.map_file_to_start_end = map_file_to_start_end
+        self.phones = phones
+        self.log_transitions = log_transitions
+        self.map_states_to_phones = map_states_to_phones
+        self.phones_matrix = states_to_phones_matrix(map_states_to_phones)
+        self.transcripts = transcripts
+        self.using_bigram = using_bigram
+    def transitions(self, point):
+        return (self.phones, self.log_transitions.array[point])
+    def topology(self, point):
+        if not SPARSE_VITERBI:
+            return None
+        key = (self.log_transitions.name, point)
+        if key not in _topologies: # built once per worker
+            _topologies[key] = build_topology(self.transitions(point))
+        return _topologies[key]
+    def __call__(self, line):
+        cline = clean(line)
+        ref = find_transcript(self.transcripts, cline)
+        if ref == None:
+            print("WARNING: no transcription for", cline, file=sys.stderr)
+            return None
+        if VERBOSE:
+            print(cline)
+        start, end = self.map_file_to_start_end[cline]
+        likelihoods = self.likelihoods.array[start:end]
+        errors = []
+        for point in range(self.log_transitions.shape[0]):
+            states, _ = viterbi(likelihoods, self.transitions(point),
+                    self.map_states_to_phones, using_bigram=self.using_bigram,
+                    topology=self.topology(point), beam=BEAM,
+                    max_active=MAX_ACTIVE)
+            hyp = [line.split()[2] for line in string_mlf(
+                self.map_states_to_phones, states, phones_only=True,
+                phones_matrix=self.phones_matrix).splitlines()]
+            errors.append(count_errors(ref, hyp) + (len(ref),))
+        return errors
+
+
+def string_table(grid, errors):
+    """ results table, best accuracy first, errors being the summed
+    (H, D, S, I, N) of each (penalty, scale) point of grid """
+    rows = []
+    for (penalty, scale), (h, d, s, n_ins, n) in zip(grid, errors):
+        rows.append((100.0 * (h - n_ins) / max(1, n),
+            100.0 * h / max(1, n), penalty, scale, h, d, s, n_ins, n))
+    rows.sort(key=lambda row: -row[0])
+    table = 'penalty\tscale\t%Corr\tAcc\tH\tD\tS\tI\tN\n'
+    for acc, corr, penalty, scale, h, d, s, n_ins, n in rows:
+        table += '%g\t%g\t%.2f\t%.2f\t%d\t%d\t%d\t%d\t%d\n' % (penalty, scale,
+                corr, acc, h, d, s, n_ins, n)
+    return table
+
+
+def process(ofname, iscpfname, ihmmfname, imlffname,
+        ilmfname=None, iwdnetfname=None, unibifname=None,
+        idbnfname=None, idbndictstuple=None):
+    with open(ihmmfname) as ihmmf:
+        n_states, transitions, gmms = parse_hmm(ihmmf)
+    map_states_to_phones = phones_mapping(gmms)
+    with open(imlffname) as imlff:
+        transcripts = parse_mlf(imlff)
+    with open(iscpfname) as iscpf:
+        lines = iscpf.readlines()
+
+    if iwdnetfname != None:
+        with open(iwdnetfname) as iwdnf:
+            transitions = parse_wdnet(transitions, iwdnf) # parse wordnet
+    elif ilmfname != None:
+        with open(ilmfname) as ilmf:
+            if MATRIX_BIGRAM:
+                transitions = parse_lm_matrix(transitions, ilmf)
+            else:
+                transitions = parse_lm(transitions, ilmf)
+    elif unibifname != None:
+        with open(unibifname) as ubf:
+            transitions = initialize_transitions(transitions, ubf,
+                    unigrams_only=UNIGRAMS_ONLY)
+    else:
+        transitions = initialize_transitions(transitions)
+    grid = [(penalty, scale) for penalty in PENALTY_GRID
+            for scale in SCALE_GRID]
+    log_transitions = np.array([penalty_scale(transitions,
+        insertion_penalty=penalty, scale_factor=scale)[1]
+        for penalty, scale in grid])
+
+    dummy = np.zeros((2,2)) # to force only 1 compile of the Viterbi kernel
+    viterbi(dummy, [None, dummy], {}) # (before forking the Pool workers)
+
+    start_time = time.time()
+    print("computing likelihoods")
+    p = Pool(cpu_count())
+    clines = [clean(line) for line in lines]
+    scorer = load_scorer(gmms, map_states_to_phones, ihmmfname,
+            idbnfname=idbnfname, idbndictstuple=idbndictstuple)
+    if scorer.per_file: # GMMs, in the Pool
+        job_stats = JobStats(cpu_count(), names=clines)
+        likelihoods, map_file_to_start_end = concatenate(map_longest_first(p,
+            scorer, clines, file_costs(clines), stats=job_stats), clines)
+        job_stats.report("likelihoods")
+    else: # DBN, normalized on the whole scp
+        likelihoods, map_file_to_start_end = scorer.score_all(clines)
+    n_frames = [map_file_to_start_end[cline][1]
+            - map_file_to_start_end[cline][0] for cline in clines]
+    print("likelihoods of", len(lines), "files computed in",
+            "%.2f" % (time.time() - start_time), "s")
+
+    print("decoding", len(grid), "(penalty, scale) points")
+    shared = (SharedArray(likelihoods), SharedArray(log_transitions))
+    sl = SweepLoop(shared[0], map_file_to_start_end, transitions[0],
+            shared[1], map_states_to_phones, transcripts,
+            using_bigram=(ilmfname != None or iwdnetfname != None
+                or unibifname != None or batch_viterbi.FORCE_ENTER_EXIT))
+    errors = np.zeros((len(grid), 5), dtype='int64')
+    job_stats = JobStats(cpu_count(), names=[clean(l) for l in lines])
+    for _, utterance_errors in longest_first(p, sl, lines, n_frames,
+            stats=job_stats):
+        if utterance_errors != None:
+            errors += np.array(utterance_errors)
+    p.close()
+    p.join()
+    job_stats.report("sweep")
+    for shared_array in shared:
+        shared_array.close()
+    table = string_table(grid, errors)
+    with open(ofname, 'w') as of:
+        of.write(table)
+    print("done in", "%.2f" % (time.time() - start_time), "s, best point:")
+    print('\n'.join(table.split('\n')[:2]))
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 4:
+        if '--help' in sys.argv:
+            print(usage)
+            sys.exit(0)
+        args = dict(enumerate(sys.argv))
+        options = [ind_x for ind_x in enumerate(sys.argv) if '--' in ind_x[1][0:2]]
+        input_unibi_fname = None # my bigram LM
+        input_lm_fname = None # HStats bigram LMs (either matrix of ARPA-MIT)
+        input_wdnet_fname = None # HTK's wdnet (with bigram probas)
+        dbn_fname = None # DBN cPickle
+        dbn_dicts_fname = None # DBN to_int and to_states dicts tuple
+        for ind, option in options:
+            args.pop(ind)
+            if option == '--v' or option == '--verbose':
+                VERBOSE = True
+            if option == '--sparse':
+                SPARSE_VITERBI = True
+            if option == '--beam':
+                BEAM = float(args[ind+1])
+                args.pop(ind+1)
+            if option == '--max-active':
+                MAX_ACTIVE = int(args[ind+1])
+                args.pop(ind+1)
+            if option == '--p-grid':
+                PENALTY_GRID = [float(x) for x in args[ind+1].split(',')]
+                args.pop(ind+1)
+            if option == '--s-grid':
+                SCALE_GRID = [float(x) for x in args[ind+1].split(',')]
+                args.pop(ind+1)
+            if option == '--ub':
+                input_unibi_fname = args[ind+1]
+                args.pop(ind+1)
+            if option == '--b':
+                input_lm_fname = args[ind+1]
+                args.pop(ind+1)
+            if option == '--w':
+                input_wdnet_fname = args[ind+1]
+                args.pop(ind+1)
+            if option == '--d':
+                if not (ind+2) in args:
+                    print("We need the DBN and the states/phones mapping", file=sys.stderr)
+                    print(usage, file=sys.stderr)
+                    sys.exit(-1)
+                dbn_fname = args[ind+1]
+                args.pop(ind+1)
+                dbn_dicts_fname = args[ind+2]
+                args.pop(ind+2)
+        output_fname = list(args.values())[1]
+        input_scp_fname = list(args.values())[2]
+        input_hmm_fname = list(args.values())[3]
+        input_mlf_fname = list(args.values())[4]
+        process(output_fname, input_scp_fname, input_hmm_fname,
+                input_mlf_fname, ilmfname=input_lm_fname,
+                iwdnetfname=input_wdnet_fname, unibifname=input_unibi_fname,
+                idbnfname=dbn_fname, idbndictstuple=dbn_dicts_fname)
+    else:
+        print(usage)
+        sys.exit(-1)
@@ -0,0 +1,110 @@
+"""
+Two-pass decoding: a cheap acoustic model selects the (frame, state) pairs
+that the expensive one (DBN, GMMs with many mixtures) scores.
+
+The first pass scores the utterance with the GMMs of another HMM set with
+the same states (e.g. an earlier HERest iteration with fewer mixtures) and
+runs the max forward-backward on the compact Topology: alpha[t, s] + beta[t,
+s] is the score of the best path through state s at frame t, the pairs
+within beam of the best path are active (the first pass best path always
+is). The second pass scores only the active pairs (LOG_ZERO elsewhere, see
+Scorer.likelihoods_active() in scorers.py) and the decoder searches them:
+the GMMs are evaluated per (frame, state) pair, the DBN (whose softmax
+needs all its outputs) on the frames with more than one active state only:
+a frame with a single active state adds the same score to all the paths
+(0.0, left out of the MLF scores).
+
+    likelihoods = two_pass_likelihoods(pool, first_scorer, scorer, clines,
+            topology, init, final)
+    # (matrix, map_file_to_start_end), as Scorer.score_all()
+"""
+
+import numpy as np
+from viterbi_kernels import LOG_ZERO, sparse_step, transpose_topology
+from scorers import concatenate
+
+TWO_PASS_BEAM = 50.0 # log score beam of the active pairs w.r.t. the best path
+TWO_PASS_CHUNK = 16 # files scored at once in the parent by the DBN
+
+
+def active_pairs(likelihoods, topology, init, final=None, beam=TWO_PASS_BEAM,
+        back_topology=None):
+    """ (T, S) booleans: the (frame, state) pairs on a path that scores
+    within beam of the best one, init and final are the log scores before
+    the first and after the last frame (final=None, or no path ending in
+    final: all states can end) """
+    n_frames, n_states = likelihoods.shape
+    if back_topology is None:
+        back_topology = transpose_topology(topology)
+    alpha = np.ndarray((n_frames, n_states), dtype='float64')
+    alpha[0] = init + likelihoods[0]
+    for i in range(1, n_frames):
+        alpha[i] = sparse_step(topology, alpha[i-1], likelihoods[i])[0]
+    if final is None or (alpha[-1] + final).max() == LOG_ZERO:
+        final = np.zeros(n_states)
+    beta = np.ndarray((n_frames, n_states), dtype='float64')
+    beta[-1] = final
+    for i in range(n_frames - 2, -1, -1):
+        beta[i] = sparse_step(back_topology, beta[i+1] + likelihoods[i+1],
+                0.0)[0]
+    alpha += beta
+    return alpha >= (alpha[-1].max() - beam)
+
+
+class FirstPassLoop(object): # to circumvent pickling pbms w/ multiprocessing.map
+    """ active_pairs() of one scp line, scored by the (per file) Scorer
+    first_scorer """
+    def __init__(self, first_scorer, topology, init, final=None,
+            beam=TWO_PASS_BEAM):
+        self.first_scorer = first_scorer
+        self.topology = topology
+        self.back_topology = transpose_topology(topology)
+        self.init = init
+        self.final = final
+        self.beam = beam
+    def __call__(self, cline):
+        return active_pairs(self.first_scorer(cline), self.topology,
+                self.init, final=self.final, beam=self.beam,
+                back_topology=self.back_topology)
+
+
+class SecondPassLoop(object): # to circumvent pickling pbms w/ multiprocessing.map
+    """ likelihoods of the active pairs of one (scp line, active) tuple by
+    the (per file) Scorer scorer """
+    def __init__(self, scorer):
+        self.scorer = scorer
+    def __call__(self, cline_active):
+        cline, active = cline_active
+        return self.scorer.likelihoods_active(self.scorer.features(cline),
+                active)
+
+
+def two_pass_likelihoods(pool, first_scorer, scorer, clines, topology, init,
+        final=None, beam=TWO_PASS_BEAM, chunk=TWO_PASS_CHUNK):
+    """ likelihoods of the files clines by scorer on the pairs that the
+    first pass (first_scorer, in the Pool pool) keeps, (matrix,
+    map_file_to_start_end) as Scorer.score_all(). Scorers that are not
+    per_file are prepare()d on the whole scp and score chunk files at once
+    in this process """
+    print("first pass")
+    list_of_active = pool.map(FirstPassLoop(first_scorer, topology, init,
+        final=final, beam=beam), clines)
+    n_pairs = sum(active.sum() for active in list_of_active)
+    n_total = sum(active.size for active in list_of_active)
+    n_frames = sum((active.sum(axis=1) > 1).sum()
+            for active in list_of_active)
+    n_total_frames = sum(active.shape[0] for active in list_of_active)
+    print("second pass on", "%.1f%%" % (100.0 * n_pairs / max(1, n_total)),
+            "of the (frame, state) pairs,", "%.1f%%" % (100.0 * n_frames
+                / max(1, n_total_frames)), "of the frames")
+    if scorer.per_file:
+        list_of_likelihoods = pool.map(SecondPassLoop(scorer),
+                list(zip(clines, list_of_active)))
+    else:
+        scorer.prepare(clines)
+        list_of_likelihoods = []
+        for start in range(0, len(clines), chunk):
+            list_of_likelihoods += scorer.chunk_active(
+                    clines[start:start + chunk],
+                    list_of_active[start:start + chunk])
+    return concatenate(list_of_likelihoods, clines)
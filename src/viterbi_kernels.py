@@ -0,0 +1,553 @@
+"""
+Viterbi search kernels used by viterbi.py and batch_viterbi.py.
+
+The transition matrix built by parse_hmm() + initialize_transitions() (or
+parse_lm*/parse_wdnet) is almost empty: left-to-right arcs inside each phone
+plus arcs from the last state of a phone to the first state of every phone.
+build_topology() extracts that structure once so that the recursion costs
+O(T.(S.K + P^2)) instead of O(T.S^2) (K: predecessors inside a phone,
+P: number of phones).
+
+Without a Topology, the dense recursion is vectorized per frame with NumPy
+(one broadcast max/argmax over the log transitions matrix), or done by a
+compiled (numba) kernel when numba is installed.
+
+run_viterbi_batch() decodes N utterances at once from a padded
+(N, T_max, S) likelihoods tensor, the *_step functions broadcast over N.
+
+run_viterbi_lean() keeps two rows of scores and compact (or memmap spilled)
+backpointers, or only checkpoint rows of scores (square-root traceback), for
+long utterances.
+
+run_forward_backward() is the log-domain (logsumexp) forward-backward on
+the same steps (*_sum_step), for states posteriors.
+
+OnlineViterbi consumes the likelihoods frame by frame and emits the states
+on which all the surviving paths agree (partial traceback), with a bounded
+delay, for long recordings.
+"""
+
+import functools
+from collections import deque
+import numpy as np
+try:
+    import numba
+except ImportError:
+    numba = None
+
+LOG_ZERO = -np.inf # log proba of pruned / impossible states
+LOG_FLOOR = -150.0 # log probas below that are epsilon_log padding (1E-80)
+BACKENDS = ['auto', 'numpy', 'compiled'] # 'auto' is compiled if available
+
+
+class Topology:
+    """ compact view of the (log) transitions between the HMM states:
+        * pred_from[j] / pred_logp[j]: predecessors of state j inside its
+          phone and their log transition (padded with LOG_ZERO),
+        * exits[p] / entries[p]: last / first state of phone p,
+        * inter_logp[p, q]: log transition from exits[p] to entries[q]
+    """
+    def __init__(self, pred_from, pred_logp, exits, entries, inter_logp):
+        self.pred_from = pred_from
+        self.pred_logp = pred_logp
+        self.exits = exits
+        self.entries = entries
+        self.inter_logp = inter_logp
+        self.n_states = pred_from.shape[0]
+
+    def __repr__(self):
+        return "Topology: " + str(self.n_states) + " states, " + \
+                str(self.exits.shape[0]) + " phones, " + \
+                str(self.pred_from.shape[1]) + " predecessors max per state"
+
+
+def build_topology(transitions):
+    """ builds the Topology from the (phones dict, log transitions matrix)
+    tuple returned by penalty_scale(). Arcs that are not inside a phone or
+    from a phone's last state to a phone's first state are dropped (they only
+    carry the epsilon_log padding) """
+    phones, log_trans = transitions
+    n_states = log_trans.shape[0]
+    preds = [[] for _ in range(n_states)]
+    exits = []
+    entries = []
+    for phn, phone in phones.items():
+        ind = phone.to_ind
+        exits.append(ind[-1])
+        entries.append(ind[0])
+        for k in ind:
+            for j in ind:
+                if k == ind[-1] and j == ind[0]: # phone to phone, see below
+                    continue
+                if log_trans[k][j] > LOG_FLOOR:
+                    preds[j].append(k)
+    n_preds = max(1, max(len(p) for p in preds))
+    pred_from = np.zeros((n_states, n_preds), dtype='int64')
+    pred_logp = np.ndarray((n_states, n_preds), dtype='float64')
+    pred_logp[:] = LOG_ZERO
+    for j, p in enumerate(preds):
+        pred_from[j, :len(p)] = p
+        pred_logp[j, :len(p)] = log_trans[p, j]
+    exits = np.array(exits, dtype='int64')
+    entries = np.array(entries, dtype='int64')
+    inter_logp = np.array(log_trans[np.ix_(exits, entries)], dtype='float64')
+    return Topology(pred_from, pred_logp, exits, entries, inter_logp)
+
+
+def sparse_step(topology, prev, likelihoods_t):
+    """ one frame of the Viterbi recursion on the Topology, works on
+    prev scores of shape (S,) or (N, S) for N utterances at once.
+    Returns (scores, backpointers) for this frame """
+    t = topology
+    # intra-phone band
+    cand = prev[..., t.pred_from] + t.pred_logp # (..., S, K)
+    k = cand.argmax(axis=-1)
+    scores = np.take_along_axis(cand, k[..., None], axis=-1)[..., 0]
+    bp = t.pred_from[np.arange(t.n_states), k]
+    if not t.exits.shape[0]: # linear graph (forced alignment), all in the band
+        scores += likelihoods_t
+        return scores, bp
+    # phone exit -> phone entry, only from the active exits if pruned
+    exits = t.exits
+    inter_logp = t.inter_logp
+    if prev.ndim == 1:
+        active = np.flatnonzero(prev[exits] > LOG_ZERO)
+        if 0 < active.shape[0] < exits.shape[0]:
+            exits = exits[active]
+            inter_logp = inter_logp[active]
+    inter = prev[..., exits][..., :, None] + inter_logp # (..., P, P)
+    p = inter.argmax(axis=-2)
+    best = np.take_along_axis(inter, p[..., None, :], axis=-2)[..., 0, :]
+    entry_scores = scores[..., t.entries]
+    better = best > entry_scores
+    scores[..., t.entries] = np.where(better, best, entry_scores)
+    bp[..., t.entries] = np.where(better, exits[p], bp[..., t.entries])
+    scores += likelihoods_t
+    return scores, bp
+
+
+def dense_step(log_trans, prev, likelihoods_t):
+    """ one frame of the dense Viterbi recursion (max-plus product of the
+    previous scores by the log transitions matrix), works on prev scores of
+    shape (S,) or (N, S). Returns (scores, backpointers) for this frame """
+    if prev.ndim == 1: # only expand the active (not pruned) states
+        active = np.flatnonzero(prev > LOG_ZERO)
+        if 0 < active.shape[0] < prev.shape[0] // 2:
+            cand = prev[active][:, None] + log_trans[active] # (A, S)
+            k = cand.argmax(axis=0)
+            scores = cand[k, np.arange(cand.shape[1])] + likelihoods_t
+            return scores, active[k]
+    cand = prev[..., :, None] + log_trans # (..., S, S)
+    bp = cand.argmax(axis=-2)
+    scores = np.take_along_axis(cand, bp[..., None, :], axis=-2)[..., 0, :]
+    scores += likelihoods_t
+    return scores, bp
+
+
+def prune(scores, beam=None, max_active=None):
+    """ beam (log score below the best one of the frame) and histogram
+    (max_active states at most) pruning of the scores of shape (S,) or
+    (N, S), in place. Returns the number of active states """
+    if beam is not None:
+        best = scores.max(axis=-1)
+        scores[scores < (best - beam)[..., None]] = LOG_ZERO
+    if max_active is not None and max_active < scores.shape[-1]:
+        kth = scores.shape[-1] - max_active
+        threshold = np.partition(scores, kth, axis=-1)[..., kth]
+        scores[scores < threshold[..., None]] = LOG_ZERO
+    return (scores > LOG_ZERO).sum()
+
+
+def run_viterbi(likelihoods, step, init, beam=None, max_active=None,
+        stats=None):
+    """ runs the Viterbi recursion with step (one of the *_step functions
+    with its transitions bound), init are the log scores at t=0 before the
+    emission. beam and max_active are for prune(), stats (dict) gets the
+    number of 'frames' and the total number of 'active' states.
+    Returns (posteriors, backpointers) """
+    posteriors = np.ndarray(likelihoods.shape, dtype='float64')
+    backpointers = np.ndarray((likelihoods.shape[0] - 1, likelihoods.shape[1]),
+            dtype='int64')
+    posteriors[0] = init + likelihoods[0]
+    n_active = prune(posteriors[0], beam, max_active)
+    for i in range(1, likelihoods.shape[0]):
+        posteriors[i], backpointers[i-1] = step(posteriors[i-1],
+                likelihoods[i])
+        n_active += prune(posteriors[i], beam, max_active)
+    if stats is not None:
+        stats['frames'] = stats.get('frames', 0) + likelihoods.shape[0]
+        stats['active'] = stats.get('active', 0) + n_active
+    return posteriors, backpointers
+
+
+def viterbi_sparse(likelihoods, topology, init, beam=None, max_active=None,
+        stats=None):
+    """ Viterbi recursion on the Topology, see run_viterbi() """
+    return run_viterbi(likelihoods, functools.partial(sparse_step, topology),
+            init, beam=beam, max_active=max_active, stats=stats)
+
+
+def run_viterbi_batch(likelihoods, lengths, step, init, beam=None,
+        max_active=None, stats=None):
+    """ runs the Viterbi recursion for N utterances at once, likelihoods is
+    a (N, T_max, S) tensor padded after lengths[n] frames for utterance n.
+    Scores of finished utterances are carried over the padding frames (with
+    identity backpointers) so that each one can be traced back from
+    T_max - 1. See run_viterbi() for the other parameters.
+    Returns (posteriors, backpointers) of shapes (N, T_max, S), (N, T_max-1, S)
+    """
+    n_utts, t_max, n_states = likelihoods.shape
+    lengths = np.asarray(lengths)
+    posteriors = np.ndarray(likelihoods.shape, dtype='float64')
+    backpointers = np.ndarray((n_utts, t_max - 1, n_states), dtype='int64')
+    identity = np.arange(n_states)
+    posteriors[:, 0] = init + likelihoods[:, 0]
+    prune(posteriors[:, 0], beam, max_active)
+    n_active = (posteriors[:, 0] > LOG_ZERO).sum()
+    for i in range(1, t_max):
+        scores, bp = step(posteriors[:, i-1], likelihoods[:, i])
+        done = lengths <= i
+        scores[done] = posteriors[done, i-1]
+        bp[done] = identity
+        posteriors[:, i] = scores
+        backpointers[:, i-1] = bp
+        prune(posteriors[:, i], beam, max_active)
+        n_active += (posteriors[~done, i] > LOG_ZERO).sum()
+    if stats is not None:
+        stats['frames'] = stats.get('frames', 0) + lengths.sum()
+        stats['active'] = stats.get('active', 0) + n_active
+    return posteriors, backpointers
+
+
+def pad_likelihoods(list_of_likelihoods):
+    """ stacks (T_n, S) likelihoods matrices in a (N, T_max, S) tensor,
+    returns (tensor, lengths) """
+    lengths = np.array([l.shape[0] for l in list_of_likelihoods])
+    padded = np.zeros((len(list_of_likelihoods), lengths.max(),
+        list_of_likelihoods[0].shape[1]), dtype=list_of_likelihoods[0].dtype)
+    for n, l in enumerate(list_of_likelihoods):
+        padded[n, :l.shape[0]] = l
+    return padded, lengths
+
+
+def traceback(backpointers, last_state):
+    """ best states path ending in last_state at the last frame """
+    states = np.ndarray(backpointers.shape[0] + 1, dtype='int64')
+    states[-1] = last_state
+    for i in range(backpointers.shape[0] - 1, -1, -1):
+        states[i] = backpointers[i][states[i+1]]
+    return states
+
+
+def backpointers_dtype(n_states):
+    """ smallest unsigned integer dtype that can index n_states states """
+    for dtype in ['uint8', 'uint16', 'uint32']:
+        if n_states - 1 <= np.iinfo(dtype).max:
+            return np.dtype(dtype)
+    return np.dtype('int64')
+
+
+def path_scores(likelihoods, step, init, states):
+    """ scores (posteriors) of the states of a Viterbi path at each frame,
+    recomputed by stepping from the path's previous state only """
+    scores = np.ndarray(likelihoods.shape[0], dtype='float64')
+    scores[0] = init[states[0]] + likelihoods[0][states[0]]
+    prev = np.ndarray(likelihoods.shape[1], dtype='float64')
+    for i in range(1, likelihoods.shape[0]):
+        prev[:] = LOG_ZERO
+        prev[states[i-1]] = scores[i-1]
+        scores[i] = step(prev, likelihoods[i])[0][states[i]]
+    return scores
+
+
+def run_viterbi_lean(likelihoods, step, init, last_state=None, beam=None,
+        max_active=None, stats=None, checkpoint=None, spill=None):
+    """ memory-lean run_viterbi() + traceback(), only two rows of scores
+    are kept during the recursion and:
+        * the backpointers are stored in the smallest integer dtype
+          (backpointers_dtype), in memory, or in a memmap file if spill (a
+          file name) is given,
+        * or, if checkpoint is given, only a row of scores every checkpoint
+          frames (0: sqrt(T)) is kept and the backpointers are recomputed one
+          segment at a time during the traceback, O(sqrt(T).S) memory for
+          twice the computation.
+    The path ends in last_state if it is given and active, in the best
+    state otherwise. See run_viterbi() for the other parameters.
+    Returns (states, their scores along the path) """
+    n_frames, n_states = likelihoods.shape
+    dtype = backpointers_dtype(n_states)
+    if checkpoint is not None:
+        checkpoint = checkpoint or max(1, int(np.sqrt(n_frames)))
+        checkpoints = []
+    elif spill is not None:
+        backpointers = np.memmap(spill, dtype=dtype, mode='w+',
+                shape=(max(1, n_frames - 1), n_states))
+    else:
+        backpointers = np.ndarray((n_frames - 1, n_states), dtype=dtype)
+    scores = init + likelihoods[0]
+    n_active = prune(scores, beam, max_active)
+    for i in range(1, n_frames):
+        if checkpoint is not None and (i - 1) % checkpoint == 0:
+            checkpoints.append(scores)
+        scores, bp = step(scores, likelihoods[i])
+        if checkpoint is None:
+            backpointers[i-1] = bp
+        n_active += prune(scores, beam, max_active)
+    if stats is not None:
+        stats['frames'] = stats.get('frames', 0) + n_frames
+        stats['active'] = stats.get('active', 0) + n_active
+    if last_state is None or scores[last_state] == LOG_ZERO:
+        last_state = scores.argmax()
+
+    if checkpoint is None:
+        states = traceback(backpointers[:n_frames - 1], last_state)
+        del backpointers # closes the memmap
+        return states, path_scores(likelihoods, step, init, states)
+    states = np.ndarray(n_frames, dtype='int64')
+    states_scores = np.ndarray(n_frames, dtype='float64')
+    states[-1] = last_state
+    states_scores[-1] = scores[last_state]
+    for k in range(len(checkpoints) - 1, -1, -1):
+        start = k * checkpoint
+        end = min(start + checkpoint, n_frames - 1) # last frame, included
+        rows = np.ndarray((end - start + 1, n_states), dtype='float64')
+        backpointers = np.ndarray((end - start, n_states), dtype=dtype)
+        rows[0] = checkpoints.pop()
+        for i in range(start + 1, end + 1):
+            rows[i-start], backpointers[i-start-1] = step(rows[i-start-1],
+                    likelihoods[i])
+            prune(rows[i-start], beam, max_active)
+        for i in range(end, start, -1):
+            states_scores[i] = rows[i-start][states[i]]
+            states[i-1] = backpointers[i-start-1][states[i]]
+        states_scores[start] = rows[0][states[start]]
+    return states, states_scores
+
+
+def logsumexp(a, axis=-1):
+    """ log(sum(exp(a))) along axis, -inf if all of a is -inf """
+    m = a.max(axis=axis)
+    m = np.where(np.isfinite(m), m, 0.0)
+    with np.errstate(divide='ignore'):
+        return np.log(np.exp(a - np.expand_dims(m, axis)).sum(axis=axis)) + m
+
+
+def transpose_topology(topology):
+    """ Topology of the reversed arcs (successors instead of predecessors),
+    for the backward recursion """
+    t = topology
+    succs = [[] for _ in range(t.n_states)]
+    for j in range(t.n_states):
+        for k, logp in zip(t.pred_from[j], t.pred_logp[j]):
+            if logp > LOG_ZERO:
+                succs[k].append((j, logp))
+    n_succs = max(1, max(len(s) for s in succs))
+    succ_from = np.zeros((t.n_states, n_succs), dtype='int64')
+    succ_logp = np.ndarray((t.n_states, n_succs), dtype='float64')
+    succ_logp[:] = LOG_ZERO
+    for k, s in enumerate(succs):
+        for i, (j, logp) in enumerate(s):
+            succ_from[k, i] = j
+            succ_logp[k, i] = logp
+    return Topology(succ_from, succ_logp, t.entries, t.exits,
+            np.ascontiguousarray(t.inter_logp.T))
+
+
+def sparse_sum_step(topology, prev, likelihoods_t):
+    """ sparse_step() with a (log) sum instead of a max: one frame of the
+    forward recursion, or of the backward one on transpose_topology() """
+    t = topology
+    scores = logsumexp(prev[..., t.pred_from] + t.pred_logp, axis=-1)
+    if t.exits.shape[0]:
+        inter = logsumexp(prev[..., t.exits][..., :, None] + t.inter_logp,
+                axis=-2)
+        scores[..., t.entries] = np.logaddexp(scores[..., t.entries], inter)
+    return scores + likelihoods_t
+
+
+def dense_sum_step(log_trans, prev, likelihoods_t):
+    """ dense_step() with a (log) sum instead of a max, the backward
+    recursion uses the transposed log transitions """
+    return logsumexp(prev[..., :, None] + log_trans, axis=-2) + likelihoods_t
+
+
+def run_forward_backward(likelihoods, lengths, step, back_step, init,
+        final=None):
+    """ log-domain forward-backward on a (N, T_max, S) likelihoods tensor
+    padded after lengths[n] frames (see pad_likelihoods()), step and
+    back_step are *_sum_step functions with their (transposed for
+    back_step) transitions bound, init and final the log scores before the
+    first and after the last frame (final=None: all states can end).
+    Returns (states posteriors (N, T_max, S), 0 on the padding frames, and
+    the log likelihood of each utterance (N,)) """
+    n_utts, t_max, n_states = likelihoods.shape
+    lengths = np.asarray(lengths)
+    if final is None:
+        final = np.zeros(n_states)
+    alpha = np.ndarray(likelihoods.shape, dtype='float64')
+    alpha[:, 0] = init + likelihoods[:, 0]
+    for i in range(1, t_max):
+        alpha[:, i] = step(alpha[:, i-1], likelihoods[:, i])
+    beta = np.ndarray(likelihoods.shape, dtype='float64')
+    beta[:, -1] = final
+    for i in range(t_max - 2, -1, -1):
+        beta[:, i] = back_step(beta[:, i+1] + likelihoods[:, i+1], 0.0)
+        beta[i >= lengths - 1, i] = final
+    log_likelihood = logsumexp(alpha[np.arange(n_utts), lengths - 1] + final)
+    alpha += beta
+    alpha -= log_likelihood[:, None, None]
+    posteriors = np.exp(alpha, out=alpha)
+    posteriors[np.arange(t_max)[None, :] >= lengths[:, None]] = 0.0
+    return posteriors, log_likelihood
+
+
+class OnlineViterbi:
+    """ frame-synchronous Viterbi with partial traceback: push() one frame
+    of likelihoods at a time, it returns the [(state, posterior)] of the
+    frames that are decided (common prefix of all the active paths), and
+    finish() returns the remaining ones. Only the undecided frames are kept,
+    at most max_delay frames (None: unbounded): beyond that the best path
+    is committed and the paths that disagree with it are dropped.
+    step, init, beam and max_active are as in run_viterbi() """
+    def __init__(self, step, init, beam=None, max_active=None,
+            max_delay=None, traceback_interval=10):
+        self.step = step
+        self.init = init
+        self.beam = beam
+        self.max_active = max_active
+        self.max_delay = max_delay
+        self.traceback_interval = traceback_interval
+        self.posteriors = deque() # undecided frames scores
+        self.backpointers = deque() # to the previous frame, but the first
+        self.n_frames = 0
+        self.n_active = 0
+
+    def push(self, likelihoods_t):
+        if self.n_frames == 0:
+            scores = self.init + likelihoods_t
+        else:
+            scores, bp = self.step(self.posteriors[-1], likelihoods_t)
+            self.backpointers.append(bp)
+        self.n_active += prune(scores, self.beam, self.max_active)
+        self.posteriors.append(scores)
+        self.n_frames += 1
+        decided = []
+        if self.n_frames % self.traceback_interval == 0:
+            decided = self._partial_traceback()
+        if self.max_delay is not None and \
+                len(self.posteriors) > self.max_delay:
+            decided += self._force_decision(len(self.posteriors) 
+                    - max(1, self.max_delay // 2))
+        return decided
+
+    def finish(self, last_state=None):
+        """ decides the remaining frames, ending in last_state if it is
+        given and active, in the best state otherwise """
+        if not len(self.posteriors):
+            return []
+        if last_state is None or self.posteriors[-1][last_state] == LOG_ZERO:
+            last_state = self.posteriors[-1].argmax()
+        return self._commit(len(self.posteriors), last_state)
+
+    def _commit(self, n, state):
+        """ decides the n oldest undecided frames, the nth one in state """
+        states = [state]
+        for i in range(n - 2, -1, -1):
+            states.append(self.backpointers[i][states[-1]])
+        states.reverse()
+        decided = []
+        for state in states:
+            decided.append((state, self.posteriors.popleft()[state]))
+            if len(self.backpointers) and \
+                    len(self.backpointers) >= len(self.posteriors):
+                self.backpointers.popleft()
+        return decided
+
+    def _partial_traceback(self):
+        active = np.flatnonzero(self.posteriors[-1] > LOG_ZERO)
+        for i in range(len(self.backpointers) - 1, -1, -1):
+            active = np.unique(self.backpointers[i][active])
+            if active.shape[0] == 1: # all paths go through this state
+                return self._commit(i + 1, active[0])
+        return []
+
+    def _force_decision(self, n):
+        """ decides the n oldest frames along the best path and drops the
+        active states whose paths do not go through it """
+        ancestors = np.arange(self.posteriors[-1].shape[0])
+        for i in range(len(self.backpointers) - 1, n - 2, -1):
+            ancestors = self.backpointers[i][ancestors]
+        state = ancestors[self.posteriors[-1].argmax()]
+        self.posteriors[-1][ancestors != state] = LOG_ZERO
+        return self._commit(n, state)
+
+
+if numba is not None:
+    @numba.njit(cache=True)
+    def _compiled_dense(likelihoods, log_trans, posteriors, backpointers,
+            beam, max_active):
+        n_states = likelihoods.shape[1]
+        best = np.empty(n_states)
+        best_ind = np.empty(n_states, dtype=np.int64)
+        n_active = 0
+        for i in range(1, likelihoods.shape[0]):
+            best[:] = -np.inf
+            best_ind[:] = 0
+            for k in range(n_states):
+                prev = posteriors[i-1, k]
+                if prev == -np.inf:
+                    continue
+                for j in range(n_states):
+                    tmp_prob = prev + log_trans[k, j]
+                    if tmp_prob > best[j]:
+                        best[j] = tmp_prob
+                        best_ind[j] = k
+            for j in range(n_states):
+                posteriors[i, j] = best[j] + likelihoods[i, j]
+                backpointers[i-1, j] = best_ind[j]
+            # pruning
+            threshold = posteriors[i].max() - beam
+            if max_active < n_states:
+                threshold = max(threshold,
+                        np.sort(posteriors[i])[n_states - max_active])
+            for j in range(n_states):
+                if posteriors[i, j] < threshold:
+                    posteriors[i, j] = -np.inf
+                elif posteriors[i, j] > -np.inf:
+                    n_active += 1
+        return n_active
+
+
+def viterbi_dense(likelihoods, log_trans, init, backend='auto',
+        beam=None, max_active=None, stats=None):
+    """ dense Viterbi recursion, see run_viterbi(), with the backend:
+        * 'numpy': frame-vectorized NumPy
+        * 'compiled': numba kernel (needs numba)
+        * 'auto': 'compiled' if numba is installed, 'numpy' otherwise """
+    assert backend in BACKENDS, "unknown Viterbi backend " + str(backend)
+    if backend == 'auto':
+        backend = 'compiled' if numba is not None else 'numpy'
+    if backend == 'numpy':
+        return run_viterbi(likelihoods, functools.partial(dense_step,
+            log_trans), init, beam=beam, max_active=max_active, stats=stats)
+    assert numba is not None, "the compiled Viterbi backend needs numba"
+    posteriors = np.ndarray(likelihoods.shape, dtype='float64')
+    backpointers = np.ndarray((likelihoods.shape[0] - 1, likelihoods.shape[1]),
+            dtype='int64')
+    posteriors[0] = init + likelihoods[0]
+    n_active = prune(posteriors[0], beam, max_active)
+    n_active += _compiled_dense(likelihoods, log_trans, posteriors,
+            backpointers, np.inf if beam is None else float(beam),
+            likelihoods.shape[1] if max_active is None else int(max_active))
+    if stats is not None:
+        stats['frames'] = stats.get('frames', 0) + likelihoods.shape[0]
+        stats['active'] = stats.get('active', 0) + n_active
+    return posteriors, backpointers
+
+
+def average_active(stats_list):
+    """ average number of active states per frame over the stats dicts
+    filled by run_viterbi() / viterbi_dense() """
+    n_frames = sum(stats.get('frames', 0) for stats in stats_list)
+    n_active = sum(stats.get('active', 0) for stats in stats_list)
+    return n_active * 1.0 / max(1, n_frames)